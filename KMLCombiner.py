@@ -1,11 +1,30 @@
 #!/usr/bin/python3
 from lxml import etree as ET
+import argparse
 import logging
+import os
 import difflib
+import tempfile
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from itertools import chain, islice
+from math import asin, cos, floor, radians, sin, sqrt
+
+# Optional, pip install rapidfuzz makes the similarity check faster, the merged output is the same without it
+try:
+    from rapidfuzz.distance import LCSseq
+except ImportError:
+    LCSseq = None
 
-# Set up logging
 log_file = 'kml_merger.log'
-logging.basicConfig(level=logging.INFO, filename=log_file, filemode='w', format='%(asctime)s - %(levelname)s - %(message)s')
+
+similarity_threshold = 0.8  # Adjust as needed
+merge_distance = None  # Meters, placemarks with Points further apart than this are never merged. None compares them by name and address alone
+
+EARTH_RADIUS = 6371008.8  # Mean radius in meters
+METERS_PER_DEGREE = EARTH_RADIUS * 3.141592653589793 / 180
 
 def parse_kml(file_path):
     """
@@ -15,158 +34,628 @@ def parse_kml(file_path):
     tree = ET.parse(file_path)
     return tree, tree.getroot().nsmap
 
-def is_similar(placemark1, placemark2, nsmap):
+def similarity_above(text1, text2, threshold=similarity_threshold):
     """
-    Check if two placemarks are similar based on their names and addresses.
+    Check if difflib's similarity ratio of two strings is above the threshold. The ratio counts the
+    characters in matching blocks, which never exceeds their longest common subsequence (rapidfuzz, when
+    installed) or their shared characters (difflib's quick ratios), so those cheaper bounds reject most
+    pairs before the ratio itself is computed.
+    """
+    length = len(text1) + len(text2)
+    if not length:
+        return 1.0 > threshold
+    # difflib's real_quick_ratio, without building the matcher
+    if 2.0 * min(len(text1), len(text2)) / length <= threshold:
+        return False
+    if LCSseq is not None and 2.0 * LCSseq.similarity(text1, text2) / length <= threshold:
+        return False
+    matcher = difflib.SequenceMatcher(None, text1, text2)
+    if LCSseq is None and matcher.quick_ratio() <= threshold:
+        return False
+    return matcher.ratio() > threshold
+
+class KMLPaths:
+    """
+    Precompiled XPath lookups for the elements the merge reads, for one KML namespace.
+    """
+    def __init__(self, namespace):
+        self.namespace = namespace
+        namespaces = {'kml': namespace}
+        self.document = ET.XPath('.//kml:Document', namespaces=namespaces)
+        self.placemarks = ET.XPath('.//kml:Placemark', namespaces=namespaces)
+        self.name = ET.XPath('.//kml:name', namespaces=namespaces)
+        self.address = ET.XPath('.//kml:address', namespaces=namespaces)
+        self.description = ET.XPath('.//kml:description', namespaces=namespaces)
+        self.extended_data = ET.XPath('.//kml:ExtendedData', namespaces=namespaces)
+        self.data = ET.XPath('.//kml:Data', namespaces=namespaces)
+        self.value = ET.XPath('.//kml:value', namespaces=namespaces)
+        self.coordinates = ET.XPath('.//kml:Point/kml:coordinates', namespaces=namespaces)
+
+    def tag(self, name):
+        return f'{{{self.namespace}}}{name}'
+
+_kml_paths = {}
+
+def kml_paths(nsmap):
+    """
+    The KMLPaths for a tree's default namespace, compiled once per namespace.
+    """
+    namespace = nsmap[None]
+    if namespace not in _kml_paths:
+        _kml_paths[namespace] = KMLPaths(namespace)
+    return _kml_paths[namespace]
+
+def first(path, element):
+    """
+    The first element path finds under element in document order, like find(), or None.
+    """
+    found = path(element)
+    return found[0] if found else None
+
+def clean_address(address_text):
+    """
+    Drop the trailing country from an address.
+    """
+    if "United States" in address_text:
+        return address_text.replace(", United States", "")
+    elif "USA" in address_text:
+        return address_text.replace(", USA", "")
+    return address_text
+
+def parse_coordinates(coordinates_elem):
+    """
+    Longitude and latitude of a Point's coordinates element, or None if it has none.
     """
-    name1 = placemark1.find(f'.//{{{nsmap[None]}}}name').text or ''
-    name2 = placemark2.find(f'.//{{{nsmap[None]}}}name').text or ''
-    address1 = placemark1.find(f'.//{{{nsmap[None]}}}address').text or ''
-    address2 = placemark2.find(f'.//{{{nsmap[None]}}}address').text or ''
+    if coordinates_elem is None or not coordinates_elem.text:
+        return None
+    try:
+        longitude, latitude = coordinates_elem.text.split()[0].split(',')[:2]
+        return float(longitude), float(latitude)
+    except ValueError:
+        return None
 
+class PlacemarkRecord:
+    """
+    A placemark with everything the merge compares read from the XML once: its name, its normalized
+    address, its Point coordinates and its ExtendedData Data elements by name. The elements these came
+    from are kept too, so merging updates the XML and the record together without searching the tree.
+    Values merged into a Data element are collected by its name as ordered unique values and only
+    written into its value element by write_values().
+
+    A record from the process pool arrives as the serialized placemark instead, and a streaming merge
+    spills it to a file serialized once it's merged. load() parses it back only if the placemark gets
+    combined with another.
+    """
+    __slots__ = ('placemark', 'paths', 'name', 'address', 'coordinates', 'address_elem', 'description_elem',
+                 'extended_data_elem', 'extended_data', 'merged_values', 'source', 'tail')
+
+    def __init__(self, placemark, paths):
+        self.paths = paths
+        self.merged_values = {}
+        self.read_elements(placemark)
+        name_elem = first(paths.name, placemark)
+        self.name = (name_elem.text if name_elem is not None else None) or ''
+        self.address = (self.address_elem.text if self.address_elem is not None else None) or ''
+        self.coordinates = parse_coordinates(first(paths.coordinates, placemark))
+
+    def read_elements(self, placemark):
+        paths = self.paths
+        self.placemark = placemark
+        self.address_elem = first(paths.address, placemark)
+        self.description_elem = first(paths.description, placemark)
+        self.extended_data_elem = first(paths.extended_data, placemark)
+        self.extended_data = {}
+        if self.extended_data_elem is not None:
+            for data_elem in paths.data(self.extended_data_elem):
+                if data_elem.get('name') is not None:  # Unnamed Data are never merged into, only appended
+                    self.extended_data.setdefault(data_elem.get('name'), data_elem)
+
+    def data_values(self, name):
+        """
+        The values of the named Data element, a dict used as an ordered set, starting from the text of its
+        value element the first time values are merged into it.
+        """
+        if name not in self.merged_values:
+            value_elem = first(self.paths.value, self.extended_data[name])
+            self.merged_values[name] = dict.fromkeys([value_elem.text] if value_elem is not None and value_elem.text else [])
+        return self.merged_values[name]
+
+    def write_values(self):
+        """
+        Write the merged Data values into their value elements (added if missing), space separated, before
+        the placemark is saved.
+        """
+        for name, values in self.merged_values.items():
+            data_elem = self.extended_data[name]
+            value_elem = first(self.paths.value, data_elem)
+            if value_elem is None:
+                value_elem = ET.SubElement(data_elem, self.paths.tag('value'))
+            value_elem.text = ' '.join(values)
+
+    def compact(self):
+        """
+        The record as plain values for passing between processes: name, address, coordinates, and the
+        placemark serialized without its tail, plus the tail.
+        """
+        return self.name, self.address, self.coordinates, ET.tostring(self.placemark, with_tail=False), self.placemark.tail
+
+    @classmethod
+    def from_compact(cls, compact, paths):
+        record = cls.__new__(cls)
+        record.paths = paths
+        record.name, record.address, record.coordinates, record.source, record.tail = compact
+        record.placemark = None
+        record.merged_values = {}
+        return record
+
+    def spill(self, file):
+        """
+        Append the placemark, serialized without its tail and with its merged values written, to the end of
+        file and let go of the element. The merged values are kept, so merging can go on after load().
+        """
+        self.write_values()
+        source = ET.tostring(self.placemark, with_tail=False)
+        self.tail = self.placemark.tail
+        self.source = (file, file.seek(0, os.SEEK_END), len(source))
+        file.write(source)
+        self.placemark = self.address_elem = self.description_elem = self.extended_data_elem = self.extended_data = None
+
+    def read_source(self):
+        """
+        The serialized placemark, as it came from the process pool or read back from the spill file.
+        """
+        if isinstance(self.source, tuple):
+            file, offset, length = self.source
+            file.seek(offset)
+            return file.read(length)
+        return self.source
+
+    def load(self):
+        """
+        Parse the placemark back from its serialized form, the first time its elements are needed.
+        """
+        if self.placemark is None:
+            placemark = ET.fromstring(self.read_source())
+            placemark.tail = self.tail
+            self.read_elements(placemark)
+            self.source = None
+
+    def child(self, tag):
+        """
+        Add an element to the end of the placemark, as a missing one is filled in.
+        """
+        return ET.SubElement(self.placemark, self.paths.tag(tag))
+
+    def set_address(self, address_text):
+        self.address_elem.text = address_text
+        self.address = address_text or ''
+
+def is_similar(record1, record2):
+    """
+    Check if two placemarks are similar based on their names and addresses.
+    """
     # Skip if address is set to name (indicating missing address)
-    if name1 == address1 or name2 == address2:
+    if record1.name == record1.address or record2.name == record2.address:
         return False
 
-    similarity_threshold = 0.8  # Adjust as needed
-    name_similarity = difflib.SequenceMatcher(None, name1, name2).ratio()
-    address_similarity = difflib.SequenceMatcher(None, address1, address2).ratio()
-
     # Require both name and address to be similar
-    return name_similarity > similarity_threshold and address_similarity > similarity_threshold
+    return similarity_above(record1.name, record2.name) and similarity_above(record1.address, record2.address)
+
+def name_tokens(name):
+    """
+    The characters of a name as a set, with repeats told apart by their occurrence, e.g. 'lll' gives
+    ('l', 0), ('l', 1) and ('l', 2). Two names share as many tokens as they share characters.
+    """
+    seen = Counter()
+    tokens = []
+    for character in name:
+        tokens.append((character, seen[character]))
+        seen[character] += 1
+    return tokens
+
+class NameIndex:
+    """
+    Blocking index over placemark names, so a new placemark is only compared against placemarks whose
+    names could pass the similarity threshold instead of all of them.
 
-def process_placemark(placemark, nsmap):
+    A ratio above the threshold t needs at least t * (len1 + len2) / 2 shared characters, and therefore
+    more than t * len / (2 - t) for a name of length len whatever the other name is. With every name's
+    tokens sorted in one global order, rarest first, two names sharing that many tokens must share one
+    of the first len - floor(t * len / (2 - t)) tokens of each (prefix filtering), so only those are
+    indexed and probed. No similar pair is missed, and candidates come back in the order they were first
+    added, the order the dictionary of merged placemarks is scanned in.
+    """
+    def __init__(self, names, threshold=similarity_threshold):
+        self.threshold = threshold
+        self.rarity = Counter(token for name in names for token in name_tokens(name))
+        self.postings = defaultdict(list)
+        self.ranks = {}
+
+    def prefix(self, name):
+        tokens = sorted(name_tokens(name), key=lambda token: (self.rarity.get(token, 0), token))
+        # Shave a little off the bound so rounding can only make the prefix longer
+        overlap = int(self.threshold * len(name) / (2 - self.threshold) - 1e-9) + 1
+        return tokens[:len(tokens) - overlap + 1]
+
+    def add(self, key, name):
+        """
+        Index a placemark under its key in the merged dictionary, once per key.
+        """
+        if key in self.ranks:
+            return
+        self.ranks[key] = len(self.ranks)
+        # Empty names only match empty names, they all share the empty token
+        for token in self.prefix(name) if name else [None]:
+            self.postings[token].append(key)
+
+    def candidates(self, name):
+        """
+        Keys of the indexed placemarks whose names may be similar to name, in the order they were added.
+        """
+        keys = set()
+        for token in self.prefix(name) if name else [None]:
+            keys.update(self.postings.get(token, ()))
+        return sorted(keys, key=self.ranks.__getitem__)
+
+def distance_meters(coordinates1, coordinates2):
+    """
+    Great circle distance between two (longitude, latitude) points, haversine formula.
+    """
+    longitude1, latitude1 = map(radians, coordinates1)
+    longitude2, latitude2 = map(radians, coordinates2)
+    a = sin((latitude2 - latitude1) / 2) ** 2 + cos(latitude1) * cos(latitude2) * sin((longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(a)))
+
+class SpatialIndex:
+    """
+    Grid hash over placemark Points, so only placemarks within distance meters of each other are compared.
+    Rows are distance tall in latitude, and each row is split into as many equal columns around the globe
+    as fit when they're at least distance wide at the row's latitude furthest from the equator. A row
+    within distance of a pole is a single column, since nearby points there can be at any longitude.
+    Column numbers wrap at the antimeridian, and a lookup checks the neighbouring cells before measuring
+    the exact distance.
+    """
+    def __init__(self, distance):
+        self.distance = distance
+        self.cell = distance / METERS_PER_DEGREE
+        self.cells = defaultdict(list)
+        self.unplaced = 0  # Kept placemarks without a Point, only the name index finds those
+
+    def columns(self, row):
+        latitude = max(abs(row), abs(row + 1)) * self.cell
+        if latitude + self.cell >= 90:
+            return 1
+        return max(1, floor(360 * cos(radians(latitude)) / self.cell))
+
+    def add(self, record):
+        longitude, latitude = record.coordinates
+        row = floor(latitude / self.cell)
+        columns = self.columns(row)
+        self.cells[row, floor((longitude + 180) % 360 / 360 * columns) % columns].append(record)
+
+    def neighbours(self, record):
+        """
+        The indexed records within distance of the record's Point.
+        """
+        longitude, latitude = record.coordinates
+        found = []
+        for row in range(floor((latitude - self.cell) / self.cell), floor((latitude + self.cell) / self.cell) + 1):
+            columns = self.columns(row)
+            column = floor((longitude + 180) % 360 / 360 * columns)
+            for other_column in {(column + offset) % columns for offset in (-1, 0, 1)}:
+                for other in self.cells.get((row, other_column), ()):
+                    if distance_meters(record.coordinates, other.coordinates) <= self.distance:
+                        found.append(other)
+        return found
+
+def process_placemark(record):
     """
     Process each placemark to ensure it has an address, and normalize the address if it does.
     """
-    existing_address_elem = placemark.find(f'.//{{{nsmap[None]}}}address')
-    if existing_address_elem is not None and existing_address_elem.text:
-        address_text = existing_address_elem.text
+    if record.address:
         # Normalize address
-        if "United States" in address_text:
-            existing_address_elem.text = address_text.replace(", United States", "")
-        elif "USA" in address_text:
-            existing_address_elem.text = address_text.replace(", USA", "")
-    else:
+        address_text = clean_address(record.address)
+        if address_text != record.address:
+            record.set_address(address_text)
+    elif record.name:
         # Set address to the name of the placemark if address is missing
-        placemark_name = placemark.find(f'.//{{{nsmap[None]}}}name').text
-        if placemark_name:
-            if existing_address_elem is None:
-                existing_address_elem = ET.SubElement(placemark, f'{{{nsmap[None]}}}address')
-            existing_address_elem.text = placemark_name
+        if record.address_elem is None:
+            record.address_elem = record.child('address')
+        record.set_address(record.name)
 
-def combine_placemark_data(existing_placemark, new_placemark, nsmap):
+def combine_placemark_data(existing_record, new_record):
     """
     Combine data from two placemarks with the same name, ensuring no information is lost.
     """
-    def get_or_create_element(parent, tag):
-        element = parent.find(f'.//{{{nsmap[None]}}}{tag}')
-        if element is None:
-            element = ET.SubElement(parent, f'{{{nsmap[None]}}}{tag}')
-        return element
+    existing_record.load()
+    new_record.load()
 
     # Merge description
-    existing_desc = get_or_create_element(existing_placemark, 'description')
-    new_desc = new_placemark.find(f'.//{{{nsmap[None]}}}description')
+    if existing_record.description_elem is None:
+        existing_record.description_elem = existing_record.child('description')
+    existing_desc = existing_record.description_elem
+    new_desc = new_record.description_elem
     if new_desc is not None and new_desc.text and (new_desc.text not in (existing_desc.text or '')):
         existing_desc.text = (existing_desc.text or '') + ' ' + new_desc.text
 
     # Normalize and merge address
-    existing_address_elem = get_or_create_element(existing_placemark, 'address')
-    new_address_elem = new_placemark.find(f'.//{{{nsmap[None]}}}address')
-    if new_address_elem is not None and new_address_elem.text:
-        address_text = new_address_elem.text
+    if existing_record.address_elem is None:
+        existing_record.address_elem = existing_record.child('address')
+    if new_record.address:
         # Clean address if it contains 'United States' or 'USA'
-        if "United States" in address_text:
-            address_text = address_text.replace(", United States", "")
-        elif "USA" in address_text:
-            address_text = address_text.replace(", USA", "")
-        if address_text not in (existing_address_elem.text or ''):
-            existing_address_elem.text = (existing_address_elem.text or '') + ' ' + address_text
-    elif existing_address_elem.text is None or existing_address_elem.text.strip() == '':
+        address_text = clean_address(new_record.address)
+        if address_text not in existing_record.address:
+            existing_record.set_address(existing_record.address + ' ' + address_text)
+    elif existing_record.address.strip() == '':
         # Set address to placemark's name if no address is found
-        placemark_name = new_placemark.find(f'.//{{{nsmap[None]}}}name').text
-        existing_address_elem.text = placemark_name
-            # Process each placemark after merging data
-    process_placemark(existing_placemark, nsmap)
-    process_placemark(new_placemark, nsmap)
-
-    # Merge ExtendedData
-    existing_data = get_or_create_element(existing_placemark, 'ExtendedData')
-    new_data = new_placemark.find(f'.//{{{nsmap[None]}}}ExtendedData')
-    if new_data is not None:
-        for new_data_elem in new_data.findall(f'.//{{{nsmap[None]}}}Data'):
+        existing_record.set_address(new_record.name or None)
+    # Process each placemark after merging data
+    process_placemark(existing_record)
+    process_placemark(new_record)
+
+    # Merge ExtendedData, by name and then by distinct value
+    if existing_record.extended_data_elem is None:
+        existing_record.extended_data_elem = existing_record.child('ExtendedData')
+    existing_data = existing_record.extended_data_elem
+    if new_record.extended_data_elem is not None:
+        for new_data_elem in new_record.paths.data(new_record.extended_data_elem):
             new_data_name = new_data_elem.get('name')
-            existing_data_elem = existing_data.find(f'.//{{{nsmap[None]}}}Data[@name="{new_data_name}"]')
-            if existing_data_elem is None:
+            if new_data_name is None:
                 existing_data.append(new_data_elem)
+            elif new_data_name not in existing_record.extended_data:
+                existing_data.append(new_data_elem)
+                existing_record.extended_data[new_data_name] = new_data_elem
             else:
-                existing_value_elem = get_or_create_element(existing_data_elem, 'value')
-                new_value_elem = new_data_elem.find(f'.//{{{nsmap[None]}}}value')
-                if new_value_elem.text and new_value_elem.text not in (existing_value_elem.text or ''):
-                    existing_value_elem.text = (existing_value_elem.text or '') + ' ' + new_value_elem.text
+                values = existing_record.data_values(new_data_name)
+                new_value_elem = first(new_record.paths.value, new_data_elem)
+                if new_value_elem is not None and new_value_elem.text:
+                    values.setdefault(new_value_elem.text)
+
+
+def merge_candidates(new_record, placemark_dict, name_index, spatial_index=None):
+    """
+    Names of the kept placemarks that could be similar to a new one, in the order they were kept: those
+    whose names could be similar, and with a spatial index, only the nearby ones among those with Points.
+    """
+    if spatial_index is None or new_record.coordinates is None:
+        return name_index.candidates(new_record.name)
+    names = {record.name for record in spatial_index.neighbours(new_record) if placemark_dict[record.name] is record}
+    if spatial_index.unplaced:
+        names.update(name for name in name_index.candidates(new_record.name) if placemark_dict[name].coordinates is None)
+    return sorted(names, key=name_index.ranks.__getitem__)
+
+def merge_placemark(new_record, placemark_dict, name_index, spatial_index=None):
+    """
+    Merge a placemark, already through process_placemark, into those kept so far: combine it into the
+    first similar one, or keep it. Returns the placemark it was combined into, or None if it was kept.
+    """
+    # Check for similar placemark, among those whose names could be similar
+    similar_record = None
+    for existing_name in merge_candidates(new_record, placemark_dict, name_index, spatial_index):
+        existing_record = placemark_dict[existing_name]
+        if is_similar(existing_record, new_record):
+            similar_record = existing_record
+            break
+
+    if similar_record is not None:
+        combine_placemark_data(similar_record, new_record)
+        return similar_record
+    placemark_dict[new_record.name] = new_record
+    name_index.add(new_record.name, new_record.name)
+    if spatial_index is not None:
+        if new_record.coordinates is not None:
+            spatial_index.add(new_record)
+        else:
+            spatial_index.unplaced += 1
+    return None
 
+def load_placemarks(file_path):
+    """
+    Parse and normalize the placemarks of a KML file, returned in compact form so this can run in the
+    process pool: the file's root tag, Document tag and namespace map, and a list of compact records.
+    """
+    tree, nsmap = parse_kml(file_path)
+    paths = kml_paths(nsmap)
+    root = tree.getroot()
+    document = first(paths.document, root)
+    compacts = []
+    if document is not None:
+        for placemark in paths.placemarks(document):
+            record = PlacemarkRecord(placemark, paths)
+            process_placemark(record)
+            compacts.append(record.compact())
+    return root.tag, document.tag if document is not None else None, nsmap, compacts
 
-def merge_kml_trees(trees):
+def merge_records(files):
     """
-    Merge multiple KML trees by adding or combining 'Placemark' elements.
+    Merge the placemark records of each file in turn. Returns the records to write: those of the first
+    file that were combined into another (the first document keeps them, after combining), then every
+    placemark kept, in the order they were kept.
     """
-    merged_tree = trees[0][0]
-    merged_nsmap = trees[0][1]
-    merged_document = merged_tree.getroot().find(f'.//{{{merged_nsmap[None]}}}Document')
+    name_index = NameIndex([record.name for records in files for record in records])
+    spatial_index = SpatialIndex(merge_distance) if merge_distance is not None else None
     placemark_dict = {}
+    combined, kept = [], []
 
-    for tree, nsmap in trees:
-        document = tree.getroot().find(f'.//{{{nsmap[None]}}}Document')
-        if document is not None:
-            for new_placemark in document.findall(f'.//{{{nsmap[None]}}}Placemark'):
-                process_placemark(new_placemark, nsmap)
+    for position, records in enumerate(files):
+        for new_record in records:
+            if merge_placemark(new_record, placemark_dict, name_index, spatial_index) is None:
+                kept.append(new_record)
+            elif position == 0:
+                combined.append(new_record)
 
-                # Check for similar placemark
-                similar_placemark = None
-                for existing_name, existing_placemark in placemark_dict.items():
-                    if is_similar(existing_placemark, new_placemark, nsmap):
-                        similar_placemark = existing_placemark
-                        break
+    return combined + kept
+
+def iter_placemarks(file_path):
+    """
+    Parse a KML file placemark by placemark, yielding each Placemark element with the paths for its
+    namespace as soon as its end tag is read. The placemark is detached from the tree first, so it's
+    freed as soon as the caller lets go of it instead of staying in the document.
+    """
+    for _, placemark in ET.iterparse(file_path, events=('end',), tag='{*}Placemark'):
+        paths = kml_paths(placemark.nsmap)
+        placemark.getparent().remove(placemark)
+        yield placemark, paths
 
-                if similar_placemark:
-                    combine_placemark_data(similar_placemark, new_placemark, nsmap)
-                else:
-                    new_name = new_placemark.find(f'.//{{{nsmap[None]}}}name').text
-                    merged_document.append(new_placemark)
-                    placemark_dict[new_name] = new_placemark
+def iter_records(file_paths):
+    """
+    The position of the file and the normalized record of each placemark in the files, in order.
+    """
+    for position, file_path in enumerate(file_paths):
+        logging.info(f"Streaming file: {file_path}")
+        for placemark, paths in iter_placemarks(file_path):
+            record = PlacemarkRecord(placemark, paths)
+            process_placemark(record)
+            yield position, record
 
-    return merged_tree
+def kml_header(file_path):
+    """
+    The root tag, Document tag and namespace map of a KML file, reading only as far as its Document.
+    """
+    root = None
+    for _, element in ET.iterparse(file_path, events=('start',)):
+        if root is None:
+            root = element
+        elif ET.QName(element).localname == 'Document':
+            return root.tag, element.tag, root.nsmap
+    return root.tag, None, root.nsmap
 
-def split_and_save_kml(tree, output_file_path, max_features=2000):
+def stream_merge_kml_files(file_paths, output_file_path, max_features=2000, rarity_sample=10000):
     """
-    Split the KML tree into multiple files, each containing up to max_features placemarks.
+    Merge multiple KML files like merge_kml_files, with the same merge decisions, but read each file
+    placemark by placemark in a single pass. Every placemark that will be written is serialized to a
+    spill file next to the output as soon as it's merged, and one that another placemark is combined
+    into is read back for that and spilled again, so memory holds the name and spatial indexes with the
+    records they point at rather than the placemarks. A later placemark can still be combined into any
+    earlier one, so the parts are written once every file is merged, reading the placemarks back from
+    the spill file one at a time.
+
+    The name index orders characters by how often they occur in the first rarity_sample names rather
+    than in every name. Any fixed order finds the same candidates, the counts only make the lookups
+    cheaper.
     """
-    root = tree.getroot()
-    nsmap = root.nsmap
-    document = root.find(f'.//{{{nsmap[None]}}}Document')
-    placemarks = document.findall(f'.//{{{nsmap[None]}}}Placemark')
+    spatial_index = SpatialIndex(merge_distance) if merge_distance is not None else None
+    placemark_dict = {}
+    # Placemarks of the first file that were combined into another stay in the tree merge's output, ahead
+    # of every kept placemark, so they're written here too
+    combined, kept = [], []
+
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(output_file_path))) as spill:
+        records = iter_records(file_paths)
+        sample = list(islice(records, rarity_sample))
+        name_index = NameIndex(record.name for _, record in sample)
+        for position, record in chain(sample, records):
+            similar_record = merge_placemark(record, placemark_dict, name_index, spatial_index)
+            if similar_record is None:
+                kept.append(record)
+                record.spill(spill)
+                continue
+            # Combining loaded it back, spill it again with what was merged in
+            similar_record.spill(spill)
+            if position == 0:
+                combined.append(record)
+                record.spill(spill)
+        write_streamed_parts(combined + kept, output_file_path, *kml_header(file_paths[0]), max_features)
+
+def write_streamed_parts(records, output_file_path, root_tag, document_tag, nsmap, max_features=2000):
+    """
+    Split the merged, spilled placemarks into parts of up to max_features placemarks, written one element
+    at a time with etree.xmlfile. The placemarks are written without the default namespace, which the root
+    element declares, so they don't each repeat its declaration. A placemark using another namespace,
+    such as gx, still declares that one itself.
+    """
+    namespace = f'{{{nsmap[None]}}}'
+    for start in range(0, len(records), max_features):
+        part_file_path = kml_part_path(output_file_path, start // max_features + 1)
+        with ET.xmlfile(part_file_path, encoding='UTF-8') as file:
+            file.write_declaration()
+            with file.element(root_tag, nsmap=nsmap):
+                file.write('\n  ')
+                with file.element(document_tag):
+                    for record in records[start:start + max_features]:
+                        placemark = ET.fromstring(record.read_source())
+                        placemark.tail = record.tail
+                        for element in placemark.iter(namespace + '*'):
+                            element.tag = element.tag[len(namespace):]
+                        ET.cleanup_namespaces(placemark)
+                        file.write(placemark)
+                file.write('\n')
+        logging.info(f"Saved {part_file_path} with {len(records[start:start + max_features])} placemarks")
+
+def kml_part_path(output_file_path, part):
+    return f"{output_file_path.rsplit('.', 1)[0]}_part{part}.kml"
 
-    for i in range(0, len(placemarks), max_features):
-        new_root = ET.Element(root.tag, nsmap=root.nsmap)
-        new_document = ET.SubElement(new_root, document.tag, nsmap=document.nsmap)
-        new_document.extend(placemarks[i:i + max_features])
-        new_tree = ET.ElementTree(new_root)
-        part_file_path = f"{output_file_path.rsplit('.', 1)[0]}_part{i // max_features + 1}.kml"
-        with open(part_file_path, 'wb') as file:
-            new_tree.write(file, xml_declaration=True, encoding='UTF-8', pretty_print=True)
-        logging.info(f"Saved {part_file_path} with {len(placemarks[i:i + max_features])} placemarks")
+def write_kml_part(part_file_path, placemarks, root_tag, document_tag, nsmap):
+    """
+    Write one part file from serialized placemarks, each with its tail. Runs in the process pool.
+    """
+    new_root = ET.Element(root_tag, nsmap=nsmap)
+    new_document = ET.SubElement(new_root, document_tag, nsmap=nsmap)
+    for source, tail in placemarks:
+        placemark = ET.fromstring(source)
+        placemark.tail = tail
+        new_document.append(placemark)
+    # Each placemark declared the namespaces it was serialized with, the root declares them already
+    ET.cleanup_namespaces(new_root)
+    new_tree = ET.ElementTree(new_root)
+    with open(part_file_path, 'wb') as file:
+        new_tree.write(file, xml_declaration=True, encoding='UTF-8', pretty_print=True)
+    return len(placemarks)
+
+def split_and_save_kml(records, output_file_path, root_tag, document_tag, nsmap, map_function=map, max_features=2000):
+    """
+    Split the merged placemarks into multiple files, each containing up to max_features placemarks,
+    serialized by map_function, e.g. a process pool's map.
+    """
+    placemarks = []
+    for record in records:
+        if record.placemark is None:
+            placemarks.append((record.source, record.tail))
+        else:
+            record.write_values()
+            placemarks.append((ET.tostring(record.placemark, with_tail=False), record.placemark.tail))
+    part_file_paths = [kml_part_path(output_file_path, i // max_features + 1) for i in range(0, len(placemarks), max_features)]
+    parts = [placemarks[i:i + max_features] for i in range(0, len(placemarks), max_features)]
+    write_part = partial(write_kml_part, root_tag=root_tag, document_tag=document_tag, nsmap=nsmap)
+    for part_file_path, saved in zip(part_file_paths, map_function(write_part, part_file_paths, parts)):
+        logging.info(f"Saved {part_file_path} with {saved} placemarks")
 
-def merge_kml_files(file_paths, output_file_path):
+def merge_kml_files(file_paths, output_file_path, streaming=False, workers=None):
     """
-    Merge multiple KML files and save the result to a specified location.
+    Merge multiple KML files and save the result to a specified location. The files are parsed and the
+    parts written by a pool of worker processes (one per CPU by default); the output is the same for
+    any number. With streaming, the files are merged placemark by placemark in one process instead of
+    parsed whole, for inputs too large to hold in memory.
     """
-    trees = [parse_kml(file_path) for file_path in file_paths]
-    merged_tree = merge_kml_trees(trees)
-    split_and_save_kml(merged_tree, output_file_path)
+    if streaming:
+        stream_merge_kml_files(file_paths, output_file_path)
+        return
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) if workers > 1 else nullcontext() as pool:
+        map_function = pool.map if pool is not None else map
+        loaded = list(map_function(load_placemarks, file_paths))
+        root_tag, document_tag, nsmap = loaded[0][:3]
+        files = [[PlacemarkRecord.from_compact(compact, kml_paths(file_nsmap)) for compact in compacts]
+                 for _, _, file_nsmap, compacts in loaded]
+        records = merge_records(files)
+        split_and_save_kml(records, output_file_path, root_tag, document_tag, nsmap, map_function)
+
+if __name__ == "__main__":
+    # Set up logging, here so pool workers that import this module don't truncate the log
+    logging.basicConfig(level=logging.INFO, filename=log_file, filemode='w', format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Example usage
-file_paths = ['AllTheThings.kml', 'StateParks.kml', 'NationalMonuments.kml', 'RecreationAreas.kml']
-output_file_path = 'CombinedKML.kml'
+    parser = argparse.ArgumentParser(description="Merge the placemarks of several KML files into parts of up to 2000 placemarks.")
+    parser.add_argument("files", metavar="FILE", nargs='*', default=['AllTheThings.kml', 'StateParks.kml', 'NationalMonuments.kml', 'RecreationAreas.kml'],
+                        help="KML files to merge, in order (default: AllTheThings.kml StateParks.kml NationalMonuments.kml RecreationAreas.kml).")
+    parser.add_argument("--output", metavar="FILE", default='CombinedKML.kml', help="Output file name, parts are written as FILE_partN.kml (default: CombinedKML.kml).")
+    parser.add_argument("--stream", action='store_true', help="Merge the files placemark by placemark with a spill file next to the output, for inputs too large to hold in memory.")
+    parser.add_argument("--workers", type=int, help="Worker processes that parse the files and write the parts (default: one per CPU).")
+    parser.add_argument("--merge-distance", metavar="METERS", type=float, help="Never merge placemarks whose Points are further apart than METERS, e.g. like-named parks in two states (default: compare by name and address alone).")
+    args = parser.parse_args()
+    if args.stream and args.workers is not None:
+        parser.error("--workers has no effect with --stream, which merges in one process")
+    if args.merge_distance is not None and args.merge_distance <= 0:
+        parser.error("--merge-distance must be more than 0 meters")
+    merge_distance = args.merge_distance
 
-merge_kml_files(file_paths, output_file_path)
+    merge_kml_files(args.files, args.output, streaming=args.stream, workers=args.workers)
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+# Parameters to configure
+cube_count = 40 # Distinct cubeName values, a few of them contain commas, colons, quotes or non-ASCII characters
+dashboards_per_cube = 12 # Dashboards drawing on each cube
+widgets_per_dashboard = 15 # Widgets on each dashboard
+m2m_rate = 0.02 # Share of queries whose queryMetadata carries m2mThresholdFlag 1
+noise_lines_per_query = 3.0 # Average non-FinishQuery lines (StartQuery, translation and connector chatter) per FinishQuery line
+malformed_rate = 0.001 # Share of FinishQuery lines cut short, so only the regex fallback of the parsers can read them
+tail_rate = 0.03 # Share of durations drawn from the Pareto tail instead of the lognormal body
+tail_alpha = 1.3 # Pareto shape of the tail, smaller is heavier
+write_batch = 4096 # Lines joined and written at once
+
+WIDGET_TYPES = ('pivot2', 'chart/bar', 'chart/line', 'chart/column', 'chart/pie', 'indicator', 'tablewidget', 'richtexteditor', 'sunburst', 'map/scatter')
+QUERY_SOURCES = ('dashboard', 'dashboard', 'dashboard', 'api', 'pulse', 'export')
+ODD_CUBE_NAMES = ('Sales, EMEA', 'Ops: Daily', 'Finance "Actuals"', 'Ventes Européennes', 'HR\\Payroll')
+NOISE_MESSAGES = ('StartQuery', 'TranslateQuery', 'ExecuteQuery', 'ConnectorResponse')
+SIZE_PATTERN = re.compile(r'^\s*([0-9.]+)\s*([KMGT]?)B?\s*$', re.IGNORECASE)
+
+def parse_size(text):
+    """
+    Parse a byte count such as 500MB, 2G or 1048576.
+    """
+    match = SIZE_PATTERN.match(text)
+    if not match:
+        raise argparse.ArgumentTypeError(f"not a size: {text}")
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+def object_id(rng):
+    return '%024x' % rng.getrandbits(96)
+
+class QueryLogGenerator:
+    """
+    Emits FinishQuery lines shaped like Sisense's query.log: JSON with the fields the tooling reads,
+    queryMetadata as an escaped JSON string, a long tail of durations and noise lines in between.
+    The same seed and time range always give the same lines.
+    """
+    def __init__(self, seed=1):
+        self.rng = random.Random(seed)
+        rng = self.rng
+        names = [f'Cube{number:03d}' for number in range(cube_count - len(ODD_CUBE_NAMES))] + list(ODD_CUBE_NAMES)
+        self.cubes = []
+        for name in names:
+            dashboards = []
+            for _ in range(dashboards_per_cube):
+                widgets = [(object_id(rng), rng.choice(WIDGET_TYPES)) for _ in range(widgets_per_dashboard)]
+                dashboards.append((object_id(rng), widgets))
+            # Cube sizes differ a lot, so some cubes are slow across the board
+            self.cubes.append((json.dumps(name, ensure_ascii=False), dashboards, rng.lognormvariate(0, 0.6)))
+        # A Zipf-like weighting, a handful of cubes take most of the queries
+        self.cube_weights = list(accumulate(1 / (rank + 1) for rank in range(len(self.cubes))))
+
+    def duration(self, scale):
+        rng = self.rng
+        if rng.random() < tail_rate:
+            return scale * 5 * rng.paretovariate(tail_alpha)
+        return scale * rng.lognormvariate(-0.5, 0.9)
+
+    def finish_query(self, timestamp):
+        rng = self.rng
+        cube_name, dashboards, scale = rng.choices(self.cubes, cum_weights=self.cube_weights)[0]
+        dashboard, widgets = rng.choice(dashboards)
+        widget, widget_type = rng.choice(widgets)
+        query_source = rng.choice(QUERY_SOURCES)
+        duration = self.duration(scale)
+        concurrent_query = min(int(rng.expovariate(0.25)) + 1, 64)
+        throttling = duration * rng.random() * 0.5 if concurrent_query > 10 else 0.0
+        translation = duration * rng.uniform(0.02, 0.2)
+        m2m_flag = 1 if rng.random() < m2m_rate else 0
+        metadata = f'{{\\"m2mThresholdFlag\\":{m2m_flag},\\"rowsCount\\":{rng.randint(0, 50000)},\\"queryGuid\\":\\"{object_id(rng)}\\"}}'
+        origin = f'"dashboard":"{dashboard}","widget":"{widget}",' if query_source != 'api' else ''
+        return (f'{{"Log_DateTime":"{timestamp.isoformat(timespec="milliseconds")}Z","Log_Level":"info","Log_Message":"FinishQuery",'
+                f'"component":"query-service","cubeName":{cube_name},{origin}"widgetType":"{widget_type}","querySource":"{query_source}",'
+                f'"duration":{duration:.3f},"translationDuration":{translation:.3f},"dataSourceExecuteDuration":{duration - translation - throttling:.3f},'
+                f'"throttlingTimeWaiting":{throttling:.3f},"concurrentQuery":{concurrent_query},"queryMetadata":"{metadata}"}}\n')
+
+    def noise(self, timestamp):
+        rng = self.rng
+        return (f'{{"Log_DateTime":"{timestamp.isoformat(timespec="milliseconds")}Z","Log_Level":"info",'
+                f'"Log_Message":"{rng.choice(NOISE_MESSAGES)}","component":"query-service","queryGuid":"{object_id(rng)}"}}\n')
+
+    def lines(self, start, end, count):
+        """
+        Yield count FinishQuery lines with noise in between, timestamps spread evenly from start to end.
+        """
+        rng = self.rng
+        step = (end - start) / max(count, 1)
+        for position in range(count):
+            timestamp = start + step * position
+            for _ in range(int(rng.expovariate(1 / noise_lines_per_query)) if noise_lines_per_query else 0):
+                yield self.noise(timestamp)
+            line = self.finish_query(timestamp)
+            if rng.random() < malformed_rate:
+                line = line[:rng.randint(len(line) // 2, len(line) - 2)] + '\n'
+            yield line
+
+    def write_log(self, path, start, end, size):
+        """
+        Write lines covering start to end until about size uncompressed bytes, gzipped when path ends in .gz.
+        Returns (lines, finish_query_lines, bytes) written.
+        """
+        # Estimate the FinishQuery count from a sample so timestamps still run from start to end
+        sample = ''.join(QueryLogGenerator(self.rng.random()).lines(start, end, 200))
+        count = max(1, int(size / (len(sample.encode()) / 200)))
+        lines = written = 0
+        # logrotate compresses with gzip's default level 6, gzip.open would use 9
+        with (gzip.open(path, 'wb', compresslevel=6) if path.endswith('.gz') else open(path, 'wb')) as file:
+            batch = []
+            for line in self.lines(start, end, count):
+                batch.append(line)
+                if len(batch) >= write_batch:
+                    data = ''.join(batch).encode()
+                    file.write(data)
+                    written += len(data)
+                    lines += len(batch)
+                    batch = []
+            data = ''.join(batch).encode()
+            file.write(data)
+            written += len(data)
+            lines += len(batch)
+        return lines, count, written
+
+def generate_logs(directory, size, rotated_files=4, days=7, plain=True, seed=1, now=None):
+    """
+    Write a query.log and rotated_files gzipped rotations named query.log-YYYYMMDDHH.gz into directory,
+    splitting size uncompressed bytes evenly and days of log time across them, newest in query.log.
+    Returns {path: (lines, finish_query_lines, bytes)}.
+    """
+    os.makedirs(directory, exist_ok=True)
+    generator = QueryLogGenerator(seed)
+    now = now or datetime.now().replace(microsecond=0)
+    file_count = rotated_files + (1 if plain else 0)
+    span = timedelta(days=days) / file_count
+    stats = {}
+    for position in range(file_count):
+        start = now - span * (file_count - position)
+        end = start + span
+        if plain and position == file_count - 1:
+            path = os.path.join(directory, 'query.log')
+        else:
+            path = os.path.join(directory, f'query.log-{end.strftime("%Y%m%d%H")}.gz')
+        stats[path] = generator.write_log(path, start, end, size // file_count)
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write synthetic Sisense query logs for testing and benchmarking the query log tooling.")
+    parser.add_argument("directory", help="Where to write query.log and the rotated query.log-*.gz files.")
+    parser.add_argument("--size", type=parse_size, default=parse_size('100MB'), help="Total uncompressed size, e.g. 500MB or 4GB (default 100MB).")
+    parser.add_argument("--rotated", metavar="N", type=int, default=4, help="Number of gzipped rotations to write (default 4).")
+    parser.add_argument("--days", type=float, default=7, help="Days of log time to cover, ending now (default 7).")
+    parser.add_argument("--no-plain", action="store_true", help="Only write gzipped rotations, no query.log.")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed, the same seed writes the same logs.")
+    args = parser.parse_args()
+
+    if args.rotated < 0 or (args.no_plain and args.rotated == 0):
+        parser.error("nothing to write")
+    stats = generate_logs(args.directory, args.size, args.rotated, args.days, not args.no_plain, args.seed)
+    for path, (lines, finish_queries, written) in stats.items():
+        print(f"{path}: {lines} lines, {finish_queries} FinishQuery, {written / (1024 * 1024):.1f} MB uncompressed")
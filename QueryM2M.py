@@ -1,193 +1,2663 @@
 #!/usr/bin/python3
+import argparse
+import atexit
+import cProfile
 import gzip
+import hashlib
+import os
+import pickle
+import shutil
+import socket
+import sqlite3
+import subprocess
+import tarfile
+import tempfile
+import time
 import re
 import glob
-from collections import defaultdict, Counter
-from datetime import datetime, timedelta
-from math import ceil
+import heapq
+from array import array
+from collections import defaultdict, namedtuple, Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from operator import itemgetter
+from datetime import datetime, timedelta, timezone
+from math import ceil, exp, log
+import json
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+try:
+    from zlib_ng import gzip_ng
+except ImportError:
+    gzip_ng = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 # Parameters to configure
 days_to_look_back = 1  # Modify this to change the range of days to look back
 slow_query_threshold = 30.0 # Filter for queries which took longer than this value to process
+slow_query_list_threshold = 5.0 # --performance lists every query slower than this many seconds, as SlowQuery.sh did
+slow_query_run_size = 100000 # ... sorting them in runs of this many queries that are spilled to disk and merged
+duration_run_size = 2000000 # --performance keeps at most this many durations in memory for its percentile table, then spills them in sorted runs per cube
+run_merge_fan_in = 64 # ... merging at most this many runs at once
+duplicate_window_seconds = 300 # --duplicates counts a query as repeated work when the same fingerprint ran within this many seconds, roughly a result cache lifetime
+fingerprint_lru_size = 10000 # ... remembering this many recent fingerprints per cube
+duplicate_top_widgets = 10 # ... and lists this many widgets wasting the most seconds on repeats
 repeat_offender_threshold = 1 # Filters the number of widgets returned to help identify poorly written widgets and make the output prettier
+sketch_relative_accuracy = 0.01 # Percentiles are reported within this relative error of the true value
+heavy_hitter_capacity = 1000 # With --top-k, widgets, dashboards, M2M combinations and minutes are counted in this many slots (widgets per cube), so counts are overestimated by at most 1/1000 of the queries
+sketch_max_buckets = 2048 # Upper bound on buckets kept per latency sketch, roughly 100 KB per cube, dashboard or widget at worst
+chunk_size = 64 * 1024 * 1024 # Plain logs larger than this many bytes are split into chunks so they can be parsed in parallel
+gzip_backend = 'auto' # How rotated logs are decompressed: auto, isal, zlib-ng, pigz, zcat or gzip. auto picks the first of isal, zlib-ng, pigz and gzip available
+read_block_size = 4 * 1024 * 1024 # Logs are read in blocks of this many bytes and split into lines by hand
+search_margin = 1024 * 1024 # Stop binary searching query.log for the start of the window once it is narrowed to this many bytes
+rollup_retention_days = {'minute': 14, 'hour': 400, 'day': 3650} # How long the --rollup store keeps each tier, older rows are dropped on every update
+timeline_top_seconds = 10 # --timeline lists this many seconds with the highest in-flight concurrency
+capacity_window_seconds = 60 # --capacity fits the arrival rate and execution time of each cube in windows of this many seconds
+capacity_limits = (1, 2, 3, 4, 6, 8, 10, 12, 16, 20, 24, 32, 48, 64) # ... simulates P95 latency at these concurrency limits and the observed one
+capacity_slack = 0.05 # ... and recommends the smallest limit whose P95 is within 5% of the best simulated
+follow_window_seconds = 300 # --follow keeps rolling aggregates over this many seconds of log time
+follow_bucket_seconds = 10 # ... split into ring buffer slots this many seconds wide
+alert_p95_seconds = 30.0 # --follow alerts when a cube or dashboard P95 over the window goes above this
+alert_m2m_hits = 1 # ... when this many m2mThresholdFlag queries land inside the window
+alert_throttling_seconds = 5.0 # ... or when the average throttlingTimeWaiting over the window goes above this
+state_directory = os.path.expanduser('~/.cache/QueryM2M') # Where the timestamp index, the --incremental checkpoint and the --cache columns are kept between runs
+
+profile_sample_every = 64 # --profile times the parsing and aggregation of every 64th FinishQuery line phase by phase and scales up
+active_profile = None # The PhaseProfile collecting --profile timings in this process, None when not profiling
 
 # Log files to process
 log_directory = '/var/log/sisense/sisense'
-log_files = glob.glob(f'{log_directory}/query.log') + glob.glob(f'{log_directory}/query*.log-*.gz')
-
-# Script Variables Declared
-earliest_date = datetime.now().replace(tzinfo=None) - timedelta(days=days_to_look_back)
-data = defaultdict(list)
-dashboard_widget_count = defaultdict(lambda: defaultdict(Counter))
-m2m_threshold_entries = defaultdict(Counter)
-widget_types = defaultdict(lambda: defaultdict(lambda: defaultdict(str)))
-query_sources = defaultdict(str)
-timestamp_count = Counter()
-earliest_timestamp = None
-latest_timestamp = None
-total_slow_queries = 0
-total_queries = 0
-total_duration = 0
-max_values = defaultdict(lambda: defaultdict(lambda: {'translationDuration': 0, 'dataSourceExecuteDuration': 0, 'throttlingTimeWaiting': 0}))
+
+def find_log_files(log_directory):
+    return glob.glob(f'{log_directory}/query.log') + glob.glob(f'{log_directory}/query*.log-*.gz')
+
+# Named factories instead of lambdas so partial aggregates can be pickled between processes
+def _widget_counter():
+    return defaultdict(Counter)
+
+def _widget_type():
+    return defaultdict(str)
+
+def _widget_type_map():
+    return defaultdict(_widget_type)
+
+def _max_value_record():
+    return {'translationDuration': 0, 'dataSourceExecuteDuration': 0, 'throttlingTimeWaiting': 0}
+
+def _max_value_map():
+    return defaultdict(_max_value_record)
+
+def _merge_max_values(max_vals, other_vals):
+    for key, value in other_vals.items():
+        max_vals[key] = max(max_vals[key], value)
+
+FINISH_QUERY_MARKER = '"Log_Message":"FinishQuery"'
+FINISH_QUERY_MARKER_BYTES = FINISH_QUERY_MARKER.encode()
+
+# Only the fields the reports use, parsed once per line into a compact record
+FinishQuery = namedtuple('FinishQuery', ['timestamp', 'cube_name', 'dashboard', 'widget', 'widget_type', 'query_source',
+                                         'duration', 'translation_duration', 'data_source_execute_duration',
+                                         'throttling_time_waiting', 'concurrent_query', 'm2m_flag'])
+_new_finish_query = tuple.__new__ # Skips the keyword handling in the namedtuple constructor, this runs once per line
+
+# Fallback for lines that aren't valid JSON, keys inside the escaped embedded JSON don't match because they end in \"
+FIELD_PATTERN = re.compile(r'"(Log_DateTime|cubeName|dashboard|widget|widgetType|querySource|duration|translationDuration|'
+                           r'dataSourceExecuteDuration|throttlingTimeWaiting|concurrentQuery)"\s*:\s*(?:"((?:[^"\\]|\\.)*)"|([^,}\s]+))')
+TIMESTAMP_PATTERN = re.compile(rb'"Log_DateTime"\s*:\s*"([^"]+)"')
+# Rotated logs carry the rotation time after .log-, e.g. query.log-20240102.gz or query.log-2024010215.gz
+ROTATION_PATTERN = re.compile(r'\.log-([0-9][0-9_T-]*)')
+# m2mThresholdFlag is logged inside an escaped JSON string, so match it with or without the escaping
+M2M_FLAG_PATTERN = re.compile(r'm2mThresholdFlag\\*"\s*:\s*\\*"?(\d+)')
+
+def parse_timestamp(timestamp_str):
+    if timestamp_str[-1:] == 'Z':
+        return datetime.fromisoformat(timestamp_str[:-1])
+    return datetime.fromisoformat(timestamp_str.replace('Z', '')).replace(tzinfo=None) #fromisoformat was introduced in Python 3.7, and will cause issues in old clients
 
 def parse_log_line(line):
-    pattern = r'"([^"]+)"\s*:\s*(?:"([^"]+)"|(\b\d+\b))'
-    matches = re.findall(pattern, line)
-    result = {}
-    for key, str_val, num_val in matches:
-        result[key] = str_val if str_val else num_val
-    return result
-
-def process_log_line_for_m2m(entry):
-    m2m_flag = entry.get('m2mThresholdFlag\\', '').replace('\\', '').replace("'", "")
-    if m2m_flag == '1':
-        cube_name = entry.get('cubeName', 'No CubeName').strip("\\").strip("'").strip('"')
-        dashboard = entry.get('dashboard', 'No Dashboard').strip("\\").strip("'").strip('"')
-        widget = entry.get('widget', 'No Widget').strip("\\").strip("'").strip('"')
-        widgetType = entry.get('widgetType', 'No Widget').strip("\\").strip("'").strip('"')
-
-        # Increment the count for the dashboard/widget combination
-        m2m_threshold_entries[(dashboard, widget, widgetType)].update([cube_name])
-
-def is_valid_duration(entry):
     try:
-        float_duration = float(entry.get('duration', '0').replace('"', ''))
-        return float_duration > slow_query_threshold
+        fields = json_loads(line)
+        if isinstance(fields, dict):
+            return fields
     except ValueError:
-        return False
+        pass
+    return {key: str_val.replace('\\"', '"') if num_val == '' else num_val for key, str_val, num_val in FIELD_PATTERN.findall(line)}
+
+def _number(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+def parse_finish_query(line, fields=None):
+    """
+    Parse a FinishQuery line into a FinishQuery record, or None if it has no usable timestamp or duration.
+    fields is parse_log_line(line) when the caller already has it.
+    """
+    if fields is None:
+        fields = parse_log_line(line)
+    get = fields.get
+    try:
+        timestamp = parse_timestamp(fields['Log_DateTime'])
+        duration = float(get('duration', 0))
+    except (KeyError, TypeError, ValueError):
+        return None
+    m2m_index = line.find('m2mThresholdFlag')
+    m2m_match = M2M_FLAG_PATTERN.match(line, m2m_index) if m2m_index >= 0 else None
+    return _new_finish_query(FinishQuery, (
+        timestamp,
+        get('cubeName'),
+        get('dashboard'),
+        get('widget'),
+        get('widgetType'),
+        get('querySource'),
+        duration,
+        _number(get('translationDuration')),
+        _number(get('dataSourceExecuteDuration')),
+        _number(get('throttlingTimeWaiting')),
+        int(_number(get('concurrentQuery'), 0)),
+        m2m_match is not None and m2m_match.group(1) == '1',
+    ))
+
+class DDSketch:
+    """
+    Mergeable quantile sketch (DDSketch) over durations. Values are counted in logarithmic buckets, so
+    any quantile is within sketch_relative_accuracy of the true value and memory is bounded by
+    sketch_max_buckets no matter how many values are added. Count, sum, min and max are exact.
+    """
+    __slots__ = ('buckets', 'zero_count', 'count', 'total', 'min', 'max')
+    gamma = (1 + sketch_relative_accuracy) / (1 - sketch_relative_accuracy)
+    gamma_log = log(gamma)
+
+    def __init__(self):
+        self.buckets = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def __getstate__(self):
+        return (self.buckets, self.zero_count, self.count, self.total, self.min, self.max)
+
+    def __setstate__(self, state):
+        self.buckets, self.zero_count, self.count, self.total, self.min, self.max = state
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = ceil(log(value) / self.gamma_log)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        if len(self.buckets) > sketch_max_buckets:
+            self._collapse()
+
+    def _collapse(self):
+        # Fold the smallest buckets together, keeping the accuracy guarantee for the upper percentiles
+        keys = sorted(self.buckets)
+        target = keys[len(keys) - sketch_max_buckets]
+        for key in keys[:len(keys) - sketch_max_buckets]:
+            self.buckets[target] += self.buckets.pop(key)
+
+    def merge(self, other):
+        if not other.count:
+            return self
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        if len(self.buckets) > sketch_max_buckets:
+            self._collapse()
+        return self
+
+    def quantiles(self, fractions):
+        """
+        Estimate several quantiles with a single pass over the buckets, fractions must be ascending.
+        """
+        results = []
+        if not self.count:
+            return [0] * len(fractions)
+        ranks = [fraction * (self.count - 1) for fraction in fractions]
+        seen = self.zero_count
+        index = 0
+        while index < len(ranks) and ranks[index] < seen:
+            results.append(0.0)
+            index += 1
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            value = min(max(2 * exp(key * self.gamma_log) / (self.gamma + 1), self.min), self.max)
+            while index < len(ranks) and ranks[index] < seen:
+                results.append(value)
+                index += 1
+        results.extend([self.max] * (len(ranks) - index))
+        return results
+
+class SpaceSaving:
+    """
+    Mergeable top-k counter (Space-Saving) holding at most capacity keys. A key that isn't tracked
+    takes over the slot of the smallest count and inherits it as its error, so every reported count
+    is an overestimate by at most its error, which is at most total / capacity, and any key counted
+    more than total / capacity times is guaranteed to be tracked. Each key also keeps a label, such
+    as the widget type, from the last time it was added.
+    """
+    __slots__ = ('capacity', 'counts', 'errors', 'labels', 'heap', 'total')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.labels = {}
+        # One (count, key) entry per tracked key, the count may lag behind and is refreshed lazily
+        self.heap = []
+        self.total = 0
+
+    def __getstate__(self):
+        return (self.capacity, self.counts, self.errors, self.labels, self.heap, self.total)
+
+    def __setstate__(self, state):
+        self.capacity, self.counts, self.errors, self.labels, self.heap, self.total = state
 
-def calculate_stats(entries):
-    durations = [float(entry['duration']) for entry in entries]
-    count = len(entries)
-    sorted_durations = sorted(durations)
+    def _smallest(self):
+        counts = self.counts
+        while True:
+            count, key = self.heap[0]
+            if counts[key] == count:
+                return count, key
+            heapq.heapreplace(self.heap, (counts[key], key))
+
+    def add(self, key, count=1, label=None):
+        """
+        Count key, returning the key it evicted to make room or None.
+        """
+        self.total += count
+        counts = self.counts
+        evicted = None
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self.capacity:
+            counts[key] = count
+            self.errors[key] = 0
+            heapq.heappush(self.heap, (count, key))
+        else:
+            smallest, evicted = self._smallest()
+            del counts[evicted], self.errors[evicted], self.labels[evicted]
+            counts[key] = smallest + count
+            self.errors[key] = smallest
+            heapq.heapreplace(self.heap, (smallest + count, key))
+        self.labels[key] = label
+        return evicted
+
+    def minimum(self):
+        return self._smallest()[0] if len(self.counts) >= self.capacity else 0
+
+    def merge(self, other):
+        """
+        Combine with another summary. A key missing from a full summary may have been counted up to
+        that summary's smallest count, which is added to its count and its error.
+        """
+        own_minimum, other_minimum = self.minimum(), other.minimum()
+        counts, errors = {}, {}
+        for key in self.counts.keys() | other.counts.keys():
+            counts[key] = self.counts.get(key, own_minimum) + other.counts.get(key, other_minimum)
+            errors[key] = self.errors.get(key, own_minimum) + other.errors.get(key, other_minimum)
+        kept = sorted(counts, key=lambda key: (-counts[key], key))[:self.capacity]
+        labels = {key: other.labels[key] if key in other.labels else self.labels[key] for key in kept}
+        self.counts = {key: counts[key] for key in kept}
+        self.errors = {key: errors[key] for key in kept}
+        self.labels = labels
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+        self.total += other.total
+        return self
+
+    def top(self, n=None):
+        """
+        The n largest (key, count, error, label), largest first.
+        """
+        keys = sorted(self.counts, key=lambda key: (-self.counts[key], key))[:n]
+        return [(key, self.counts[key], self.errors[key], self.labels[key]) for key in keys]
+
+class TopValues:
+    """
+    A value per key, such as a latency sketch per widget, kept only for the keys a SpaceSaving summary
+    of the same keys tracks, so at most capacity values. A key that takes over an evicted key's slot
+    starts from a new value, so its value misses at most its SpaceSaving error of updates.
+    factory makes a new value and merge_value(value, other) folds another value into one.
+    """
+    __slots__ = ('hitters', 'values', 'factory', 'merge_value')
+
+    def __init__(self, capacity, factory, merge_value):
+        self.hitters = SpaceSaving(capacity)
+        self.values = {}
+        self.factory = factory
+        self.merge_value = merge_value
+
+    def __getstate__(self):
+        return (self.hitters, self.values, self.factory, self.merge_value)
+
+    def __setstate__(self, state):
+        self.hitters, self.values, self.factory, self.merge_value = state
+
+    def track(self, key, count=1):
+        """
+        Count key and return its value to update.
+        """
+        evicted = self.hitters.add(key, count)
+        if evicted is not None:
+            del self.values[evicted]
+        value = self.values.get(key)
+        if value is None:
+            value = self.values[key] = self.factory()
+        return value
+
+    def items(self):
+        return self.values.items()
+
+    def merge(self, other):
+        for key, value in other.values.items():
+            self.merge_value(self.track(key, other.hitters.counts[key]), value)
+        return self
+
+def calculate_stats(sketch):
     stats = {
-        'count': count,
-        'average_duration': sum(sorted_durations) / count if count else 0,
-        'max_duration': max(sorted_durations) if sorted_durations else 0,
-        'max_concurrent_query': max(int(entry['concurrentQuery']) for entry in entries) if entries else 0
+        'count': sketch.count,
+        'average_duration': sketch.total / sketch.count if sketch.count else 0,
+        'max_duration': sketch.max or 0,
     }
-    if count >= 2:
-        stats['p50_duration'] = sorted_durations[int(count * 0.5)]
-        p95_index = ceil(count * 0.95) - 1
-        stats['p95_duration'] = sorted_durations[p95_index]
+    if sketch.count >= 2:
+        stats['p50_duration'], stats['p90_duration'], stats['p95_duration'], stats['p99_duration'] = sketch.quantiles([0.5, 0.9, 0.95, 0.99])
     return stats
 
-def parse_timestamp(timestamp_str):
-    return datetime.fromisoformat(timestamp_str.replace('Z', '')).replace(tzinfo=None) #fromisoformat was introduced in Python 3.7, and will cause issues in old clients
+class QueryAggregates:
+    """
+    Everything the report needs from a set of log lines. Partial aggregates built from
+    separate files or chunks can be combined with merge() in file order.
+
+    With top_k, nothing grows with the number of dashboards, widgets or minutes: slow widgets per cube,
+    M2M combinations and minutes with slow queries are counted in SpaceSaving summaries, and the
+    dashboard and widget latency sketches and the per-dashboard maximums are TopValues. Only the
+    state kept per cube still grows, with the number of cubes.
+    """
+    def __init__(self, top_k=None):
+        self.top_k = top_k
+        self.slow_durations = defaultdict(DDSketch)
+        self.max_concurrent_query = Counter()
+        self.cube_latency = defaultdict(DDSketch)
+        self.dashboard_widget_count = defaultdict(_widget_counter)
+        self.m2m_threshold_entries = defaultdict(Counter)
+        self.widget_types = defaultdict(_widget_type_map)
+        self.query_sources = defaultdict(str)
+        self.earliest_timestamp = None
+        self.latest_timestamp = None
+        self.total_slow_queries = 0
+        self.total_queries = 0
+        self.total_duration = 0
+        if top_k:
+            capacity = max(heavy_hitter_capacity, top_k)
+            self.dashboard_latency = TopValues(capacity, DDSketch, DDSketch.merge) # (cube, dashboard): sketch
+            self.widget_latency = TopValues(capacity, DDSketch, DDSketch.merge) # (cube, dashboard, widget): sketch
+            self.max_values = TopValues(capacity, _max_value_record, _merge_max_values) # (cube, dashboard): maximums
+            self.timestamp_count = SpaceSaving(capacity)
+            # Used instead of the unbounded dashboard_widget_count, widget_types and m2m_threshold_entries
+            self.widget_hitters = defaultdict(partial(SpaceSaving, capacity))
+            self.m2m_hitters = SpaceSaving(capacity)
+        else:
+            self.dashboard_latency = defaultdict(DDSketch)
+            self.widget_latency = defaultdict(DDSketch)
+            self.max_values = defaultdict(_max_value_map)
+            self.timestamp_count = Counter()
+            self.widget_hitters = None
+            self.m2m_hitters = None
 
-def update_max_values(cube_name, dashboard, entry):
-    max_vals = max_values[cube_name][dashboard]
-    max_vals['translationDuration'] = max(max_vals['translationDuration'], float(entry.get('translationDuration', 0)))
-    max_vals['dataSourceExecuteDuration'] = max(max_vals['dataSourceExecuteDuration'], float(entry.get('dataSourceExecuteDuration', 0)))
-    max_vals['throttlingTimeWaiting'] = max(max_vals['throttlingTimeWaiting'], float(entry.get('throttlingTimeWaiting', 0)))
+    def add_m2m(self, key, cube_name, count=1):
+        if self.m2m_hitters is not None:
+            self.m2m_hitters.add(key + (cube_name,), count)
+        else:
+            self.m2m_threshold_entries[key][cube_name] += count
 
-def process_slow_query(entry, timestamp):
-    global total_slow_queries
+    def process_log_line_for_m2m(self, record):
+        if record.m2m_flag:
+            cube_name = record.cube_name or 'No CubeName'
+            dashboard = record.dashboard or 'No Dashboard'
+            widget = record.widget or 'No Widget'
+            widgetType = record.widget_type or 'No Widget'
+
+            # Increment the count for the dashboard/widget combination
+            self.add_m2m((dashboard, widget, widgetType), cube_name)
+
+    def update_max_values(self, cube_name, dashboard, record):
+        max_vals = self.max_values.track((cube_name, dashboard)) if self.top_k else self.max_values[cube_name][dashboard]
+        max_vals['translationDuration'] = max(max_vals['translationDuration'], record.translation_duration)
+        max_vals['dataSourceExecuteDuration'] = max(max_vals['dataSourceExecuteDuration'], record.data_source_execute_duration)
+        max_vals['throttlingTimeWaiting'] = max(max_vals['throttlingTimeWaiting'], record.throttling_time_waiting)
+
+    def process_slow_query(self, record):
+        if record.duration > slow_query_threshold and record.cube_name is not None:
+            cube_name = record.cube_name
+            dashboard = record.dashboard or 'No Dashboard'
+            widget = record.widget or 'No Widget'
+            self.slow_durations[cube_name].add(record.duration)
+            self.max_concurrent_query[cube_name] = max(self.max_concurrent_query[cube_name], record.concurrent_query)
+            if self.widget_hitters is not None:
+                self.widget_hitters[cube_name].add((dashboard, widget), 1, record.widget_type or 'No WidgetType')
+            else:
+                self.dashboard_widget_count[cube_name][dashboard][widget] += 1
+                self.widget_types[cube_name][dashboard][widget] = record.widget_type or 'No WidgetType'
+            self.query_sources[cube_name] = record.query_source or 'No QuerySource'
+            if self.top_k:
+                self.timestamp_count.add(record.timestamp.strftime('%Y-%m-%d %H:%M'))
+            else:
+                self.timestamp_count[record.timestamp.strftime('%Y-%m-%d %H:%M')] += 1
+            self.total_slow_queries += 1
+            self.update_max_values(cube_name, dashboard, record)
+
+    def update_timestamp_range(self, timestamp):
+        if self.earliest_timestamp is None or timestamp < self.earliest_timestamp:
+            self.earliest_timestamp = timestamp
+        if self.latest_timestamp is None or timestamp > self.latest_timestamp:
+            self.latest_timestamp = timestamp
+
+    def process_latency(self, record):
+        cube_name = record.cube_name or 'No CubeName'
+        dashboard = record.dashboard or 'No Dashboard'
+        widget_key = (cube_name, dashboard, record.widget or 'No Widget')
+        self.cube_latency[cube_name].add(record.duration)
+        if self.top_k:
+            self.dashboard_latency.track((cube_name, dashboard)).add(record.duration)
+            self.widget_latency.track(widget_key).add(record.duration)
+        else:
+            self.dashboard_latency[(cube_name, dashboard)].add(record.duration)
+            self.widget_latency[widget_key].add(record.duration)
+
+    def add_latency_sketches(self, name, sketches):
+        """
+        Merge {key: sketch} into the dashboard_latency or widget_latency sketches.
+        """
+        own = getattr(self, name)
+        for key, sketch in sketches.items():
+            (own.track(key, sketch.count) if self.top_k else own[key]).merge(sketch)
+
+    def process_record(self, record):
+        self.total_queries += 1
+        self.total_duration += record.duration
+        self.update_timestamp_range(record.timestamp)
+        self.process_log_line_for_m2m(record)
+        self.process_latency(record)
+
+        if record.duration > slow_query_threshold:
+            self.process_slow_query(record)
+
+    def merge(self, other):
+        if (self.m2m_hitters is None) != (other.m2m_hitters is None):
+            raise ValueError("Aggregates counted with --top-k can only be merged with others counted with --top-k")
+        if self.m2m_hitters is not None:
+            self.m2m_hitters.merge(other.m2m_hitters)
+            for cube_name, hitters in other.widget_hitters.items():
+                self.widget_hitters[cube_name].merge(hitters)
+            for name in ('dashboard_latency', 'widget_latency', 'max_values', 'timestamp_count'):
+                getattr(self, name).merge(getattr(other, name))
+        else:
+            self.add_latency_sketches('dashboard_latency', other.dashboard_latency)
+            self.add_latency_sketches('widget_latency', other.widget_latency)
+            self.timestamp_count.update(other.timestamp_count)
+            for cube_name, dashboards in other.max_values.items():
+                for dashboard, other_vals in dashboards.items():
+                    _merge_max_values(self.max_values[cube_name][dashboard], other_vals)
+        for name in ('slow_durations', 'cube_latency'):
+            sketches = getattr(self, name)
+            for key, sketch in getattr(other, name).items():
+                sketches[key].merge(sketch)
+        for cube_name, concurrent_query in other.max_concurrent_query.items():
+            self.max_concurrent_query[cube_name] = max(self.max_concurrent_query[cube_name], concurrent_query)
+        for cube_name, dashboards in other.dashboard_widget_count.items():
+            for dashboard, widgets in dashboards.items():
+                self.dashboard_widget_count[cube_name][dashboard].update(widgets)
+        for key, cube_names in other.m2m_threshold_entries.items():
+            self.m2m_threshold_entries[key].update(cube_names)
+        for cube_name, dashboards in other.widget_types.items():
+            for dashboard, widgets in dashboards.items():
+                self.widget_types[cube_name][dashboard].update(widgets)
+        self.query_sources.update(other.query_sources)
+        for timestamp in (other.earliest_timestamp, other.latest_timestamp):
+            if timestamp is not None:
+                self.update_timestamp_range(timestamp)
+        self.total_slow_queries += other.total_slow_queries
+        self.total_queries += other.total_queries
+        self.total_duration += other.total_duration
+        return self
+
+    def dashboard_max_values(self, cube_name, dashboard):
+        if self.top_k:
+            return self.max_values.values.get((cube_name, dashboard)) or _max_value_record()
+        return self.max_values[cube_name][dashboard]
+
+    def slow_minutes(self):
+        """
+        [(minute, slow queries, error)] in time order, with top_k only the top_k busiest minutes.
+        """
+        if self.top_k:
+            return sorted((minute, count, error) for minute, count, error, label in self.timestamp_count.top(self.top_k))
+        return sorted((minute, count, 0) for minute, count in self.timestamp_count.items())
+
+def file_identity(stat):
+    return [stat.st_ino, stat.st_size, stat.st_mtime]
+
+def load_timestamp_index():
     try:
-        duration = float(entry.get('duration', 0))
-    except ValueError:
-        print(f"Warning: Invalid duration value '{entry.get('duration')}' in entry: {entry}")
-        return 
-
-    if duration > slow_query_threshold:
-        cube_name = entry['cubeName']
-        dashboard = entry.get('dashboard', 'No Dashboard')
-        data[cube_name].append(entry)
-        widgetType = entry.get('widgetType', 'No WidgetType').strip("\\").strip("'").strip('"')
-        querySource = entry.get('querySource', 'No QuerySource').strip("\\").strip("'").strip('"')
-        dashboard_widget_count[cube_name][dashboard][entry.get('widget', 'No Widget')] += 1
-        widget_types[cube_name][dashboard][entry.get('widget', 'No Widget')] = widgetType
-        query_sources[cube_name] = querySource
-        timestamp_count[timestamp.strftime('%Y-%m-%d %H:%M')] += 1
-        total_slow_queries += 1
-        update_max_values(cube_name, dashboard, entry)
-
-def update_timestamp_range(timestamp):
-    global earliest_timestamp, latest_timestamp
-    if earliest_timestamp is None or timestamp < earliest_timestamp:
-        earliest_timestamp = timestamp
-    if latest_timestamp is None or timestamp > latest_timestamp:
-        latest_timestamp = timestamp
-
-# Loop to parse the logs
-for log_file in log_files:
-    with (gzip.open if log_file.endswith('.gz') else open)(log_file, 'rt') as file:
-        for line in file:
-            if '"Log_Message":"FinishQuery"' in line:
-                try:
-                    entry = parse_log_line(line)
-                    timestamp = parse_timestamp(entry['Log_DateTime'])
-                    if timestamp >= earliest_date:
-                        duration_str = entry.get('duration', '0')
-                        try:
-                            duration = float(duration_str)
-                        except ValueError:
-                            continue
-
-                        total_queries += 1
-                        total_duration += duration
-                        update_timestamp_range(timestamp)
-                        process_log_line_for_m2m(entry)
-
-                        if duration > slow_query_threshold:
-                            process_slow_query(entry, timestamp)
-
-                except KeyError as e:
+        with open(os.path.join(state_directory, 'timestamp_index.json')) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_timestamp_index(index):
+    os.makedirs(state_directory, exist_ok=True)
+    with open(os.path.join(state_directory, 'timestamp_index.json'), 'w') as file:
+        json.dump(index, file)
+
+def rotation_time(log_file):
+    """
+    Latest time a rotated log can contain, taken from the timestamp logrotate put in its name.
+    Date-only names cover the whole day. Returns None when the name has no usable timestamp.
+    """
+    match = ROTATION_PATTERN.search(os.path.basename(log_file))
+    if not match:
+        return None
+    digits = re.sub(r'\D', '', match.group(1))
+    if len(digits) == 10 and digits.startswith('1'):
+        return datetime.fromtimestamp(int(digits), timezone.utc).replace(tzinfo=None)
+    for length, date_format, covers in ((14, '%Y%m%d%H%M%S', timedelta(seconds=1)), (12, '%Y%m%d%H%M', timedelta(minutes=1)),
+                                        (10, '%Y%m%d%H', timedelta(hours=1)), (8, '%Y%m%d', timedelta(days=1))):
+        if len(digits) >= length:
+            try:
+                rotated = datetime.strptime(digits[:length], date_format) + covers
+            except ValueError:
+                continue
+            # Rotation names are in local time, log timestamps are compared as UTC
+            return rotated.astimezone(timezone.utc).replace(tzinfo=None)
+    return None
+
+def file_may_overlap(log_file, earliest_date, index):
+    """
+    Decide from the file mtime, the rotation timestamp in its name and the cached timestamp index
+    whether a log file can contain any entry inside the window.
+    """
+    stat = os.stat(log_file)
+    if datetime.fromtimestamp(stat.st_mtime, timezone.utc).replace(tzinfo=None) < earliest_date:
+        return False
+    rotated = rotation_time(log_file)
+    if rotated is not None and rotated < earliest_date:
+        return False
+    cached = index.get(log_file)
+    if cached and cached['identity'] == file_identity(stat) and cached['last'] and parse_timestamp(cached['last']) < earliest_date:
+        return False
+    return True
+
+def _first_timestamp_after(file, offset, end):
+    file.seek(offset - 1 if offset else 0)
+    if offset:
+        file.readline()
+    while file.tell() < end:
+        line = file.readline()
+        if not line:
+            break
+        match = TIMESTAMP_PATTERN.search(line)
+        if match:
+            try:
+                return parse_timestamp(match.group(1).decode('utf-8', 'replace'))
+            except ValueError:
+                continue
+    return None
+
+def find_window_start(log_file, earliest_date):
+    """
+    Binary search the live log for a byte offset just before the first line inside the window.
+    Lines are appended in time order, so everything before the returned offset is older than the window.
+    """
+    with open(log_file, 'rb') as file:
+        low, high = 0, os.fstat(file.fileno()).st_size
+        while high - low > search_margin:
+            mid = (low + high) // 2
+            timestamp = _first_timestamp_after(file, mid, high)
+            if timestamp is None or timestamp >= earliest_date:
+                high = mid
+            else:
+                low = mid
+    return low
+
+def plan_work_units(log_files, start_offsets=None, end_offsets=None):
+    """
+    Split the log files into (path, start, end) byte ranges. Gzip files can't be seeked so they
+    are always a single unit, large plain logs are split into chunk_size pieces.
+    """
+    start_offsets = start_offsets or {}
+    end_offsets = end_offsets or {}
+    units = []
+    for log_file in log_files:
+        start = start_offsets.get(log_file, 0)
+        if log_file.endswith('.gz'):
+            units.append((log_file, start, None))
+            continue
+        size = end_offsets.get(log_file, os.path.getsize(log_file))
+        if log_file not in end_offsets and size - start <= chunk_size:
+            units.append((log_file, start, None))
+        else:
+            for chunk_start in range(start, size, chunk_size):
+                units.append((log_file, chunk_start, min(chunk_start + chunk_size, size)))
+    return units
+
+GZIP_BACKENDS = ('isal', 'zlib-ng', 'pigz', 'zcat', 'gzip')
+
+def available_gzip_backends():
+    return [backend for backend in GZIP_BACKENDS if
+            (backend == 'isal' and igzip is not None) or (backend == 'zlib-ng' and gzip_ng is not None) or
+            (backend in ('pigz', 'zcat') and shutil.which(backend)) or backend == 'gzip']
+
+def open_decompressed(log_file, backend=None):
+    """
+    Open a gzip log for binary reads with the requested backend, returning the stream and the
+    decompressor process when the backend is a pigz or zcat pipe.
+    """
+    backend = backend or gzip_backend
+    if backend == 'auto':
+        # zcat is usually slower than zlib in-process, pigz at least decompresses on another core
+        backend = next(backend for backend in available_gzip_backends() if backend != 'zcat')
+    if backend == 'isal':
+        return igzip.open(log_file, 'rb'), None
+    if backend == 'zlib-ng':
+        return gzip_ng.open(log_file, 'rb'), None
+    if backend in ('pigz', 'zcat'):
+        process = subprocess.Popen([backend, '-dc', log_file], stdout=subprocess.PIPE, bufsize=read_block_size)
+        return process.stdout, process
+    return gzip.open(log_file, 'rb'), None
+
+def _marked_lines(read, limit=None, finish_line=None):
+    """
+    Read blocks until EOF or limit bytes and yield only the lines containing the FinishQuery marker,
+    found with bytes.find so the other lines are never split out or decoded. finish_line completes
+    a line that runs past limit.
+    """
+    pending = b''
+    while limit is None or limit > 0:
+        block = read(read_block_size if limit is None else min(read_block_size, limit))
+        if not block:
+            break
+        if limit is not None:
+            limit -= len(block)
+        cut = block.rfind(b'\n') + 1
+        if not cut:
+            pending += block
+            continue
+        chunk = pending + block[:cut] if pending else block[:cut]
+        pending = block[cut:]
+        marked = chunk.count(FINISH_QUERY_MARKER_BYTES)
+        if marked * 4 > chunk.count(b'\n'):
+            # Mostly FinishQuery lines, so decoding and splitting the whole chunk at once is cheaper
+            for line in chunk.decode('utf-8', 'replace').split('\n'):
+                if FINISH_QUERY_MARKER in line:
+                    yield line
+            continue
+        position = chunk.find(FINISH_QUERY_MARKER_BYTES) if marked else -1
+        while position >= 0:
+            line_start = chunk.rfind(b'\n', 0, position) + 1
+            line_end = chunk.find(b'\n', position)
+            yield chunk[line_start:line_end].decode('utf-8', 'replace')
+            position = chunk.find(FINISH_QUERY_MARKER_BYTES, line_end)
+    if pending and limit is not None and finish_line is not None:
+        pending += finish_line()
+    if FINISH_QUERY_MARKER_BYTES in pending:
+        yield pending.rstrip(b'\n').decode('utf-8', 'replace')
+
+def read_finish_query_lines(log_file, start=0, end=None, backend=None):
+    if log_file.endswith('.gz'):
+        stream, process = open_decompressed(log_file, backend)
+        try:
+            # Resuming a rotated log from a checkpoint, the offset always sits just after a newline
+            skip = start
+            while skip > 0:
+                skipped = len(stream.read(min(read_block_size, skip)))
+                if not skipped:
+                    break
+                skip -= skipped
+            yield from _marked_lines(_reader(stream.read, log_file))
+        finally:
+            stream.close()
+            if process is not None:
+                process.kill()
+                if process.wait() not in (0, -9, -13):
+                    print(f"Warning: {process.args[0]} exited with code {process.returncode} reading {log_file}")
+        return
+
+    with open(log_file, 'rb') as file:
+        # A line belongs to the chunk it starts in, so skip the partial line the previous chunk owns
+        if start:
+            file.seek(start - 1)
+            file.readline()
+        limit = None if end is None else max(0, end - file.tell())
+        yield from _marked_lines(_reader(file.read, log_file), limit, file.readline)
+
+def _use_gzip_backend(backend):
+    global gzip_backend
+    gzip_backend = backend
+
+def worker_pool(workers):
+    """
+    A process pool whose workers decompress with this process's gzip_backend. Only forked workers
+    would inherit it, spawned ones import the module afresh.
+    """
+    return ProcessPoolExecutor(max_workers=workers, initializer=_use_gzip_backend, initargs=(gzip_backend,))
+
+def benchmark_gzip_backends(log_files):
+    """
+    Time every available backend reading the rotated logs through read_finish_query_lines.
+    """
+    gz_files = [log_file for log_file in log_files if log_file.endswith('.gz')]
+    compressed_mb = sum(os.path.getsize(log_file) for log_file in gz_files) / (1024 * 1024)
+    print(f"\nDecompressing {len(gz_files)} rotated logs ({compressed_mb:.1f} MB compressed):")
+    for backend in available_gzip_backends():
+        start = time.perf_counter()
+        lines = sum(1 for log_file in gz_files for line in read_finish_query_lines(log_file, backend=backend))
+        elapsed = time.perf_counter() - start
+        print(f"  {backend}: {elapsed:.2f}s, {compressed_mb / elapsed:.1f} MB/s compressed, {lines / elapsed:,.0f} FinishQuery lines/s")
+
+class PhaseProfile:
+    """
+    Wall and CPU time per phase for --profile. Reads are timed block by block and the per-line phases
+    on every profile_sample_every'th FinishQuery line, scaled up to all of them, so profiling costs a
+    few percent. Profiles of work units parsed in a pool are merged like their aggregates.
+    """
+    LINE_PHASES = ('JSON decode', 'parse_timestamp', 'other fields')
+
+    def __init__(self):
+        self.wall = Counter()
+        self.cpu = Counter()
+        self.sampled = Counter()
+        self.counted = Counter()
+        self.files = {} # log_file: [bytes, lines, FinishQuery lines, wall seconds]
+        self.countdown = profile_sample_every // 2 # FinishQuery lines until the next sample
+        self.sampling = False # Whether the line parse() last saw is a sample
+        # What reading the CPU clock itself costs, it is taken off every sampled interval
+        clock = time.process_time
+        start = clock()
+        for _ in range(100):
+            clock()
+        self.clock_cost = (clock() - start) / 101
+
+    def file_stats(self, log_file):
+        return self.files.setdefault(log_file, [0, 0, 0, 0.0])
+
+    def add(self, phase, wall, cpu):
+        self.wall[phase] += wall
+        self.cpu[phase] += cpu
+
+    def timed_read(self, read, log_file):
+        stats = self.file_stats(log_file)
+        def timed(size=-1):
+            wall, cpu = time.perf_counter(), time.process_time()
+            block = read(size)
+            self.add('read and decompress', time.perf_counter() - wall, time.process_time() - cpu)
+            stats[0] += len(block)
+            stats[1] += block.count(b'\n')
+            return block
+        return timed
+
+    def parse_sampled(self, line):
+        """
+        parse_finish_query(line), also timing the JSON decode and parse_timestamp it is made of. Samples
+        are timed in CPU time only, a sample that happens to be preempted would be scaled up too.
+        """
+        clock = time.process_time
+        start = clock()
+        fields = parse_log_line(line)
+        decoded = clock()
+        try:
+            parse_timestamp(fields['Log_DateTime'])
+        except (KeyError, TypeError, ValueError):
+            pass
+        timestamp_parsed = clock()
+        record = parse_finish_query(line, fields)
+        # parse_finish_query parses the timestamp again
+        self.cpu['JSON decode'] += max(decoded - start - self.clock_cost, 0)
+        self.cpu['parse_timestamp'] += max(timestamp_parsed - decoded - self.clock_cost, 0)
+        self.cpu['other fields'] += max((clock() - timestamp_parsed) - (timestamp_parsed - decoded), 0)
+        self.sampled['parse'] += 1
+        return record
+
+    def aggregate_sampled(self, aggregates, record):
+        start = time.process_time()
+        aggregates.process_record(record)
+        self.cpu['aggregation'] += max(time.process_time() - start - self.clock_cost, 0)
+        self.sampled['aggregation'] += 1
+
+    def parse(self, line):
+        """
+        The parse hook of process_work_unit, timing every profile_sample_every'th line.
+        """
+        self.counted['parse'] += 1
+        self.countdown -= 1
+        self.sampling = not self.countdown
+        if not self.sampling:
+            return parse_finish_query(line)
+        self.countdown = profile_sample_every
+        return self.parse_sampled(line)
+
+    def aggregate(self, aggregates, record):
+        """
+        The aggregation hook of process_work_unit, timing the record when its line was sampled.
+        """
+        self.counted['aggregation'] += 1
+        if self.sampling:
+            self.aggregate_sampled(aggregates, record)
+        else:
+            aggregates.process_record(record)
+
+    def merge(self, other):
+        for name in ('wall', 'cpu', 'sampled', 'counted'):
+            getattr(self, name).update(getattr(other, name))
+        for log_file, stats in other.files.items():
+            own = self.file_stats(log_file)
+            for position, value in enumerate(stats):
+                own[position] += value
+        return self
+
+    def phases(self):
+        """
+        (phase, wall, cpu, lines) with the sampled CPU times scaled up. Finding the FinishQuery lines gets
+        the CPU time of the work units not accounted for by another phase, and the wall time the units
+        spent outside reads is split between the phases by their share of that CPU time.
+        """
+        lines = sum(stats[1] for stats in self.files.values())
+        phases = []
+        for phase, group in [(phase, 'parse') for phase in self.LINE_PHASES] + [('aggregation', 'aggregation')]:
+            scale = self.counted[group] / self.sampled[group] if self.sampled[group] else 0
+            phases.append((phase, max(self.cpu[phase] * scale, 0), self.counted[group]))
+        find_cpu = max(self.cpu['work units'] - self.cpu['read and decompress'] - sum(cpu for phase, cpu, count in phases), 0)
+        phases.insert(0, ('find FinishQuery lines', find_cpu, lines))
+        unit_cpu = sum(cpu for phase, cpu, count in phases)
+        rest_wall = max(self.wall['work units'] - self.wall['read and decompress'], 0)
+        return ([('read and decompress', self.wall['read and decompress'], self.cpu['read and decompress'], lines)] +
+                [(phase, rest_wall * cpu / unit_cpu if unit_cpu else 0, cpu, count) for phase, cpu, count in phases] +
+                [('merge', self.wall['merge'], self.cpu['merge'], self.counted['parse'])])
+
+def _reader(read, log_file):
+    return read if active_profile is None else active_profile.timed_read(read, log_file)
+
+def profile_work_unit(unit, earliest_date, aggregates_factory=QueryAggregates):
+    """
+    process_work_unit with --profile timings, returning the unit's PhaseProfile along with its result.
+    """
+    global active_profile
+    outer_profile, active_profile = active_profile, PhaseProfile()
+    profile = active_profile
+    try:
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = process_work_unit(unit, earliest_date, aggregates_factory, profile)
+        elapsed = time.perf_counter() - wall
+        profile.add('work units', elapsed, time.process_time() - cpu)
+        stats = profile.file_stats(unit[0])
+        stats[2] += profile.counted['parse']
+        stats[3] += elapsed
+    finally:
+        active_profile = outer_profile
+    return result, profile
+
+def print_profile(profile, started, times_started):
+    elapsed = time.perf_counter() - started
+    times = os.times()
+    own_cpu = times.user + times.system - times_started.user - times_started.system
+    worker_cpu = times.children_user + times.children_system - times_started.children_user - times_started.children_system
+    total_bytes = sum(stats[0] for stats in profile.files.values())
+    print(f"\nProfile: {elapsed:.2f}s elapsed, {own_cpu:.2f}s CPU in this process, {worker_cpu:.2f}s CPU in worker processes")
+    print(f"Per-line phases are timed on 1 in {profile_sample_every} FinishQuery lines and scaled up; times are summed over work units.")
+    print(f"  {'Phase':<24} {'Wall s':>9} {'CPU s':>9} {'Lines/s':>12} {'MB/s':>9}")
+    for phase, wall, cpu, lines in profile.phases():
+        lines_per_second = f"{lines / wall:,.0f}" if wall else '-'
+        mb_per_second = f"{total_bytes / (1024 * 1024) / wall:.1f}" if wall else '-'
+        print(f"  {phase:<24} {wall:9.3f} {cpu:9.3f} {lines_per_second:>12} {mb_per_second:>9}")
+    print("Per file:")
+    for log_file, (size, lines, finish_queries, wall) in sorted(profile.files.items()):
+        rate = f"{size / (1024 * 1024) / wall:.1f} MB/s, {lines / wall:,.0f} lines/s" if wall else "not timed"
+        print(f"  {log_file}: {size / (1024 * 1024):.1f} MB, {lines} lines, {finish_queries} FinishQuery in {wall:.2f}s ({rate})")
+
+def process_work_unit(unit, earliest_date, aggregates_factory=QueryAggregates, profile=None):
+    """
+    Aggregate one unit, also returning the first and last FinishQuery timestamps seen in it
+    whether or not they fall inside the window. With a PhaseProfile, lines are parsed and
+    aggregated through its hooks so it can time a sample of them.
+    """
+    log_file, start, end = unit
+    aggregates = aggregates_factory()
+    if profile is None:
+        parse, process_record = parse_finish_query, aggregates.process_record
+    else:
+        parse, process_record = profile.parse, partial(profile.aggregate, aggregates)
+    first_timestamp = last_timestamp = None
+    for line in read_finish_query_lines(log_file, start, end):
+        record = parse(line)
+        if record is None:
+            continue
+        if first_timestamp is None or record.timestamp < first_timestamp:
+            first_timestamp = record.timestamp
+        if last_timestamp is None or record.timestamp > last_timestamp:
+            last_timestamp = record.timestamp
+        if record.timestamp >= earliest_date:
+            process_record(record)
+    return aggregates, first_timestamp, last_timestamp
+
+def run_work_units(units, earliest_date, workers=1, aggregates_factory=QueryAggregates):
+    process = process_work_unit if active_profile is None else profile_work_unit
+    if workers > 1 and len(units) > 1:
+        with worker_pool(workers) as pool:
+            results = list(pool.map(process, units, [earliest_date] * len(units), [aggregates_factory] * len(units)))
+    else:
+        results = [process(unit, earliest_date, aggregates_factory) for unit in units]
+    if active_profile is None:
+        return results
+    for result, profile in results:
+        active_profile.merge(profile)
+    return [result for result, profile in results]
+
+def merge_results(aggregates, units, results, index):
+    wall, cpu = time.perf_counter(), time.process_time()
+    for (log_file, start, end), (partial, first_timestamp, last_timestamp) in zip(units, results):
+        aggregates.merge(partial)
+        # Only whole files give a trustworthy first/last timestamp for the index
+        if start == 0 and end is None:
+            index[log_file] = {'identity': file_identity(os.stat(log_file)),
+                               'first': first_timestamp and first_timestamp.isoformat(),
+                               'last': last_timestamp and last_timestamp.isoformat()}
+    save_timestamp_index({log_file: entry for log_file, entry in index.items() if os.path.exists(log_file)})
+    if active_profile is not None:
+        active_profile.add('merge', time.perf_counter() - wall, time.process_time() - cpu)
+    return aggregates
+
+def analyze_logs(log_files, earliest_date, workers=1, aggregates_factory=QueryAggregates):
+    """
+    Parse every log file that can overlap the window and reduce the partial aggregates in file order,
+    so the result is identical whether the units were parsed in this process or in a process pool.
+    """
+    index = load_timestamp_index()
+    log_files = [log_file for log_file in log_files if file_may_overlap(log_file, earliest_date, index)]
+    start_offsets = {log_file: find_window_start(log_file, earliest_date) for log_file in log_files if not log_file.endswith('.gz')}
+    units = plan_work_units(log_files, start_offsets)
+    return merge_results(aggregates_factory(), units, run_work_units(units, earliest_date, workers, aggregates_factory), index)
+
+def head_fingerprint(log_file):
+    """
+    Identify a log by its first complete line. logrotate renames and compresses query.log, so the
+    path and inode change but the first line doesn't. Returns None if there is no complete line yet.
+    """
+    with (gzip.open if log_file.endswith('.gz') else open)(log_file, 'rb') as file:
+        line = file.readline()
+    return hashlib.sha1(line).hexdigest() if line.endswith(b'\n') else None
+
+def complete_size(log_file):
+    """
+    Offset just past the last newline, so a line that is still being written is left for the next run.
+    """
+    with open(log_file, 'rb') as file:
+        position = os.fstat(file.fileno()).st_size
+        while position > 0:
+            block_start = max(0, position - 65536)
+            file.seek(block_start)
+            newline = file.read(position - block_start).rfind(b'\n')
+            if newline >= 0:
+                return block_start + newline + 1
+            position = block_start
+    return 0
+
+CHECKPOINT_VERSION = 2 # Bump whenever QueryAggregates changes shape, older checkpoints are then rebuilt
+
+def checkpoint_path():
+    return os.path.join(state_directory, 'checkpoint.pickle')
+
+def new_checkpoint(earliest_date, top_k=None):
+    return {'version': CHECKPOINT_VERSION, 'since': earliest_date, 'aggregates': QueryAggregates(top_k), 'offsets': {}}
+
+def load_checkpoint(earliest_date, top_k=None):
+    """
+    The saved checkpoint, or a new one starting at earliest_date if there is none or it was written by
+    another version of QueryM2M or with a different --top-k setting.
+    """
+    try:
+        with open(checkpoint_path(), 'rb') as file:
+            checkpoint = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return new_checkpoint(earliest_date, top_k)
+    if not isinstance(checkpoint, dict) or checkpoint.get('version') != CHECKPOINT_VERSION:
+        print("Warning: the checkpoint was written by another version of QueryM2M, starting a new one")
+        return new_checkpoint(earliest_date, top_k)
+    if checkpoint['aggregates'].top_k != top_k:
+        print(f"Warning: the checkpoint was counted with --top-k {checkpoint['aggregates'].top_k}, not {top_k}, starting a new one")
+        return new_checkpoint(earliest_date, top_k)
+    return checkpoint
+
+def save_checkpoint(checkpoint):
+    os.makedirs(state_directory, exist_ok=True)
+    temporary_path = checkpoint_path() + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        pickle.dump(checkpoint, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, checkpoint_path())
+
+def plan_incremental_units(log_files, offsets, earliest_date, index):
+    """
+    Work units covering what was appended or rotated since offsets were recorded, and the offsets to
+    record once they are merged.
+    """
+    pending_files, start_offsets, end_offsets, consumed = [], {}, {}, {}
+    for log_file in log_files:
+        fingerprint = head_fingerprint(log_file)
+        if fingerprint is None or (fingerprint in offsets and offsets[fingerprint] is None):
+            continue
+        offset = offsets.get(fingerprint, 0)
+        if log_file.endswith('.gz'):
+            consumed[fingerprint] = None
+        else:
+            end = complete_size(log_file)
+            if end < offset:
+                offset = 0 # Truncated in place, start over
+            consumed[fingerprint] = end_offsets[log_file] = end
+        if offset == 0:
+            if not file_may_overlap(log_file, earliest_date, index):
+                continue
+            if not log_file.endswith('.gz'):
+                offset = find_window_start(log_file, earliest_date)
+        start_offsets[log_file] = offset
+        pending_files.append(log_file)
+
+    return plan_work_units(pending_files, start_offsets, end_offsets), consumed
+
+def analyze_logs_incremental(log_files, earliest_date, workers=1, top_k=None):
+    """
+    Parse only what was appended or rotated since the last checkpoint and merge it into the saved aggregates.
+    Offsets are keyed by head_fingerprint(), with None marking a rotated log that has been read to the end,
+    so a query.log that was partly read and then rotated to query.log-*.gz resumes where it left off.
+    Returns the aggregates and the start of the window they cover, which the checkpoint keeps from its first run.
+    """
+    checkpoint = load_checkpoint(earliest_date, top_k)
+    offsets = checkpoint['offsets']
+    index = load_timestamp_index()
+    units, consumed = plan_incremental_units(log_files, offsets, earliest_date, index)
+    merge_results(checkpoint['aggregates'], units, run_work_units(units, earliest_date, workers, partial(QueryAggregates, top_k)), index)
+    offsets.update(consumed)
+    save_checkpoint(checkpoint)
+    return checkpoint['aggregates'], checkpoint['since']
+
+# Fields of the slow query list in SlowQuery.sh's order, slow queries are spilled in pickled blocks of SLOW_QUERY_BLOCK
+SLOW_QUERY_FIELDS = ('duration', 'translationDuration', 'dataSourceExecuteDuration', 'concurrentQuery',
+                     'throttlingTimeWaiting', 'widget', 'dashboard', 'cubeName', 'querySource')
+SLOW_QUERY_BLOCK = 1024
+DURATION_BLOCK = 8192 # Durations are read back from their runs this many at a time
+
+def interpolated_percentiles(values, count, percentiles):
+    """
+    Percentiles of count sorted values interpolated between closest ranks, the formula QueryPerformance.sh used.
+    values is a sequence, or an iterator that is only read up to the highest rank needed.
+    """
+    ranks = []
+    for p in percentiles:
+        index = 1 + (count - 1) * p
+        ranks.append((min(int(index), count), index - int(index)))
+    if hasattr(values, '__getitem__'):
+        picked = values
+    else:
+        needed = {whole - 1 for whole, fraction in ranks} | {whole for whole, fraction in ranks if whole < count}
+        last = max(needed)
+        picked = {}
+        for position, value in enumerate(values):
+            if position in needed:
+                picked[position] = value
+                if position == last:
+                    break
+    return [picked[whole - 1] if whole >= count else picked[whole - 1] * (1 - fraction) + picked[whole] * fraction
+            for whole, fraction in ranks]
+
+def sorted_durations(durations):
+    if np is not None:
+        return np.sort(np.frombuffer(durations, dtype=np.float64))
+    return sorted(durations)
+
+def spill_run(records, spill_directory):
+    """
+    Sort slow queries by duration, ties in log order, and write them to a run file as pickled blocks.
+    """
+    records.sort(key=itemgetter(0, 1))
+    descriptor, path = tempfile.mkstemp(suffix='.run', dir=spill_directory)
+    with os.fdopen(descriptor, 'wb') as file:
+        for position in range(0, len(records), SLOW_QUERY_BLOCK):
+            pickle.dump(records[position:position + SLOW_QUERY_BLOCK], file, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+def read_run(path, offset=0):
+    """
+    The slow queries of a run file, with offset added to their sequence numbers.
+    """
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                block = pickle.load(file)
+            except EOFError:
+                return
+            if offset:
+                block = [(record[0], offset + record[1]) + record[2:] for record in block]
+            yield from block
+
+def spill_durations(durations, spill_directory):
+    """
+    Sort durations and write them to a run file as packed doubles.
+    """
+    values = sorted_durations(durations)
+    descriptor, path = tempfile.mkstemp(suffix='.durations', dir=spill_directory)
+    with os.fdopen(descriptor, 'wb') as file:
+        file.write(values.tobytes() if np is not None else array('d', values).tobytes())
+    return path
+
+def read_durations(path):
+    with open(path, 'rb') as file:
+        while True:
+            block = file.read(DURATION_BLOCK * 8)
+            if not block:
+                return
+            yield from array('d', block)
+
+def merge_duration_runs(paths, spill_directory):
+    """
+    Merge duration runs in groups of run_merge_fan_in into longer runs until that few are left,
+    so reading them back never keeps more than run_merge_fan_in files open.
+    """
+    while len(paths) > run_merge_fan_in:
+        merged = []
+        for position in range(0, len(paths), run_merge_fan_in):
+            descriptor, path = tempfile.mkstemp(suffix='.durations', dir=spill_directory)
+            with os.fdopen(descriptor, 'wb') as file:
+                block = array('d')
+                for value in heapq.merge(*map(read_durations, paths[position:position + run_merge_fan_in])):
+                    block.append(value)
+                    if len(block) >= DURATION_BLOCK:
+                        block.tofile(file)
+                        block = array('d')
+                block.tofile(file)
+            merged.append(path)
+        paths = merged
+    return paths
+
+class PerformanceAggregates(QueryAggregates):
+    """
+    QueryAggregates plus what QueryPerformance.sh and SlowQuery.sh reported, so all three reports
+    come from one pass: every duration per cube for exact interpolated percentiles, kept as packed
+    doubles and spilled to spill_directory in sorted runs once duration_run_size are held, and the
+    slow query list. With slow_limit only the slowest slow_limit queries are kept on a heap,
+    otherwise they are sorted in runs spilled to spill_directory too, each run kept with the offset
+    that renumbers its queries' sequence numbers into the merged log order.
+    """
+    def __init__(self, slow_limit=None, spill_directory=None, top_k=None):
+        super().__init__(top_k)
+        self.cube_durations = defaultdict(partial(array, 'd'))
+        self.buffered_durations = 0
+        self.duration_runs = defaultdict(list)
+        self.slow_limit = slow_limit
+        self.spill_directory = spill_directory
+        self.slow_queries = []
+        self.slow_runs = []
+
+    def spill_durations(self):
+        for cube_name, durations in self.cube_durations.items():
+            if durations:
+                self.duration_runs[cube_name].append(spill_durations(durations, self.spill_directory))
+        self.cube_durations.clear()
+        self.buffered_durations = 0
+
+    def add_slow_query(self, record):
+        if self.slow_limit is not None:
+            if len(self.slow_queries) < self.slow_limit:
+                heapq.heappush(self.slow_queries, record)
+            elif record[0] > self.slow_queries[0][0]:
+                heapq.heapreplace(self.slow_queries, record)
+            return
+        self.slow_queries.append(record)
+        if len(self.slow_queries) >= slow_query_run_size:
+            self.slow_runs.append((spill_run(self.slow_queries, self.spill_directory), 0))
+            self.slow_queries = []
+
+    def process_record(self, record):
+        super().process_record(record)
+        self.cube_durations[record.cube_name or 'No CubeName'].append(record.duration)
+        self.buffered_durations += 1
+        if self.buffered_durations >= duration_run_size:
+            self.spill_durations()
+        if record.duration > slow_query_list_threshold:
+            # The sequence number breaks ties on duration in log order and keeps None fields out of comparisons
+            self.add_slow_query((record.duration, self.total_queries, record.translation_duration, record.data_source_execute_duration,
+                                 record.concurrent_query, record.throttling_time_waiting, record.widget, record.dashboard,
+                                 record.cube_name, record.query_source))
+
+    def merge(self, other):
+        # Renumber after the queries merged so far, so ties stay in merge order
+        offset = self.total_queries
+        super().merge(other)
+        for cube_name, durations in other.cube_durations.items():
+            self.cube_durations[cube_name].extend(durations)
+            self.buffered_durations += len(durations)
+        for cube_name, runs in other.duration_runs.items():
+            self.duration_runs[cube_name].extend(runs)
+        if self.buffered_durations >= duration_run_size:
+            self.spill_durations()
+        self.slow_runs.extend((path, offset + run_offset) for path, run_offset in other.slow_runs)
+        for record in other.slow_queries:
+            self.add_slow_query((record[0], offset + record[1]) + record[2:])
+        return self
+
+    def sorted_cube_durations(self, cube_names):
+        """
+        The durations of cube_names in ascending order, an array when none were spilled and otherwise
+        an iterator merging the spilled runs with what is still held.
+        """
+        held = array('d')
+        for cube_name in cube_names:
+            held.extend(self.cube_durations.get(cube_name, ()))
+        runs = [run for cube_name in cube_names for run in self.duration_runs.get(cube_name, ())]
+        if not runs:
+            return sorted_durations(held)
+        return heapq.merge(sorted_durations(held), *map(read_durations, merge_duration_runs(runs, self.spill_directory)))
+
+    def sorted_slow_queries(self):
+        """
+        The slow queries from fastest to slowest, like SlowQuery.sh's sort -k2,2n, equal durations in log order.
+        """
+        if self.slow_limit is not None:
+            return iter(sorted(self.slow_queries, key=itemgetter(0, 1)))
+        return heapq.merge(sorted(self.slow_queries, key=itemgetter(0, 1)), *(read_run(path, offset) for path, offset in self.slow_runs),
+                           key=itemgetter(0, 1))
+
+def analyze_performance(log_files, earliest_date, spill_directory, workers=1, slow_limit=None, top_k=None):
+    return analyze_logs(log_files, earliest_date, workers, partial(PerformanceAggregates, slow_limit, spill_directory, top_k))
+
+def query_fingerprint(record):
+    """
+    64-bit hash of the fields that identify what a query asks for, normalized so case and stray
+    whitespace in names don't split identical queries.
+    """
+    fields = (record.cube_name, record.dashboard, record.widget, record.widget_type, record.query_source)
+    normalized = '\x1f'.join('' if value is None else value.strip().casefold() for value in fields)
+    return int.from_bytes(hashlib.blake2b(normalized.encode(), digest_size=8).digest(), 'big')
+
+class DuplicateAggregates(QueryAggregates):
+    """
+    QueryAggregates plus repeated identical queries: a query is a repeat when its fingerprint was
+    seen within duplicate_window_seconds, looked up in a bounded LRU of recent fingerprints per cube.
+    Each work unit has its own LRUs, so a repeat straddling two units isn't counted.
+    """
+    def __init__(self, top_k=None):
+        super().__init__(top_k)
+        self.recent = defaultdict(OrderedDict) # cube: {fingerprint: last seen}
+        self.cube_queries = Counter()
+        self.cube_duplicates = Counter()
+        self.cube_wasted = Counter()
+        self.widget_duplicates = Counter() # (cube, dashboard, widget): repeats
+        self.widget_wasted = Counter()
+
+    def __getstate__(self):
+        # The LRUs only matter while a unit is being parsed
+        state = self.__dict__.copy()
+        state['recent'] = defaultdict(OrderedDict)
+        return state
+
+    def process_record(self, record):
+        super().process_record(record)
+        cube_name = record.cube_name or 'No CubeName'
+        recent = self.recent[cube_name]
+        fingerprint = query_fingerprint(record)
+        self.cube_queries[cube_name] += 1
+        last_seen = recent.get(fingerprint)
+        if last_seen is not None:
+            recent.move_to_end(fingerprint)
+            if (record.timestamp - last_seen).total_seconds() <= duplicate_window_seconds:
+                key = (cube_name, record.dashboard or 'No Dashboard', record.widget or 'No Widget')
+                self.cube_duplicates[cube_name] += 1
+                self.cube_wasted[cube_name] += record.duration
+                self.widget_duplicates[key] += 1
+                self.widget_wasted[key] += record.duration
+        elif len(recent) >= fingerprint_lru_size:
+            recent.popitem(last=False)
+        recent[fingerprint] = record.timestamp
+
+    def merge(self, other):
+        super().merge(other)
+        for name in ('cube_queries', 'cube_duplicates', 'cube_wasted', 'widget_duplicates', 'widget_wasted'):
+            getattr(self, name).update(getattr(other, name))
+        return self
+
+TARBALL_SUFFIXES = ('.tar.gz', '.tgz', '.tar')
+PARTIAL_VERSION = 2
+
+def node_name(source):
+    name = os.path.basename(os.path.normpath(source))
+    for suffix in TARBALL_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def is_query_log(name):
+    return name == 'query.log' or (name.startswith('query') and '.log-' in name and name.endswith('.gz'))
+
+def member_path(name):
+    """
+    A tarball member's path made relative, with empty, . and .. parts dropped so it stays inside
+    the directory it is extracted to. None when nothing is left.
+    """
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.', '..')]
+    return os.path.join(*parts) if parts else None
+
+def extract_query_logs(tarball, destination):
+    """
+    Copy only the query logs out of a node's tarball, each under its own sanitized member path so
+    logs with the same name in different directories don't overwrite each other.
+    """
+    os.makedirs(destination, exist_ok=True)
+    with tarfile.open(tarball) as archive:
+        for member in archive:
+            relative_path = member_path(member.name)
+            if member.isfile() and relative_path and is_query_log(os.path.basename(relative_path)):
+                target_path = os.path.join(destination, relative_path)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                with archive.extractfile(member) as source, open(target_path, 'wb') as target:
+                    shutil.copyfileobj(source, target, read_block_size)
+    return destination
+
+def node_log_files(root):
+    """
+    The query logs of one node's log root, which may be a copy of the whole filesystem with
+    the logs in one or more directories below it.
+    """
+    log_files = find_log_files(root)
+    if not log_files:
+        for directory, _, names in sorted(os.walk(root)):
+            if 'query.log' in names or any(is_query_log(name) for name in names):
+                log_files.extend(find_log_files(directory))
+    return log_files
+
+def analyze_nodes(sources, earliest_date, workers=1, top_k=None):
+    """
+    Aggregate each node's log root or tarball separately. Tarballs are unpacked and all nodes'
+    work units are parsed in one pool, so a few big nodes don't leave workers idle.
+    """
+    with tempfile.TemporaryDirectory(prefix='QueryM2M-') as scratch:
+        tarballs = [(source, os.path.join(scratch, str(position))) for position, source in enumerate(sources)
+                    if os.path.isfile(source) and source.endswith(TARBALL_SUFFIXES)]
+        if workers > 1 and len(tarballs) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                roots = dict(zip((source for source, _ in tarballs), pool.map(extract_query_logs, *zip(*tarballs))))
+        else:
+            roots = {source: extract_query_logs(source, destination) for source, destination in tarballs}
+
+        index = load_timestamp_index()
+        node_units = []
+        for source in sources:
+            log_files = [log_file for log_file in node_log_files(roots.get(source, source)) if file_may_overlap(log_file, earliest_date, index)]
+            if not log_files:
+                print(f"Warning: no query logs found for node {node_name(source)} in {source}")
+            start_offsets = {log_file: find_window_start(log_file, earliest_date) for log_file in log_files if not log_file.endswith('.gz')}
+            node_units.append(plan_work_units(log_files, start_offsets))
+        results = run_work_units([unit for units in node_units for unit in units], earliest_date, workers, partial(QueryAggregates, top_k))
+
+        nodes = {}
+        position = 0
+        for source, units in zip(sources, node_units):
+            name = node_name(source)
+            while name in nodes:
+                name += "'"
+            nodes[name] = merge_results(QueryAggregates(top_k), units, results[position:position + len(units)], index)
+            position += len(units)
+        return nodes
+
+def partial_path(directory, node):
+    return os.path.join(directory, f'{node}.partial.json.gz')
+
+# Partials come from other nodes, so they are plain JSON rather than pickles, which could run code when loaded.
+# JSON objects only take string keys, so maps are written as lists of [key..., value] rows.
+def sketch_to_json(sketch):
+    return [sorted(sketch.buckets.items()), sketch.zero_count, sketch.count, sketch.total, sketch.min, sketch.max]
+
+def sketch_from_json(state):
+    sketch = DDSketch()
+    buckets, sketch.zero_count, sketch.count, sketch.total, sketch.min, sketch.max = state
+    sketch.buckets = {int(key): int(count) for key, count in buckets}
+    return sketch
+
+def _key_to_json(key):
+    return list(key) if isinstance(key, tuple) else key
+
+def _key_from_json(key):
+    return tuple(key) if isinstance(key, list) else key
+
+def hitters_to_json(hitters):
+    return [hitters.capacity, hitters.total, [[_key_to_json(key), count, hitters.errors[key], hitters.labels[key]] for key, count in hitters.counts.items()]]
+
+def hitters_from_json(state):
+    capacity, total, rows = state
+    hitters = SpaceSaving(capacity)
+    hitters.total = total
+    for key, count, error, label in rows:
+        key = _key_from_json(key)
+        hitters.counts[key], hitters.errors[key], hitters.labels[key] = count, error, label
+    hitters.heap = [(count, key) for key, count in hitters.counts.items()]
+    heapq.heapify(hitters.heap)
+    return hitters
+
+def top_values_to_json(top_values, value_to_json):
+    return [hitters_to_json(top_values.hitters), [[_key_to_json(key), value_to_json(value)] for key, value in top_values.items()]]
+
+def top_values_from_json(state, factory, merge_value, value_from_json):
+    hitters, rows = state
+    top_values = TopValues(0, factory, merge_value)
+    top_values.hitters = hitters_from_json(hitters)
+    top_values.values = {_key_from_json(key): value_from_json(value) for key, value in rows}
+    return top_values
+
+def _timestamp_to_json(timestamp):
+    return timestamp and timestamp.isoformat()
+
+def _timestamp_from_json(text):
+    return text and datetime.fromisoformat(text)
+
+def aggregates_to_json(aggregates):
+    state = {
+        'top_k': aggregates.top_k,
+        'slow_durations': [[cube_name, sketch_to_json(sketch)] for cube_name, sketch in aggregates.slow_durations.items()],
+        'max_concurrent_query': list(aggregates.max_concurrent_query.items()),
+        'cube_latency': [[cube_name, sketch_to_json(sketch)] for cube_name, sketch in aggregates.cube_latency.items()],
+        'query_sources': list(aggregates.query_sources.items()),
+        'earliest_timestamp': _timestamp_to_json(aggregates.earliest_timestamp),
+        'latest_timestamp': _timestamp_to_json(aggregates.latest_timestamp),
+        'total_slow_queries': aggregates.total_slow_queries,
+        'total_queries': aggregates.total_queries,
+        'total_duration': aggregates.total_duration,
+    }
+    if aggregates.top_k:
+        state.update({
+            'dashboard_latency': top_values_to_json(aggregates.dashboard_latency, sketch_to_json),
+            'widget_latency': top_values_to_json(aggregates.widget_latency, sketch_to_json),
+            'max_values': top_values_to_json(aggregates.max_values, dict),
+            'timestamp_count': hitters_to_json(aggregates.timestamp_count),
+            'widget_hitters': [[cube_name, hitters_to_json(hitters)] for cube_name, hitters in aggregates.widget_hitters.items()],
+            'm2m_hitters': hitters_to_json(aggregates.m2m_hitters),
+        })
+        return state
+    state.update({
+        'dashboard_latency': [list(key) + [sketch_to_json(sketch)] for key, sketch in aggregates.dashboard_latency.items()],
+        'widget_latency': [list(key) + [sketch_to_json(sketch)] for key, sketch in aggregates.widget_latency.items()],
+        'max_values': [[cube_name, dashboard, max_vals] for cube_name, dashboards in aggregates.max_values.items()
+                       for dashboard, max_vals in dashboards.items()],
+        'timestamp_count': list(aggregates.timestamp_count.items()),
+        'dashboard_widget_count': [[cube_name, dashboard, widget, count] for cube_name, dashboards in aggregates.dashboard_widget_count.items()
+                                   for dashboard, widgets in dashboards.items() for widget, count in widgets.items()],
+        'm2m_threshold_entries': [list(key) + [cube_name, count] for key, cube_names in aggregates.m2m_threshold_entries.items()
+                                  for cube_name, count in cube_names.items()],
+        'widget_types': [[cube_name, dashboard, widget, widget_type] for cube_name, dashboards in aggregates.widget_types.items()
+                         for dashboard, widgets in dashboards.items() for widget, widget_type in widgets.items()],
+    })
+    return state
+
+def aggregates_from_json(state):
+    aggregates = QueryAggregates(state['top_k'])
+    for cube_name, sketch in state['slow_durations']:
+        aggregates.slow_durations[cube_name] = sketch_from_json(sketch)
+    aggregates.max_concurrent_query.update(dict(state['max_concurrent_query']))
+    for cube_name, sketch in state['cube_latency']:
+        aggregates.cube_latency[cube_name] = sketch_from_json(sketch)
+    aggregates.query_sources.update(dict(state['query_sources']))
+    aggregates.earliest_timestamp = _timestamp_from_json(state['earliest_timestamp'])
+    aggregates.latest_timestamp = _timestamp_from_json(state['latest_timestamp'])
+    aggregates.total_slow_queries = state['total_slow_queries']
+    aggregates.total_queries = state['total_queries']
+    aggregates.total_duration = state['total_duration']
+    if aggregates.top_k:
+        aggregates.dashboard_latency = top_values_from_json(state['dashboard_latency'], DDSketch, DDSketch.merge, sketch_from_json)
+        aggregates.widget_latency = top_values_from_json(state['widget_latency'], DDSketch, DDSketch.merge, sketch_from_json)
+        aggregates.max_values = top_values_from_json(state['max_values'], _max_value_record, _merge_max_values, dict)
+        aggregates.timestamp_count = hitters_from_json(state['timestamp_count'])
+        for cube_name, hitters in state['widget_hitters']:
+            aggregates.widget_hitters[cube_name] = hitters_from_json(hitters)
+        aggregates.m2m_hitters = hitters_from_json(state['m2m_hitters'])
+        return aggregates
+    for *key, sketch in state['dashboard_latency']:
+        aggregates.dashboard_latency[tuple(key)] = sketch_from_json(sketch)
+    for *key, sketch in state['widget_latency']:
+        aggregates.widget_latency[tuple(key)] = sketch_from_json(sketch)
+    for cube_name, dashboard, max_vals in state['max_values']:
+        aggregates.max_values[cube_name][dashboard].update(max_vals)
+    aggregates.timestamp_count.update(dict(state['timestamp_count']))
+    for cube_name, dashboard, widget, count in state['dashboard_widget_count']:
+        aggregates.dashboard_widget_count[cube_name][dashboard][widget] = count
+    for dashboard, widget, widget_type, cube_name, count in state['m2m_threshold_entries']:
+        aggregates.m2m_threshold_entries[(dashboard, widget, widget_type)][cube_name] = count
+    for cube_name, dashboard, widget, widget_type in state['widget_types']:
+        aggregates.widget_types[cube_name][dashboard][widget] = widget_type
+    return aggregates
+
+def save_partial(path, node, aggregates, earliest_date):
+    """
+    Write one node's aggregates for shipping to wherever the cluster report is built.
+    """
+    partial = {'version': PARTIAL_VERSION, 'node': node, 'earliest_date': earliest_date.isoformat(),
+               'slow_query_threshold': slow_query_threshold, 'aggregates': aggregates_to_json(aggregates)}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary_path = path + '.tmp'
+    with gzip.open(temporary_path, 'wt', compresslevel=6, encoding='utf-8') as file:
+        json.dump(partial, file, separators=(',', ':'))
+    os.replace(temporary_path, path)
+
+def load_partials(paths):
+    nodes = {}
+    for path in paths:
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as file:
+                partial = json.load(file)
+        except (OSError, ValueError) as error:
+            raise SystemExit(f"Error: {path} is not a partial aggregate file: {error}")
+        if not isinstance(partial, dict) or partial.get('version') != PARTIAL_VERSION:
+            raise SystemExit(f"Error: {path} was written by an incompatible version of QueryM2M")
+        if partial['slow_query_threshold'] != slow_query_threshold:
+            print(f"Warning: {path} was aggregated with a slow query threshold of {partial['slow_query_threshold']} seconds, not {slow_query_threshold}")
+        name = partial['node']
+        while name in nodes:
+            name += "'"
+        try:
+            nodes[name] = aggregates_from_json(partial['aggregates'])
+        except (KeyError, TypeError, ValueError) as error:
+            raise SystemExit(f"Error: {path} holds malformed aggregates: {error!r}")
+    return nodes
+
+def reduce_nodes(nodes):
+    cluster = QueryAggregates(max((aggregates.top_k for aggregates in nodes.values() if aggregates.top_k), default=None))
+    for aggregates in nodes.values():
+        cluster.merge(aggregates)
+    return cluster
+
+# Columnar cache of every parsed FinishQuery record, strings are dictionary encoded per segment
+NUMERIC_COLUMNS = (('timestamp', 'int64'), ('duration', 'float64'), ('translation_duration', 'float64'),
+                   ('data_source_execute_duration', 'float64'), ('throttling_time_waiting', 'float64'),
+                   ('concurrent_query', 'int32'), ('m2m_flag', 'bool'))
+STRING_COLUMNS = ('cube_name', 'dashboard', 'widget', 'widget_type', 'query_source')
+EPOCH = datetime(1970, 1, 1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+def cache_directory():
+    return os.path.join(state_directory, 'columnar')
+
+def load_cache_manifest():
+    try:
+        with open(os.path.join(cache_directory(), 'manifest.json')) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache_manifest(manifest):
+    os.makedirs(cache_directory(), exist_ok=True)
+    with open(os.path.join(cache_directory(), 'manifest.json'), 'w') as file:
+        json.dump(manifest, file)
+
+def ingest_file(log_file, segment_name):
+    """
+    Parse every FinishQuery line of one log into columns and write them as a cache segment,
+    Parquet when pyarrow is installed and a directory of .npy files otherwise.
+    """
+    numeric = {name: [] for name, dtype in NUMERIC_COLUMNS}
+    codes = {name: [] for name in STRING_COLUMNS}
+    strings = {}
+    for line in read_finish_query_lines(log_file):
+        record = parse_finish_query(line)
+        if record is None:
+            continue
+        numeric['timestamp'].append((record.timestamp - EPOCH) // ONE_MICROSECOND)
+        for name, dtype in NUMERIC_COLUMNS[1:]:
+            numeric[name].append(getattr(record, name))
+        for name in STRING_COLUMNS:
+            value = getattr(record, name)
+            codes[name].append(-1 if value is None else strings.setdefault(value, len(strings)))
+
+    string_table = list(strings)
+    segment_path = os.path.join(cache_directory(), segment_name)
+    if pa is not None:
+        columns = {name: pa.array(numeric[name], type=dtype) for name, dtype in NUMERIC_COLUMNS}
+        dictionary = pa.array(string_table, type=pa.string())
+        for name in STRING_COLUMNS:
+            indices = pa.array([None if code < 0 else code for code in codes[name]], type=pa.int32())
+            columns[name] = pa.DictionaryArray.from_arrays(indices, dictionary)
+        segment_path += '.parquet'
+        pq.write_table(pa.table(columns), segment_path)
+    else:
+        os.makedirs(segment_path, exist_ok=True)
+        for name, dtype in NUMERIC_COLUMNS:
+            np.save(os.path.join(segment_path, f'{name}.npy'), np.array(numeric[name], dtype=dtype))
+        for name in STRING_COLUMNS:
+            np.save(os.path.join(segment_path, f'{name}.npy'), np.array(codes[name], dtype='int32'))
+        with open(os.path.join(segment_path, 'strings.json'), 'w') as file:
+            json.dump(string_table, file)
+
+    timestamps = numeric['timestamp']
+    return {'segment': os.path.basename(segment_path), 'rows': len(timestamps),
+            'first': min(timestamps) if timestamps else None, 'last': max(timestamps) if timestamps else None}
+
+def remove_segment(segment):
+    segment_path = os.path.join(cache_directory(), segment)
+    if os.path.isdir(segment_path):
+        for name in os.listdir(segment_path):
+            os.remove(os.path.join(segment_path, name))
+        os.rmdir(segment_path)
+    elif os.path.exists(segment_path):
+        os.remove(segment_path)
+
+def ingest_logs(log_files, workers=1):
+    """
+    Bring the columnar cache up to date. Logs whose identity matches the manifest are skipped, so rotated
+    archives are only parsed once, and segments for logs that no longer exist are dropped.
+    """
+    manifest = load_cache_manifest()
+    os.makedirs(cache_directory(), exist_ok=True)
+    pending = []
+    for log_file in log_files:
+        identity = file_identity(os.stat(log_file))
+        entry = manifest.get(log_file)
+        if entry and entry['identity'] == identity:
+            continue
+        segment_name = hashlib.sha1(f'{log_file}:{identity}'.encode()).hexdigest()
+        pending.append((log_file, identity, segment_name))
+
+    if workers > 1 and len(pending) > 1:
+        with worker_pool(workers) as pool:
+            results = list(pool.map(ingest_file, [item[0] for item in pending], [item[2] for item in pending]))
+    else:
+        results = [ingest_file(log_file, segment_name) for log_file, identity, segment_name in pending]
+
+    for (log_file, identity, segment_name), result in zip(pending, results):
+        if log_file in manifest:
+            remove_segment(manifest[log_file]['segment'])
+        manifest[log_file] = dict(result, identity=identity)
+    for log_file in [log_file for log_file in manifest if log_file not in log_files]:
+        remove_segment(manifest.pop(log_file)['segment'])
+    save_cache_manifest(manifest)
+    return manifest
+
+def read_segment(segment):
+    """
+    Load one cache segment as numpy columns plus the string table for each string column.
+    """
+    segment_path = os.path.join(cache_directory(), segment)
+    if segment.endswith('.parquet'):
+        table = pq.read_table(segment_path)
+        columns = {name: table.column(name).to_numpy() for name, dtype in NUMERIC_COLUMNS}
+        string_tables = {}
+        for name in STRING_COLUMNS:
+            # Parquet keeps a dictionary per column, so each string column gets its own table back
+            column = table.column(name).combine_chunks()
+            string_tables[name] = column.dictionary.to_pylist()
+            columns[name] = column.indices.fill_null(-1).to_numpy().astype('int32')
+        return columns, string_tables
+    columns = {name: np.load(os.path.join(segment_path, f'{name}.npy')) for name, dtype in NUMERIC_COLUMNS + tuple((name, 'int32') for name in STRING_COLUMNS)}
+    with open(os.path.join(segment_path, 'strings.json')) as file:
+        string_table = json.load(file)
+    return columns, {name: string_table for name in STRING_COLUMNS}
+
+def load_columns(manifest, earliest_date):
+    """
+    Concatenate the cached rows at or after earliest_date. String codes are remapped onto one shared
+    table, with code -1 meaning the field was missing.
+    """
+    earliest = (earliest_date - EPOCH) // ONE_MICROSECOND
+    all_columns = NUMERIC_COLUMNS + tuple((name, 'int32') for name in STRING_COLUMNS)
+    parts = {name: [] for name, dtype in all_columns}
+    strings = {}
+    for entry in manifest.values():
+        if not entry['rows'] or entry['last'] < earliest:
+            continue
+        columns, string_tables = read_segment(entry['segment'])
+        keep = columns['timestamp'] >= earliest
+        for name, dtype in NUMERIC_COLUMNS:
+            parts[name].append(columns[name][keep])
+        for name in STRING_COLUMNS:
+            # The extra -1 at the end keeps missing values missing after the remap
+            remap = np.array([strings.setdefault(value, len(strings)) for value in string_tables[name]] + [-1], dtype='int32')
+            parts[name].append(remap[columns[name][keep]])
+    columns = {name: np.concatenate(parts[name]) if parts[name] else np.array([], dtype=dtype) for name, dtype in all_columns}
+    return columns, list(strings)
+
+def sketches_by_group(group_ids, values):
+    """
+    One DDSketch per group id, built with numpy instead of calling add() for every value.
+    """
+    sketches = {}
+    if not len(values):
+        return sketches
+    order = np.argsort(group_ids, kind='stable')
+    group_ids, values = group_ids[order], values[order]
+    bounds = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1], True])
+    positive = values > 0
+    keys = np.zeros(len(values), dtype='int64')
+    keys[positive] = np.ceil(np.log(values[positive]) / DDSketch.gamma_log)
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        sketch = DDSketch()
+        group_values = values[start:end]
+        group_positive = positive[start:end]
+        sketch.count = int(end - start)
+        sketch.total = float(group_values.sum())
+        sketch.min, sketch.max = float(group_values.min()), float(group_values.max())
+        sketch.zero_count = int(sketch.count - group_positive.sum())
+        unique_keys, counts = np.unique(keys[start:end][group_positive], return_counts=True)
+        sketch.buckets = dict(zip(unique_keys.tolist(), counts.tolist()))
+        if len(sketch.buckets) > sketch_max_buckets:
+            sketch._collapse()
+        sketches[int(group_ids[start])] = sketch
+    return sketches
+
+def aggregates_from_columns(columns, strings, top_k=None):
+    """
+    Build the same QueryAggregates the log parser produces, with the per-query work vectorized.
+    Only the slow queries, normally a small fraction, are walked one by one.
+    """
+    aggregates = QueryAggregates(top_k)
+    count = len(columns['timestamp'])
+    if not count:
+        return aggregates
+    names = strings + [None]
+    width = len(names)
+    cube = np.where(columns['cube_name'] < 0, width - 1, columns['cube_name']).astype('int64')
+    dashboard = np.where(columns['dashboard'] < 0, width - 1, columns['dashboard']).astype('int64')
+    widget = np.where(columns['widget'] < 0, width - 1, columns['widget']).astype('int64')
+    widget_type = np.where(columns['widget_type'] < 0, width - 1, columns['widget_type']).astype('int64')
+    durations = columns['duration']
+
+    aggregates.total_queries = count
+    aggregates.total_duration = float(durations.sum())
+    aggregates.earliest_timestamp = EPOCH + int(columns['timestamp'].min()) * ONE_MICROSECOND
+    aggregates.latest_timestamp = EPOCH + int(columns['timestamp'].max()) * ONE_MICROSECOND
+
+    for cube_code, sketch in sketches_by_group(cube, durations).items():
+        aggregates.cube_latency[names[cube_code] or 'No CubeName'] = sketch
+    aggregates.add_latency_sketches('dashboard_latency', {
+        (names[pair // width] or 'No CubeName', names[pair % width] or 'No Dashboard'): sketch
+        for pair, sketch in sketches_by_group(cube * width + dashboard, durations).items()})
+    aggregates.add_latency_sketches('widget_latency', {
+        (names[triple // width // width] or 'No CubeName', names[triple // width % width] or 'No Dashboard', names[triple % width] or 'No Widget'): sketch
+        for triple, sketch in sketches_by_group((cube * width + dashboard) * width + widget, durations).items()})
+
+    m2m = columns['m2m_flag']
+    if m2m.any():
+        combos, counts = np.unique(np.stack([dashboard[m2m], widget[m2m], widget_type[m2m], cube[m2m]]), axis=1, return_counts=True)
+        for (dashboard_code, widget_code, widget_type_code, cube_code), combo_count in zip(combos.T.tolist(), counts.tolist()):
+            key = (names[dashboard_code] or 'No Dashboard', names[widget_code] or 'No Widget', names[widget_type_code] or 'No Widget')
+            aggregates.add_m2m(key, names[cube_code] or 'No CubeName', combo_count)
+
+    for row in np.flatnonzero(durations > slow_query_threshold).tolist():
+        aggregates.process_slow_query(_new_finish_query(FinishQuery, (
+            EPOCH + int(columns['timestamp'][row]) * ONE_MICROSECOND,
+            names[cube[row]], names[dashboard[row]], names[widget[row]], names[widget_type[row]],
+            names[columns['query_source'][row]] if columns['query_source'][row] >= 0 else None,
+            float(durations[row]), float(columns['translation_duration'][row]),
+            float(columns['data_source_execute_duration'][row]), float(columns['throttling_time_waiting'][row]),
+            int(columns['concurrent_query'][row]), bool(m2m[row]),
+        )))
+    return aggregates
+
+# Rollup store of per-cube latency in minute, hour and day buckets kept across runs
+ROLLUP_TIERS = (('minute', 60), ('hour', 3600), ('day', 86400))
+ONE_MINUTE = timedelta(minutes=1)
+
+class MinuteRollups:
+    """
+    Count, sum, max, slow query count and a DDSketch per cube and minute. Used as the aggregates of
+    work units when updating the rollup store, it merges like QueryAggregates.
+    """
+    def __init__(self):
+        self.buckets = {} # (cube, minute as epoch seconds): [count, total, max, slow, DDSketch]
+
+    def process_record(self, record):
+        key = (record.cube_name or 'No CubeName', (record.timestamp - EPOCH) // ONE_MINUTE * 60)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [0, 0.0, 0.0, 0, DDSketch()]
+        duration = record.duration
+        bucket[0] += 1
+        bucket[1] += duration
+        if duration > bucket[2]:
+            bucket[2] = duration
+        if duration > slow_query_threshold:
+            bucket[3] += 1
+        bucket[4].add(duration)
+
+    def merge(self, other):
+        for key, bucket in other.buckets.items():
+            _merge_bucket(self.buckets, key, bucket)
+        return self
+
+def _merge_bucket(buckets, key, bucket):
+    own = buckets.get(key)
+    if own is None:
+        buckets[key] = bucket
+        return
+    own[0] += bucket[0]
+    own[1] += bucket[1]
+    own[2] = max(own[2], bucket[2])
+    own[3] += bucket[3]
+    own[4].merge(bucket[4])
+
+def rollup_path():
+    return os.path.join(state_directory, 'rollups.sqlite')
+
+def open_rollup_store():
+    os.makedirs(state_directory, exist_ok=True)
+    connection = sqlite3.connect(rollup_path())
+    connection.execute("""CREATE TABLE IF NOT EXISTS rollups (tier TEXT, cube TEXT, bucket INTEGER, count INTEGER, total REAL,
+                          max REAL, slow INTEGER, sketch BLOB, PRIMARY KEY (tier, cube, bucket)) WITHOUT ROWID""")
+    connection.execute("CREATE TABLE IF NOT EXISTS offsets (fingerprint TEXT PRIMARY KEY, offset INTEGER)")
+    return connection
+
+def dump_sketch(sketch):
+    # Only builtins, so the store doesn't depend on where DDSketch lives
+    return pickle.dumps(sketch.__getstate__(), protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_sketch(blob):
+    sketch = DDSketch.__new__(DDSketch)
+    sketch.__setstate__(pickle.loads(blob))
+    return sketch
+
+def update_rollups(log_files, workers=1):
+    """
+    Fold the log lines not yet in the rollup store into its minute buckets and the hour and day buckets
+    they belong to, then drop rows past each tier's retention. The store keeps its own offsets, the
+    same way --incremental does, so every line is counted once.
+    """
+    connection = open_rollup_store()
+    offsets = dict(connection.execute("SELECT fingerprint, offset FROM offsets"))
+    index = load_timestamp_index()
+    units, consumed = plan_incremental_units(log_files, offsets, datetime.min, index)
+    minutes = merge_results(MinuteRollups(), units, run_work_units(units, datetime.min, workers, MinuteRollups), index).buckets
+
+    now = (datetime.now(timezone.utc).replace(tzinfo=None) - EPOCH) // timedelta(seconds=1)
+    with connection:
+        for tier, seconds in ROLLUP_TIERS:
+            buckets = {}
+            for (cube_name, minute), bucket in minutes.items():
+                _merge_bucket(buckets, (cube_name, minute // seconds * seconds), [bucket[0], bucket[1], bucket[2], bucket[3], DDSketch().merge(bucket[4])])
+            cutoff = now - rollup_retention_days[tier] * 86400
+            for (cube_name, start), bucket in buckets.items():
+                if start < cutoff:
                     continue
+                row = connection.execute("SELECT count, total, max, slow, sketch FROM rollups WHERE tier = ? AND cube = ? AND bucket = ?",
+                                         (tier, cube_name, start)).fetchone()
+                if row is not None:
+                    _merge_bucket(buckets, (cube_name, start), list(row[:4]) + [load_sketch(row[4])])
+                count, total, maximum, slow, sketch = buckets[(cube_name, start)]
+                connection.execute("INSERT OR REPLACE INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (tier, cube_name, start, count, total, maximum, slow, dump_sketch(sketch)))
+            connection.execute("DELETE FROM rollups WHERE tier = ? AND bucket < ?", (tier, cutoff))
+        connection.executemany("INSERT OR REPLACE INTO offsets VALUES (?, ?)", consumed.items())
+    connection.close()
+    return len(minutes)
+
+def choose_tier(since, until):
+    """
+    The finest tier still holding since that keeps the range to a few hundred rows.
+    """
+    span = (until - since).total_seconds()
+    age_days = (datetime.now(timezone.utc).replace(tzinfo=None) - since).total_seconds() / 86400
+    if span <= 6 * 3600 and age_days <= rollup_retention_days['minute']:
+        return 'minute'
+    if span <= 14 * 86400 and age_days <= rollup_retention_days['hour']:
+        return 'hour'
+    return 'day'
+
+def query_rollups(since, until, cube_name=None, tier=None):
+    """
+    [(bucket start, cube, count, total, max, slow, sketch)] from since until until, for one cube or all of them.
+    """
+    tier = tier or choose_tier(since, until)
+    start = (since - EPOCH) // timedelta(seconds=1)
+    end = (until - EPOCH) // timedelta(seconds=1)
+    connection = open_rollup_store()
+    if cube_name is None:
+        rows = connection.execute("SELECT bucket, cube, count, total, max, slow, sketch FROM rollups WHERE tier = ? AND bucket >= ? AND bucket < ? "
+                                  "ORDER BY cube, bucket", (tier, start, end)).fetchall()
+    else:
+        rows = connection.execute("SELECT bucket, cube, count, total, max, slow, sketch FROM rollups WHERE tier = ? AND cube = ? AND bucket >= ? AND bucket < ? "
+                                  "ORDER BY bucket", (tier, cube_name, start, end)).fetchall()
+    connection.close()
+    return tier, [(EPOCH + timedelta(seconds=bucket), cube, count, total, maximum, slow, load_sketch(sketch))
+                  for bucket, cube, count, total, maximum, slow, sketch in rows]
+
+def print_trend(since, until, cube_name=None, tier=None):
+    tier, rows = query_rollups(since, until, cube_name, tier)
+    print(f"\nQuery latency per {tier} from {since} to {until}:")
+    cubes = defaultdict(list)
+    for row in rows:
+        cubes[row[1]].append(row)
+    for cube, cube_rows in cubes.items():
+        print(f"CubeName: {cube}")
+        overall = DDSketch()
+        for start, _, count, total, maximum, slow, sketch in cube_rows:
+            overall.merge(sketch)
+            p50, p95 = sketch.quantiles([0.5, 0.95])
+            print(f"  {start}: Count: {count}, Slow: {slow}, Average: {total / count:.3f}, P50: {p50:.3f}, P95: {p95:.3f}, Max: {maximum:.3f}")
+        print_percentiles("Whole range", overall, '  ')
+    if not rows:
+        print("No rollups in this range, run --rollup first.")
+
+ONE_SECOND_US = 1000000
+
+def concurrency_timeline(starts, ends):
+    """
+    Exact in-flight concurrency for the [start, end) intervals, in microseconds, with a sweep over the sorted
+    start/end events. Returns the first second covered, the peak and time-weighted mean concurrency for every
+    second from there on, and the event times and running levels for looking up the level at any instant.
+    """
+    count = len(starts)
+    times = np.concatenate([starts, ends])
+    deltas = np.concatenate([np.ones(count, dtype='int64'), -np.ones(count, dtype='int64')])
+    # Ends sort before starts at the same instant, so back to back queries don't count as overlapping
+    order = np.lexsort((deltas, times))
+    times, deltas = times[order], deltas[order]
+    levels = np.cumsum(deltas)
+
+    first_second = int(times[0] // ONE_SECOND_US)
+    boundaries = np.arange(first_second, int(times[-1] // ONE_SECOND_US) + 2, dtype='int64') * ONE_SECOND_US
+    level_index = np.searchsorted(times, boundaries[:-1], side='right') - 1
+    peak = np.where(level_index >= 0, levels[np.maximum(level_index, 0)], 0)
+    event_seconds = times // ONE_SECOND_US - first_second
+    group_starts = np.flatnonzero(np.r_[True, event_seconds[1:] != event_seconds[:-1]])
+    peak[event_seconds[group_starts]] = np.maximum(peak[event_seconds[group_starts]], np.maximum.reduceat(levels, group_starts))
+
+    # Integral of the level over time is piecewise linear between events, so interpolating it at the
+    # second boundaries gives the exact query-seconds in flight during each second
+    area = np.concatenate([[0.0], np.cumsum(levels[:-1] * np.diff(times).astype('float64'))])
+    mean = np.diff(np.interp(boundaries.astype('float64'), times.astype('float64'), area)) / ONE_SECOND_US
+    return first_second, peak, mean, times, levels
+
+def level_at(times, levels, instants):
+    index = np.searchsorted(times, instants, side='right') - 1
+    return np.where(index >= 0, levels[np.maximum(index, 0)], 0)
+
+def timeline_rows(scope, starts, ends, throttling):
+    """
+    Per second rows for one scope: peak and mean in flight, queries started and how many of them waited on the
+    query throttle, with the throttled queries attributed to the second they started in.
+    """
+    first_second, peak, mean, times, levels = concurrency_timeline(starts, ends)
+    start_seconds = starts // ONE_SECOND_US - first_second
+    started = np.bincount(start_seconds, minlength=len(peak))
+    throttled = np.bincount(start_seconds, weights=throttling > 0, minlength=len(peak)).astype('int64')
+    max_wait = np.zeros(len(peak))
+    np.maximum.at(max_wait, start_seconds, throttling)
+    # The level just after a query starts includes the query itself
+    start_levels = level_at(times, levels, starts)
+    return {'scope': scope, 'first_second': first_second, 'peak': peak, 'mean': mean, 'started': started,
+            'throttled': throttled, 'max_wait': max_wait, 'start_levels': start_levels, 'throttling': throttling}
+
+def build_timelines(columns, strings, node=None):
+    node = node or socket.gethostname()
+    keep = columns['duration'] > 0
+    ends = columns['timestamp'][keep]
+    starts = ends - np.round(columns['duration'][keep] * ONE_SECOND_US).astype('int64')
+    throttling = columns['throttling_time_waiting'][keep]
+    cubes = columns['cube_name'][keep]
+    timelines = [timeline_rows(f"Node: {node}", starts, ends, throttling)] if len(starts) else []
+    for cube_code in np.unique(cubes).tolist():
+        in_cube = cubes == cube_code
+        cube_name = strings[cube_code] if cube_code >= 0 else 'No CubeName'
+        timelines.append(timeline_rows(f"Node: {node}, CubeName: {cube_name}", starts[in_cube], ends[in_cube], throttling[in_cube]))
+    return timelines
+
+def second_label(second):
+    return (EPOCH + timedelta(seconds=int(second))).strftime('%Y-%m-%d %H:%M:%S')
+
+def print_timeline_report(timelines):
+    print("\nConcurrency timeline (a query is in flight from its end timestamp minus its duration until its end):")
+    for timeline in timelines:
+        peak, throttling, start_levels = timeline['peak'], timeline['throttling'], timeline['start_levels']
+        peak_concurrency = int(peak.max())
+        at_peak = int((peak == peak_concurrency).sum())
+        throttled = throttling > 0
+        print(f"\n{timeline['scope']}")
+        print(f"  Peak in-flight concurrency: {peak_concurrency} (reached in {at_peak} seconds)")
+        if throttled.any():
+            near_peak = (start_levels[throttled] >= peak_concurrency - 1).mean() * 100
+            print(f"  Throttled queries: {int(throttled.sum())} of {len(throttling)}, average wait {throttling[throttled].mean():.3f}s")
+            print(f"  {near_peak:.1f}% of throttled queries started with concurrency within 1 of the peak"
+                  + (" - the query throttle looks like the bottleneck" if near_peak >= 50 else ""))
+        else:
+            print("  No queries waited on the query throttle")
+        print(f"  Top {timeline_top_seconds} seconds by in-flight concurrency:")
+        for index in np.argsort(-peak, kind='stable')[:timeline_top_seconds].tolist():
+            print(f"    {second_label(timeline['first_second'] + index)}: peak {int(peak[index])}, mean {timeline['mean'][index]:.2f}, "
+                  f"started {int(timeline['started'][index])}, throttled {int(timeline['throttled'][index])}, max wait {timeline['max_wait'][index]:.3f}s")
+
+def write_timeline_csv(timelines, path):
+    with open(path, 'w') as file:
+        file.write("scope,second,peak_concurrency,mean_concurrency,started,throttled,max_throttling_wait\n")
+        for timeline in timelines:
+            scope = timeline['scope'].replace('"', '""')
+            for index in np.flatnonzero((timeline['mean'] > 0) | (timeline['started'] > 0)).tolist():
+                file.write(f'"{scope}",{second_label(timeline["first_second"] + index)},{int(timeline["peak"][index])},'
+                           f'{timeline["mean"][index]:.4f},{int(timeline["started"][index])},{int(timeline["throttled"][index])},'
+                           f'{timeline["max_wait"][index]:.3f}\n')
+
+def erlang_c(servers, load):
+    """
+    Probability that a query has to wait in an M/M/c queue with this many servers, for an array of offered loads
+    in concurrent queries, through the Erlang B recursion which stays stable for large loads.
+    """
+    blocking = np.ones_like(load)
+    for count in range(1, servers + 1):
+        blocking = load * blocking / (count + load * blocking)
+    utilization = load / servers
+    return np.where(utilization < 1, blocking / np.maximum(1 - utilization * (1 - blocking), 1e-12), 1.0)
+
+def grouped_percentile(values, starts, percentile):
+    """
+    Linearly interpolated percentile of values within each group, for values laid out group by group
+    with group i starting at starts[i] and no group empty. Partitions each group, linear in its size.
+    """
+    bounds = starts.tolist() + [len(values)]
+    return np.array([np.percentile(values[start:end], percentile) for start, end in zip(bounds[:-1], bounds[1:])])
+
+def fit_capacity_model(columns, strings, current_limit=None):
+    """
+    Fit a queueing model of the query throttle per cube and simulate P95 latency at each concurrency limit.
+
+    A query is translated, then waits on the throttle, then executes on the data source. Per cube and
+    capacity_window_seconds window, the arrival rate and mean dataSourceExecuteDuration give the offered load,
+    and the wait at c concurrent queries is the M/G/c mean from Erlang C with the Allen-Cunneen correction for
+    the variability of execution times, or the backlog building up over the window once the load exceeds c.
+    Execution time grows linearly with concurrentQuery as fitted per cube, so raising the limit is not free.
+    The modelled waits are scaled per cube to match the observed throttlingTimeWaiting at the observed limit,
+    the highest concurrentQuery seen unless current_limit is given.
+    """
+    keep = columns['duration'] > 0
+    if not keep.any():
+        return []
+    cube_codes, cube_of = np.unique(columns['cube_name'][keep], return_inverse=True)
+    cube_count = len(cube_codes)
+    cube_size = np.bincount(cube_of, minlength=cube_count)
+    cube_starts = np.cumsum(cube_size) - cube_size
+    # Laid out cube by cube, so each cube's percentiles come from one slice
+    order = np.flatnonzero(keep)[np.argsort(cube_of, kind='stable')]
+    cube_of = np.repeat(np.arange(cube_count), cube_size)
+    duration = columns['duration'][order]
+    translation = np.clip(columns['translation_duration'][order], 0, None)
+    service = np.clip(columns['data_source_execute_duration'][order], 0, None)
+    waiting = np.clip(columns['throttling_time_waiting'][order], 0, None)
+    concurrency = np.maximum(columns['concurrent_query'][order], 1).astype('float64')
+
+    # Queries reach the throttle once translated
+    arrivals = columns['timestamp'][order] / ONE_SECOND_US - duration + translation
+    windows = np.floor(arrivals / capacity_window_seconds).astype('int64')
+    windows -= windows.min()
+    span = int(windows.max()) + 1
+    groups, group_of = np.unique(cube_of * span + windows, return_inverse=True)
+    group_cube = groups // span
+    group_size = np.bincount(group_of)
+    rate = group_size / capacity_window_seconds
+    mean_service = np.bincount(group_of, service) / group_size
+    mean_concurrency = np.bincount(group_of, concurrency) / group_size
+
+    # Mean, variance and the least squares line of execution time against concurrentQuery, per cube
+    service_mean = np.bincount(cube_of, service, cube_count) / cube_size
+    service_variance = np.maximum(np.bincount(cube_of, service * service, cube_count) / cube_size - service_mean ** 2, 0)
+    concurrency_mean = np.bincount(cube_of, concurrency, cube_count) / cube_size
+    concurrency_variance = np.bincount(cube_of, concurrency * concurrency, cube_count) / cube_size - concurrency_mean ** 2
+    covariance = np.bincount(cube_of, concurrency * service, cube_count) / cube_size - concurrency_mean * service_mean
+    safe_variance = np.where(concurrency_variance > 1e-9, concurrency_variance, 1.0)
+    slope = np.where(concurrency_variance > 1e-9, np.maximum(covariance / safe_variance, 0), 0.0)
+    intercept = np.maximum(service_mean - slope * concurrency_mean, 1e-6)
+    safe_mean = np.where(service_mean > 0, service_mean, 1.0)
+    variability = ((1 + np.where(service_mean > 0, service_variance / safe_mean ** 2, 1.0)) / 2)[group_cube]
+    group_intercept, group_slope = intercept[group_cube], slope[group_cube]
+    observed_level = group_intercept + group_slope * mean_concurrency
+    offered = rate * mean_service
+
+    def simulate(limit):
+        # A few fixed point steps settle how many queries run at once and how much that slows each of them
+        busy = np.minimum(limit, offered)
+        for _ in range(3):
+            busy = np.minimum(limit, offered * (group_intercept + group_slope * busy) / observed_level)
+        slowdown = (group_intercept + group_slope * busy) / observed_level
+        load = offered * slowdown
+        utilization = load / limit
+        queued = erlang_c(limit, load) * mean_service * slowdown / (limit * np.maximum(1 - utilization, 1e-12)) * variability
+        backlog = (1 - 1 / np.maximum(utilization, 1)) * capacity_window_seconds / 2
+        return slowdown, np.where(utilization < 1, queued, backlog)
+
+    observed_limit = np.zeros(cube_count)
+    np.maximum.at(observed_limit, cube_of, concurrency)
+    if current_limit:
+        observed_limit[:] = current_limit
+    observed_limit = observed_limit.astype('int64')
+    limits = sorted(set(capacity_limits) | set(observed_limit.tolist()))
+    simulated = {limit: simulate(limit) for limit in limits}
+
+    modelled_wait = np.zeros(cube_count)
+    for limit in np.unique(observed_limit).tolist():
+        at_limit = observed_limit[group_cube] == limit
+        modelled_wait += np.bincount(group_cube[at_limit], (group_size * simulated[limit][1])[at_limit], cube_count)
+    modelled_wait /= cube_size
+    observed_wait = np.bincount(cube_of, waiting, cube_count) / cube_size
+    safe_wait = np.where(modelled_wait > 0, modelled_wait, 1.0)
+    calibration = np.where(modelled_wait > 0, np.clip(observed_wait / safe_wait, 0.1, 10), 1.0)
+
+    p95 = np.empty((cube_count, len(limits)))
+    for position, limit in enumerate(limits):
+        slowdown, wait = simulated[limit]
+        latency = translation + service * slowdown[group_of] + calibration[cube_of] * wait[group_of]
+        p95[:, position] = grouped_percentile(latency, cube_starts, 95)
+    observed_p95 = grouped_percentile(duration, cube_starts, 95)
+    peak_load = np.zeros(cube_count)
+    np.maximum.at(peak_load, group_cube, offered)
+
+    models = []
+    for cube in np.argsort(-cube_size, kind='stable').tolist():
+        code = int(cube_codes[cube])
+        cube_limits = sorted(set(capacity_limits) | {int(observed_limit[cube])})
+        cube_p95 = p95[cube, [limits.index(limit) for limit in cube_limits]]
+        recommended = cube_limits[int(np.flatnonzero(cube_p95 <= cube_p95.min() * (1 + capacity_slack))[0])]
+        models.append({'cube_name': strings[code] if code >= 0 else 'No CubeName', 'queries': int(cube_size[cube]),
+                       'peak_load': float(peak_load[cube]), 'growth': float(slope[cube] / (intercept[cube] + slope[cube])),
+                       'observed_limit': int(observed_limit[cube]), 'observed_wait': float(observed_wait[cube]),
+                       'modelled_wait': float(modelled_wait[cube]), 'calibration': float(calibration[cube]),
+                       'observed_p95': float(observed_p95[cube]), 'limits': cube_limits, 'p95': cube_p95.tolist(),
+                       'recommended': recommended})
+    return models
+
+def print_capacity_report(models):
+    print(f"\nThrottling capacity model per cube (M/G/c queue fitted per {capacity_window_seconds} second window, "
+          f"queries are translated, wait on the throttle, then execute on the data source):")
+    if not models:
+        print("No queries with a duration in the specified date range.")
+    for model in models:
+        limits, p95 = model['limits'], model['p95']
+        at_observed = p95[limits.index(model['observed_limit'])]
+        print(f"\nCubeName: {model['cube_name']}")
+        print(f"  Queries: {model['queries']}, peak offered load {model['peak_load']:.2f} concurrent queries, "
+              f"execution time grows {model['growth']:.1%} per extra concurrent query")
+        print(f"  At limit {model['observed_limit']}: throttling wait observed {model['observed_wait']:.3f}s, modelled {model['modelled_wait']:.3f}s "
+              f"(scaled by {model['calibration']:.2f}), P95 observed {model['observed_p95']:.3f}s, modelled {at_observed:.3f}s")
+        print("  Limit: " + "".join(f"{limit:>9}" for limit in limits))
+        print("  P95:   " + "".join(f"{value:>9.3f}" for value in p95))
+        print(f"  Recommended concurrency limit: {model['recommended']} (P95 {p95[limits.index(model['recommended'])]:.3f}s, "
+              f"within {capacity_slack:.0%} of the best simulated)")
+
+# Fixed log scale histogram for the rolling windows, 15% wide bins from 1 ms up to about 16 hours
+LATENCY_BIN_FLOOR = 0.001
+LATENCY_BIN_GROWTH = log(1.15)
+LATENCY_BINS = 128
 
+class RollingWindow:
+    """
+    Aggregates for one cube or dashboard over the last follow_window_seconds of log time, kept in a ring
+    of follow_bucket_seconds slots. Adding a query is O(1) and a slot is reset when the ring wraps onto it,
+    so memory doesn't grow however long --follow runs.
+    """
+    __slots__ = ('stamps', 'counts', 'm2m_hits', 'throttling', 'histograms')
+    slots = max(1, follow_window_seconds // follow_bucket_seconds)
 
+    def __init__(self):
+        self.stamps = [None] * self.slots
+        self.counts = [0] * self.slots
+        self.m2m_hits = [0] * self.slots
+        self.throttling = [0.0] * self.slots
+        self.histograms = [{} for _ in range(self.slots)]
 
-# Sort cube names based on the count of slow queries
-sorted_cubes = sorted(data.items(), key=lambda x: calculate_stats(x[1])['count'])
+    def add(self, record, bucket):
+        slot = bucket % self.slots
+        if self.stamps[slot] != bucket:
+            self.stamps[slot] = bucket
+            self.counts[slot] = self.m2m_hits[slot] = 0
+            self.throttling[slot] = 0.0
+            self.histograms[slot] = {}
+        self.counts[slot] += 1
+        self.m2m_hits[slot] += record.m2m_flag
+        self.throttling[slot] += record.throttling_time_waiting
+        if record.duration <= LATENCY_BIN_FLOOR:
+            latency_bin = 0
+        else:
+            latency_bin = min(int(log(record.duration / LATENCY_BIN_FLOOR) / LATENCY_BIN_GROWTH) + 1, LATENCY_BINS - 1)
+        histogram = self.histograms[slot]
+        histogram[latency_bin] = histogram.get(latency_bin, 0) + 1
 
-# Loop to display the nested results in sorted order
-for cube_name, entries in sorted_cubes:
-    stats = calculate_stats(entries)
-    querySource = query_sources[cube_name]
-    print(f"\nCubeName: {cube_name} (Query Source: {querySource})")
-    print(f"Count of Slow Queries: {stats['count']}")
-    print(f"Average Duration: {stats['average_duration']:.3f}")
-    print(f"Slowest Duration: {stats['max_duration']:.3f}")
+    def stats(self, current_bucket):
+        count = m2m_hits = 0
+        throttling = 0.0
+        histogram = Counter()
+        for slot, stamp in enumerate(self.stamps):
+            if stamp is not None and 0 <= current_bucket - stamp < self.slots:
+                count += self.counts[slot]
+                m2m_hits += self.m2m_hits[slot]
+                throttling += self.throttling[slot]
+                histogram.update(self.histograms[slot])
+        p95 = 0.0
+        seen = 0
+        for latency_bin in sorted(histogram):
+            seen += histogram[latency_bin]
+            if seen >= count * 0.95:
+                p95 = LATENCY_BIN_FLOOR * exp(latency_bin * LATENCY_BIN_GROWTH)
+                break
+        return {'count': count, 'p95': p95, 'm2m_hits': m2m_hits, 'throttling': throttling / count if count else 0.0}
+
+def check_alerts(windows, current_bucket, last_alerts, as_json=False):
+    """
+    Print an alert for every window over a threshold, at most once per window length for each key and kind,
+    and forget windows and alerts that have aged out.
+    """
+    now = datetime.now().replace(microsecond=0)
+    for key, window in list(windows.items()):
+        stats = window.stats(current_bucket)
+        if not stats['count']:
+            del windows[key]
+            continue
+        label = f"CubeName: {key[1]}" if key[0] == 'cube' else f"CubeName: {key[1]}, Dashboard: {key[2]}"
+        for kind, triggered, message in (
+                ('p95', stats['p95'] > alert_p95_seconds, f"P95 duration {stats['p95']:.3f}s"),
+                ('m2m', stats['m2m_hits'] >= alert_m2m_hits, f"{stats['m2m_hits']} possible M2M queries"),
+                ('throttling', stats['throttling'] > alert_throttling_seconds, f"average throttling wait {stats['throttling']:.3f}s")):
+            if not triggered or current_bucket - last_alerts.get((key, kind), -RollingWindow.slots) < RollingWindow.slots:
+                continue
+            last_alerts[(key, kind)] = current_bucket
+            if as_json:
+                print(json.dumps({'time': now.isoformat(), 'alert': kind, 'scope': list(key), 'message': message, **stats}), flush=True)
+            else:
+                print(f"{now} ALERT {label} - {message} over the last {follow_window_seconds}s ({stats['count']} queries)", flush=True)
+    for alert_key in [alert_key for alert_key, bucket in last_alerts.items() if current_bucket - bucket >= RollingWindow.slots]:
+        del last_alerts[alert_key]
+
+def follow_log(log_file, poll_interval=1.0, as_json=False):
+    """
+    Tail query.log like tail -F, reopening it when logrotate replaces or truncates it, and keep rolling
+    windows per cube and dashboard. Starts from the first line inside the current window.
+    """
+    windows = {}
+    last_alerts = {}
+    file = None
+    inode = None
+    pending = b''
+    first_open = True
+    current_bucket = None
+    next_check = time.monotonic()
+    while True:
+        if file is None:
+            try:
+                file = open(log_file, 'rb')
+            except FileNotFoundError:
+                time.sleep(poll_interval)
+                continue
+            inode = os.fstat(file.fileno()).st_ino
+            if first_open:
+                start = find_window_start(log_file, datetime.now() - timedelta(seconds=follow_window_seconds))
+                if start:
+                    file.seek(start - 1)
+                    file.readline()
+                first_open = False
+
+        block = file.read(1024 * 1024)
+        if block:
+            lines = (pending + block).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                line = line.decode('utf-8', 'replace')
+                if FINISH_QUERY_MARKER not in line:
+                    continue
+                record = parse_finish_query(line)
+                if record is None:
+                    continue
+                bucket = int((record.timestamp - EPOCH).total_seconds()) // follow_bucket_seconds
+                current_bucket = bucket if current_bucket is None else max(current_bucket, bucket)
+                cube_name = record.cube_name or 'No CubeName'
+                for key in (('cube', cube_name), ('dashboard', cube_name, record.dashboard or 'No Dashboard')):
+                    window = windows.get(key)
+                    if window is None:
+                        window = windows[key] = RollingWindow()
+                    window.add(record, bucket)
+        else:
+            try:
+                stat = os.stat(log_file)
+            except FileNotFoundError:
+                stat = None
+            # Rotated away or truncated in place, everything left in the old file has been read so start the new one
+            if stat is None or stat.st_ino != inode or stat.st_size < file.tell():
+                file.close()
+                file = None
+                pending = b''
+                continue
+            time.sleep(poll_interval)
+
+        if current_bucket is not None and time.monotonic() >= next_check:
+            check_alerts(windows, current_bucket, last_alerts, as_json)
+            next_check = time.monotonic() + poll_interval
+
+def print_percentiles(label, sketch, indent=''):
+    stats = calculate_stats(sketch)
     if 'p50_duration' in stats:
-        print(f"P50 Duration: {stats['p50_duration']:.3f}")
-    if 'p95_duration' in stats:
-        print(f"P95 Duration: {stats['p95_duration']:.3f}")
-    print(f"Maximum Concurrent Queries: {stats['max_concurrent_query']}")
-
-    for dashboard, widgets in dashboard_widget_count[cube_name].items():
-        max_vals = max_values[cube_name][dashboard]
-        print(f"  Dashboard: {dashboard}")
-        print(f"    Max Translation Duration: {max_vals['translationDuration']}")
-        print(f"    Max Data Source Execution Duration: {max_vals['dataSourceExecuteDuration']}")
-        print(f"    Max Throttling Time Waiting: {max_vals['throttlingTimeWaiting']}")
-        for widget, freq in widgets.items():
-            if freq > repeat_offender_threshold:
-                widgetType = widget_types[cube_name][dashboard][widget]
-                print(f"    Widget: {widget} (Type: {widgetType}) - Count: {freq}")
-
-# Calculate the percentage of slow queries
-if total_queries > 0:
-    slow_queries_percentage = (total_slow_queries / total_queries) * 100
-else:
-    slow_queries_percentage = 0
-
-overall_average_duration = total_duration / total_queries if total_queries else 0
-
-# Display the result
-day_suffix = "day" if days_to_look_back == 1 else "days"
-print(f"\nFound {total_slow_queries} slow queries (duration > {slow_query_threshold} seconds) which is {slow_queries_percentage:.4f}% of {total_queries} total queries over the past {days_to_look_back} {day_suffix}. The overall average response time is {overall_average_duration:.3f} seconds")
-
-print("\nSummary of detected possible M2Ms based on m2mThresholdFlag:")
-for (dashboard, widget, widgetType), cube_names in m2m_threshold_entries.items():
-    for cube_name, count in cube_names.items():
-        print(f"Dashboard: {dashboard}, Widget: {widget}, Widget Type: {widgetType}, Cube: {cube_name} - Count: {count}")
-
-if earliest_timestamp and latest_timestamp:
-    print(f"\nTimestamp range of processed data: {earliest_timestamp} to {latest_timestamp}")
-else:
-    print("\nNo data available in the specified date range.")
-
-print("\nTimestamps with Reported Slow Queries:")
-sorted_timestamps = sorted(timestamp_count.items())
-for timestamp, count in sorted_timestamps:
-    print(f"  {timestamp}: {count} slow queries")
+        print(f"{indent}{label} - Count: {stats['count']}, P50: {stats['p50_duration']:.3f}, P90: {stats['p90_duration']:.3f}, "
+              f"P95: {stats['p95_duration']:.3f}, P99: {stats['p99_duration']:.3f}, Max: {stats['max_duration']:.3f}")
+    else:
+        print(f"{indent}{label} - Count: {stats['count']}, Max: {stats['max_duration']:.3f}")
+
+def print_latency_report(aggregates, level='cube'):
+    dashboards = defaultdict(list)
+    for (cube_name, dashboard), sketch in aggregates.dashboard_latency.items():
+        dashboards[cube_name].append((dashboard, sketch))
+    widgets = defaultdict(list)
+    for (cube_name, dashboard, widget), sketch in aggregates.widget_latency.items():
+        widgets[(cube_name, dashboard)].append((widget, sketch))
+
+    print("\nQuery latency percentiles for all queries:")
+    for cube_name, sketch in aggregates.cube_latency.items():
+        print_percentiles(f"CubeName: {cube_name}", sketch)
+        if level == 'cube':
+            continue
+        for dashboard, dashboard_sketch in dashboards[cube_name]:
+            print_percentiles(f"Dashboard: {dashboard}", dashboard_sketch, '  ')
+            if level == 'widget':
+                for widget, widget_sketch in widgets[(cube_name, dashboard)]:
+                    print_percentiles(f"Widget: {widget}", widget_sketch, '    ')
+
+def print_node_breakdown(nodes):
+    print("\nPer-node breakdown:")
+    for node, aggregates in sorted(nodes.items()):
+        node_latency = DDSketch()
+        for sketch in aggregates.cube_latency.values():
+            node_latency.merge(sketch)
+        slow_queries_percentage = aggregates.total_slow_queries / aggregates.total_queries * 100 if aggregates.total_queries else 0
+        if aggregates.m2m_hitters is not None:
+            m2m_count = aggregates.m2m_hitters.total
+        else:
+            m2m_count = sum(sum(cube_names.values()) for cube_names in aggregates.m2m_threshold_entries.values())
+        print(f"Node: {node} - Queries: {aggregates.total_queries}, Slow Queries: {aggregates.total_slow_queries} ({slow_queries_percentage:.4f}%), Possible M2Ms: {m2m_count}")
+        print_percentiles("All queries", node_latency, '  ')
+        if aggregates.earliest_timestamp and aggregates.latest_timestamp:
+            print(f"  Timestamp range: {aggregates.earliest_timestamp} to {aggregates.latest_timestamp}")
+
+    cube_names = sorted({cube_name for aggregates in nodes.values() for cube_name in aggregates.slow_durations})
+    if cube_names:
+        print("\nSlow queries per cube and node:")
+        for cube_name in cube_names:
+            counts = ', '.join(f"{node}: {aggregates.slow_durations[cube_name].count if cube_name in aggregates.slow_durations else 0}"
+                               for node, aggregates in sorted(nodes.items()))
+            print(f"  CubeName: {cube_name} - {counts}")
+
+def print_performance_report(aggregates):
+    print(f"{'Data Model Name':<30} {'Total Queries Processed':<40} {'Average Duration in seconds (P50)':<40} {'90th Percentile (P90)':<40} {'95th Percentile (P95)':<40} {'99th Percentile (P99)':<30}\n")
+    # cube_latency counts every query of each cube exactly, in the order the cubes were first seen
+    cube_names = list(aggregates.cube_latency)
+    for cube_name, names in [(cube_name, [cube_name]) for cube_name in cube_names] + [('Overall Query Performance', cube_names)]:
+        count = sum(aggregates.cube_latency[name].count for name in names)
+        if not count:
+            continue
+        p50, p90, p95, p99 = interpolated_percentiles(aggregates.sorted_cube_durations(names), count, (0.5, 0.9, 0.95, 0.99))
+        print(f"{cube_name:<30} {count:<40d} {p50:<40.3f} {p90:<40.3f} {p95:<40.3f} {p99:<40.3f}")
+
+def print_slow_query_list(aggregates):
+    print(f"\nQueries slower than {slow_query_list_threshold} seconds, fastest first:")
+    for record in aggregates.sorted_slow_queries():
+        values = (record[0],) + record[2:]
+        fields = [f"{{{name}: {'' if value is None else value}}}" for name, value in zip(SLOW_QUERY_FIELDS, values)
+                  if value is not None or name not in ('widget', 'dashboard', 'cubeName')]
+        print(', '.join(fields))
+
+def dashboard_widgets(aggregates, cube_name):
+    """
+    {dashboard: [(widget, count, error, widget type)]} of a cube's slow queries, exact unless --top-k
+    was used, then only the top_k widgets with their error bounds.
+    """
+    if aggregates.widget_hitters is None:
+        return {dashboard: [(widget, freq, 0, aggregates.widget_types[cube_name][dashboard][widget]) for widget, freq in widgets.items()]
+                for dashboard, widgets in aggregates.dashboard_widget_count[cube_name].items()}
+    dashboards = defaultdict(list)
+    for (dashboard, widget), freq, error, widgetType in aggregates.widget_hitters[cube_name].top(aggregates.top_k):
+        dashboards[dashboard].append((widget, freq, error, widgetType))
+    return dashboards
+
+def m2m_entries(aggregates):
+    if aggregates.m2m_hitters is None:
+        return [key + (cube_name, count, 0) for key, cube_names in aggregates.m2m_threshold_entries.items() for cube_name, count in cube_names.items()]
+    return [key + (count, error) for key, count, error, label in aggregates.m2m_hitters.top(aggregates.top_k)]
+
+def print_duplicate_report(aggregates):
+    print(f"\nRepeated identical queries (same cube, dashboard, widget, widget type and query source within {duplicate_window_seconds} seconds):")
+    for cube_name, queries in sorted(aggregates.cube_queries.items(), key=lambda item: -aggregates.cube_wasted[item[0]]):
+        duplicates = aggregates.cube_duplicates[cube_name]
+        print(f"CubeName: {cube_name} - Queries: {queries}, Repeats: {duplicates} ({duplicates / queries * 100:.2f}%), "
+              f"Seconds spent on repeats: {aggregates.cube_wasted[cube_name]:.3f}")
+    total_queries = sum(aggregates.cube_queries.values())
+    total_duplicates = sum(aggregates.cube_duplicates.values())
+    if total_queries:
+        print(f"Overall: {total_duplicates} of {total_queries} queries were repeats ({total_duplicates / total_queries * 100:.2f}%), "
+              f"{sum(aggregates.cube_wasted.values()):.3f} seconds that result caching could have saved")
+    print(f"\nTop {duplicate_top_widgets} widgets by seconds spent on repeats:")
+    for (cube_name, dashboard, widget), wasted in aggregates.widget_wasted.most_common(duplicate_top_widgets):
+        print(f"  Cube: {cube_name}, Dashboard: {dashboard}, Widget: {widget} - Repeats: {aggregates.widget_duplicates[(cube_name, dashboard, widget)]}, Seconds: {wasted:.3f}")
+
+def print_report(aggregates, period=None):
+    # Compute the stats once per cube, then sort cube names based on the count of slow queries
+    cube_stats = {cube_name: calculate_stats(sketch) for cube_name, sketch in aggregates.slow_durations.items()}
+    sorted_cubes = sorted(cube_stats.items(), key=lambda x: x[1]['count'])
+
+    # Loop to display the nested results in sorted order
+    for cube_name, stats in sorted_cubes:
+        querySource = aggregates.query_sources[cube_name]
+        print(f"\nCubeName: {cube_name} (Query Source: {querySource})")
+        print(f"Count of Slow Queries: {stats['count']}")
+        print(f"Average Duration: {stats['average_duration']:.3f}")
+        print(f"Slowest Duration: {stats['max_duration']:.3f}")
+        if 'p50_duration' in stats:
+            print(f"P50 Duration: {stats['p50_duration']:.3f}")
+        if 'p95_duration' in stats:
+            print(f"P95 Duration: {stats['p95_duration']:.3f}")
+        print(f"Maximum Concurrent Queries: {aggregates.max_concurrent_query[cube_name]}")
+
+        for dashboard, widgets in dashboard_widgets(aggregates, cube_name).items():
+            max_vals = aggregates.dashboard_max_values(cube_name, dashboard)
+            print(f"  Dashboard: {dashboard}")
+            print(f"    Max Translation Duration: {max_vals['translationDuration']}")
+            print(f"    Max Data Source Execution Duration: {max_vals['dataSourceExecuteDuration']}")
+            print(f"    Max Throttling Time Waiting: {max_vals['throttlingTimeWaiting']}")
+            for widget, freq, error, widgetType in widgets:
+                if freq > repeat_offender_threshold:
+                    bound = f" (overestimated by at most {error})" if error else ""
+                    print(f"    Widget: {widget} (Type: {widgetType}) - Count: {freq}{bound}")
+
+    # Calculate the percentage of slow queries
+    if aggregates.total_queries > 0:
+        slow_queries_percentage = (aggregates.total_slow_queries / aggregates.total_queries) * 100
+    else:
+        slow_queries_percentage = 0
+
+    overall_average_duration = aggregates.total_duration / aggregates.total_queries if aggregates.total_queries else 0
+
+    # Display the result
+    if period is None:
+        period = f"over the past {days_to_look_back} {'day' if days_to_look_back == 1 else 'days'}"
+    print(f"\nFound {aggregates.total_slow_queries} slow queries (duration > {slow_query_threshold} seconds) which is {slow_queries_percentage:.4f}% of {aggregates.total_queries} total queries {period}. The overall average response time is {overall_average_duration:.3f} seconds")
+
+    print("\nSummary of detected possible M2Ms based on m2mThresholdFlag:")
+    for dashboard, widget, widgetType, cube_name, count, error in m2m_entries(aggregates):
+        bound = f" (overestimated by at most {error})" if error else ""
+        print(f"Dashboard: {dashboard}, Widget: {widget}, Widget Type: {widgetType}, Cube: {cube_name} - Count: {count}{bound}")
+
+    if aggregates.earliest_timestamp and aggregates.latest_timestamp:
+        print(f"\nTimestamp range of processed data: {aggregates.earliest_timestamp} to {aggregates.latest_timestamp}")
+    else:
+        print("\nNo data available in the specified date range.")
+
+    print("\nTimestamps with Reported Slow Queries:" if not aggregates.top_k else f"\nThe {aggregates.top_k} Minutes with the Most Slow Queries:")
+    for timestamp, count, error in aggregates.slow_minutes():
+        bound = f" (overestimated by at most {error})" if error else ""
+        print(f"  {timestamp}: {count} slow queries{bound}")
+
+def option_flags(dests):
+    return ' and '.join(f"--{dest.replace('_', '-')}" for dest in sorted(dests))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize slow queries and possible M2Ms from Sisense query logs.")
+    parser.add_argument("--workers", metavar="N", type=int, default=1, help="Parse log files (and chunks of large plain logs) in a pool of N processes.")
+    parser.add_argument("--incremental", action="store_true", help="Only parse log lines added since the last --incremental run and report on everything accumulated since the checkpoint was created.")
+    parser.add_argument("--reset-checkpoint", action="store_true", help="Discard the --incremental checkpoint before running.")
+    parser.add_argument("--cache", action="store_true", help="Ingest new or changed logs into the columnar cache and build the report from the cache (needs numpy, uses Parquet when pyarrow is installed).")
+    parser.add_argument("--ingest-only", action="store_true", help="Only bring the columnar cache up to date.")
+    parser.add_argument("--timeline", action="store_true", help="Reconstruct in-flight concurrency per second for the node and each cube from the columnar cache and line it up with throttlingTimeWaiting (needs numpy).")
+    parser.add_argument("--timeline-csv", metavar="PATH", type=str, help="With --timeline, also write every active second to a CSV file.")
+    parser.add_argument("--capacity", action="store_true", help="Fit a queueing model of the query throttle per cube from the columnar cache, simulate P95 latency at several concurrency limits and recommend one (needs numpy).")
+    parser.add_argument("--current-limit", metavar="N", type=int, help="With --capacity, the concurrency limit in force, instead of the highest concurrentQuery seen.")
+    parser.add_argument("--rollup", action="store_true", help="Add the log lines not yet seen to the per-cube minute, hour and day rollups kept in the state directory.")
+    parser.add_argument("--trend", metavar="CUBE", nargs="?", const="", help="Print latency per bucket for CUBE, or every cube, from the rollup store.")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="With --trend, start of the range in UTC (default 30 days ago).")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="With --trend, end of the range in UTC (default now).")
+    parser.add_argument("--tier", choices=[tier for tier, seconds in ROLLUP_TIERS], help="With --trend, bucket size (default: chosen from the range).")
+    parser.add_argument("--follow", action="store_true", help="Tail query.log and print alerts from rolling per cube and per dashboard windows until interrupted.")
+    parser.add_argument("--alert-json", action="store_true", help="With --follow, print alerts as JSON lines.")
+    parser.add_argument("--performance", action="store_true", help="In the same pass, also print the per cube percentile table of QueryPerformance.sh and the slow query list of SlowQuery.sh.")
+    parser.add_argument("--duplicates", action="store_true", help="Also report queries repeated within duplicate_window_seconds, the seconds they took and the widgets repeating the most.")
+    parser.add_argument("--slow-limit", metavar="N", type=int, help="With --performance, only list the N slowest queries.")
+    parser.add_argument("--top-k", metavar="N", type=int, help="Only report the N most frequent slow widgets per cube, M2M combinations and minutes with slow queries, and keep dashboard and widget percentiles for the most frequent ones, counted in memory that doesn't grow with the number of dashboards and widgets, with error bounds.")
+    parser.add_argument("--nodes", metavar="SOURCE", nargs="+", help="Log roots or tarballs, one per node, to aggregate in parallel into one cluster report with a per-node breakdown.")
+    parser.add_argument("--write-partial", metavar="DIR", type=str, help="Write each node's aggregates (this node's, or one per --nodes source) to DIR instead of printing a report.")
+    parser.add_argument("--node-name", type=str, default=socket.gethostname(), help="Name this node's partial aggregate file is written under (default: the host name).")
+    parser.add_argument("--merge-partials", metavar="FILE", nargs="+", help="Reduce partial aggregate files from --write-partial into one cluster report with a per-node breakdown.")
+    parser.add_argument("--profile", action="store_true", help="After the report, print wall and CPU time, lines/s and MB/s per parsing phase and per log file.")
+    parser.add_argument("--profile-dump", metavar="PATH", type=str, help="Also run cProfile over this process (not the --workers pool) and write the pstats file to PATH.")
+    parser.add_argument("--gzip-backend", choices=('auto',) + GZIP_BACKENDS, default=gzip_backend, help="How rotated logs are decompressed.")
+    parser.add_argument("--benchmark-gzip", action="store_true", help="Time every available gzip backend on the rotated logs and exit.")
+    parser.add_argument("--percentiles", choices=['none', 'cube', 'dashboard', 'widget'], default='cube', help="Print P50/P90/P95/P99 latency for all queries at this level of detail.")
+    args = parser.parse_args()
+
+    # Each mode and the options it reads, in the order they're dispatched below. The last ones are where the
+    # report reads its logs from, plain parsing when none is given. Anything else would be silently ignored
+    modes = ((('benchmark_gzip',), ()),
+             (('rollup', 'trend'), ('workers', 'since', 'until', 'tier')),
+             (('follow',), ('alert_json',)),
+             (('timeline',), ('workers', 'timeline_csv')),
+             (('capacity',), ('workers', 'current_limit')),
+             (('ingest_only',), ('workers',)),
+             (('performance',), ('workers', 'slow_limit', 'top_k')),
+             (('duplicates',), ('workers', 'top_k')),
+             (('merge_partials',), ('write_partial', 'percentiles')),
+             (('nodes',), ('workers', 'top_k', 'write_partial', 'percentiles')),
+             (('cache',), ('workers', 'top_k', 'write_partial', 'node_name', 'percentiles')),
+             (('incremental',), ('workers', 'top_k', 'write_partial', 'node_name', 'percentiles')),
+             ((), ('workers', 'top_k', 'write_partial', 'node_name', 'percentiles')))
+    anywhere = {'gzip_backend', 'profile', 'profile_dump', 'reset_checkpoint'}
+    given = {dest for dest, value in vars(args).items() if value != parser.get_default(dest)}
+    chosen = [(dests, options) for dests, options in modes if given.intersection(dests)] or [modes[-1]]
+    if len(chosen) > 1:
+        parser.error(f"{option_flags(given.intersection(chosen[0][0]))} and {option_flags(given.intersection(chosen[1][0]))} can't be used together")
+    mode_dests, mode_options = chosen[0]
+    ignored = given - set(mode_dests) - set(mode_options) - anywhere
+    if ignored:
+        parser.error(f"{option_flags(ignored)} {'has' if len(ignored) == 1 else 'have'} no effect with {option_flags(given.intersection(mode_dests)) or 'the default report'}")
+    if 'node_name' in given and 'write_partial' not in given:
+        parser.error("--node-name only names the file --write-partial writes")
+    if 'percentiles' in given and 'write_partial' in given:
+        parser.error("--percentiles has no effect with --write-partial, which prints no report")
+
+    earliest_date = datetime.now().replace(tzinfo=None) - timedelta(days=days_to_look_back)
+    gzip_backend = args.gzip_backend
+    if args.profile or args.profile_dump:
+        active_profile = PhaseProfile()
+        atexit.register(print_profile, active_profile, time.perf_counter(), os.times())
+    if args.profile_dump:
+        profiler = cProfile.Profile()
+        atexit.register(profiler.dump_stats, args.profile_dump)
+        atexit.register(profiler.disable)
+        profiler.enable()
+    if gzip_backend != 'auto' and gzip_backend not in available_gzip_backends():
+        raise SystemExit(f"Error: gzip backend {gzip_backend} is not installed. Available: {', '.join(available_gzip_backends())}")
+    if args.benchmark_gzip:
+        benchmark_gzip_backends(find_log_files(log_directory))
+        raise SystemExit(0)
+    if args.reset_checkpoint and os.path.exists(checkpoint_path()):
+        os.remove(checkpoint_path())
+    if args.rollup or args.trend is not None:
+        if args.rollup:
+            print(f"Updated {update_rollups(find_log_files(log_directory), args.workers)} cube minutes in {rollup_path()}")
+        if args.trend is not None:
+            until = args.until or datetime.now(timezone.utc).replace(tzinfo=None)
+            print_trend(args.since or until - timedelta(days=30), until, args.trend or None, args.tier)
+        raise SystemExit(0)
+    if args.follow:
+        try:
+            follow_log(f'{log_directory}/query.log', as_json=args.alert_json)
+        except KeyboardInterrupt:
+            pass
+        raise SystemExit(0)
+    if (args.cache or args.ingest_only or args.timeline or args.capacity) and np is None:
+        parser.error("--cache, --ingest-only, --timeline and --capacity need numpy installed")
+    if args.timeline:
+        timelines = build_timelines(*load_columns(ingest_logs(find_log_files(log_directory), args.workers), earliest_date))
+        print_timeline_report(timelines)
+        if args.timeline_csv:
+            write_timeline_csv(timelines, args.timeline_csv)
+        raise SystemExit(0)
+    if args.capacity:
+        print_capacity_report(fit_capacity_model(*load_columns(ingest_logs(find_log_files(log_directory), args.workers), earliest_date), args.current_limit))
+        raise SystemExit(0)
+    if args.ingest_only:
+        ingest_logs(find_log_files(log_directory), args.workers)
+        raise SystemExit(0)
+    if args.performance:
+        with tempfile.TemporaryDirectory(prefix='QueryM2M-') as spill_directory:
+            aggregates = analyze_performance(find_log_files(log_directory), earliest_date, spill_directory, args.workers, args.slow_limit, args.top_k)
+            print_performance_report(aggregates)
+            print_slow_query_list(aggregates)
+            print_report(aggregates)
+        raise SystemExit(0)
+    if args.duplicates:
+        aggregates = analyze_logs(find_log_files(log_directory), earliest_date, args.workers, partial(DuplicateAggregates, args.top_k))
+        print_report(aggregates)
+        print_duplicate_report(aggregates)
+        raise SystemExit(0)
+
+    nodes = period = None
+    if args.merge_partials:
+        nodes = load_partials(args.merge_partials)
+    elif args.nodes:
+        nodes = analyze_nodes(args.nodes, earliest_date, args.workers, args.top_k)
+    elif args.cache:
+        aggregates = aggregates_from_columns(*load_columns(ingest_logs(find_log_files(log_directory), args.workers), earliest_date), args.top_k)
+    elif args.incremental:
+        aggregates, since = analyze_logs_incremental(find_log_files(log_directory), earliest_date, args.workers, args.top_k)
+        period = f"since {since:%Y-%m-%d %H:%M}, when the checkpoint was started"
+    else:
+        aggregates = analyze_logs(find_log_files(log_directory), earliest_date, args.workers, partial(QueryAggregates, args.top_k))
+    if args.write_partial:
+        for node, node_aggregates in (nodes or {args.node_name: aggregates}).items():
+            save_partial(partial_path(args.write_partial, node), node, node_aggregates, earliest_date)
+            print(f"Wrote {partial_path(args.write_partial, node)}")
+        raise SystemExit(0)
+    if nodes is not None:
+        aggregates = reduce_nodes(nodes)
+        print_report(aggregates)
+        print_node_breakdown(nodes)
+    else:
+        print_report(aggregates, period)
+    if args.percentiles != 'none':
+        print_latency_report(aggregates, args.percentiles)
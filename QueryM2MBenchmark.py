@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import QueryM2M
+import QueryLogGenerator
+
+# Parameters to configure
+default_size = '200MB' # Synthetic logs generated when no --data directory is given
+regression_threshold = 0.10 # Fail when lines/s drops or peak RSS grows by more than this fraction against the baseline
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+def read_path(log_files, scratch):
+    return sum(1 for log_file in log_files for line in QueryM2M.read_finish_query_lines(log_file))
+
+def parse_path(log_files, scratch):
+    return sum(1 for log_file in log_files for line in QueryM2M.read_finish_query_lines(log_file)
+               if QueryM2M.parse_finish_query(line) is not None)
+
+def aggregate_path(log_files, scratch):
+    return QueryM2M.analyze_logs(log_files, datetime.min).total_queries
+
+def parallel_aggregate_path(log_files, scratch):
+    return QueryM2M.analyze_logs(log_files, datetime.min, os.cpu_count()).total_queries
+
+def performance_path(log_files, scratch):
+    aggregates = QueryM2M.analyze_performance(log_files, datetime.min, scratch)
+    for record in aggregates.sorted_slow_queries():
+        pass
+    return aggregates.total_queries
+
+def cache_ingest_path(log_files, scratch):
+    return QueryM2M.aggregates_from_columns(*QueryM2M.load_columns(QueryM2M.ingest_logs(log_files), datetime.min)).total_queries
+
+def cache_load_path(log_files, scratch):
+    # Runs after cache-ingest against the same state directory, so nothing is parsed
+    return cache_ingest_path(log_files, scratch)
+
+def shell_path(script):
+    def run(log_files, scratch):
+        with open(os.path.join(SCRIPT_DIRECTORY, script)) as file:
+            text = file.read().replace('/var/log/sisense/sisense/', os.path.dirname(log_files[0]) + '/')
+        completed = subprocess.run(['bash', '-c', text], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if completed.returncode:
+            # QueryPerformance.sh needs gawk, mawk stops at its arrays of arrays
+            raise RuntimeError((completed.stderr.decode(errors='replace').strip().splitlines() or [f"exit status {completed.returncode}"])[0])
+        return None
+    return run
+
+# Name, function and whether it needs numpy, in the order they run
+PATHS = (
+    ('read', read_path, False),
+    ('parse', parse_path, False),
+    ('aggregate', aggregate_path, False),
+    ('aggregate-parallel', parallel_aggregate_path, False),
+    ('performance', performance_path, False),
+    ('cache-ingest', cache_ingest_path, True),
+    ('cache-load', cache_load_path, True),
+    ('QueryPerformance.sh', shell_path('QueryPerformance.sh'), False),
+    ('SlowQuery.sh', shell_path('SlowQuery.sh'), False),
+)
+
+def run_path(name, log_files, state_directory, connection):
+    """
+    Run one path in a fresh process so its peak RSS is its own. Subprocesses (the pool, awk) count too.
+    """
+    QueryM2M.state_directory = state_directory
+    function = dict((path_name, path_function) for path_name, path_function, _ in PATHS)[name]
+    with tempfile.TemporaryDirectory(prefix='QueryM2MBenchmark-') as scratch:
+        try:
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            records = function(log_files, scratch)
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+        except Exception as error:
+            connection.send({'error': f"{type(error).__name__}: {error}"})
+            return
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    connection.send({'seconds': elapsed, 'cpu_seconds': cpu, 'records': records, 'peak_rss_mb': peak_kb / 1024})
+
+def measure(name, log_files, state_directory):
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_path, args=(name, log_files, state_directory, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': f"exited with code {process.exitcode}"}
+    process.join()
+    return result
+
+def dataset_stats(log_files):
+    """
+    Total lines and uncompressed bytes of the logs.
+    """
+    lines = size = 0
+    for log_file in log_files:
+        with (gzip.open(log_file, 'rb') if log_file.endswith('.gz') else open(log_file, 'rb')) as file:
+            for block in iter(lambda: file.read(QueryM2M.read_block_size), b''):
+                lines += block.count(b'\n')
+                size += len(block)
+    return lines, size
+
+def run_benchmarks(log_files, paths, repeat=1):
+    lines, size = dataset_stats(log_files)
+    print(f"Benchmarking on {len(log_files)} logs, {lines} lines, {size / (1024 * 1024):.1f} MB uncompressed")
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='QueryM2MBenchmark-state-') as state_directory:
+        for name, function, needs_numpy in PATHS:
+            if name not in paths:
+                continue
+            if needs_numpy and QueryM2M.np is None:
+                print(f"{name:<22} skipped, needs numpy")
+                continue
+            # Best of repeat runs, except cache-ingest which only finds an empty cache the first time
+            runs = []
+            for _ in range(1 if name == 'cache-ingest' else repeat):
+                runs.append(measure(name, log_files, state_directory))
+            failed = [run for run in runs if 'error' in run]
+            if failed:
+                print(f"{name:<22} failed: {failed[0]['error']}")
+                continue
+            best = min(runs, key=lambda run: run['seconds'])
+            result = {'lines_per_second': lines / best['seconds'], 'mb_per_second': size / (1024 * 1024) / best['seconds'],
+                      'peak_rss_mb': max(run['peak_rss_mb'] for run in runs), 'seconds': best['seconds'], 'cpu_seconds': best['cpu_seconds']}
+            results[name] = result
+            print(f"{name:<22} {result['seconds']:8.2f}s {result['lines_per_second']:12,.0f} lines/s {result['mb_per_second']:8.1f} MB/s "
+                  f"{result['peak_rss_mb']:8.1f} MB peak RSS")
+    return results
+
+def compare_to_baseline(results, baseline, threshold, paths=None):
+    """
+    Print every path that got slower or bigger than the baseline allows, or that was run and is in the
+    baseline but failed or was skipped this time, and return whether any did.
+    """
+    regressed = False
+    for name in baseline:
+        if name not in results and (paths is None or name in paths):
+            print(f"Regression: {name} is in the baseline but has no result, it failed or was skipped")
+            regressed = True
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        speed = result['lines_per_second'] / baseline[name]['lines_per_second'] - 1
+        memory = result['peak_rss_mb'] / baseline[name]['peak_rss_mb'] - 1
+        if speed < -threshold:
+            print(f"Regression: {name} is {-speed:.1%} slower than the baseline")
+            regressed = True
+        if memory > threshold:
+            print(f"Regression: {name} peaks at {memory:.1%} more memory than the baseline")
+            regressed = True
+    return regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark each QueryM2M parsing and aggregation path, and the shell scripts, on synthetic or real query logs.")
+    parser.add_argument("--data", metavar="DIR", type=str, help="Benchmark the query logs in DIR instead of generating synthetic ones.")
+    parser.add_argument("--size", type=QueryLogGenerator.parse_size, default=QueryLogGenerator.parse_size(default_size), help=f"Uncompressed size of the synthetic logs (default {default_size}).")
+    parser.add_argument("--paths", nargs="+", choices=[name for name, _, _ in PATHS], default=[name for name, _, _ in PATHS], help="Only run these paths.")
+    parser.add_argument("--repeat", type=int, default=1, help="Run each path this many times and keep the fastest.")
+    parser.add_argument("--save-baseline", metavar="FILE", type=str, help="Write the results to FILE as the baseline for later runs.")
+    parser.add_argument("--baseline", metavar="FILE", type=str, help="Compare against the results in FILE and exit with status 1 on a regression.")
+    parser.add_argument("--threshold", type=float, default=regression_threshold, help=f"Allowed slowdown or memory growth as a fraction (default {regression_threshold}).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='QueryM2MBenchmark-logs-') as generated:
+        if args.data:
+            log_files = QueryM2M.find_log_files(args.data)
+            if not log_files:
+                parser.error(f"no query logs in {args.data}")
+        else:
+            # A fixed end time keeps the synthetic logs identical between runs
+            QueryLogGenerator.generate_logs(generated, args.size, now=datetime(2024, 1, 8))
+            log_files = QueryM2M.find_log_files(generated)
+        results = run_benchmarks(log_files, args.paths, args.repeat)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare_to_baseline(results, baseline, args.threshold, args.paths):
+            raise SystemExit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
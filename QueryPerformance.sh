@@ -1,4 +1,5 @@
 #Calculate performance statistics from finished queries, run from any SSH session to a node where logs are stored
+# QueryM2M.py --performance prints this table from the same single pass as its other reports, with exact fields instead of splitting on [,:]
 Filepath=/var/log/sisense/sisense/ && { cat ${Filepath}query.log; zcat ${Filepath}query*.log-*.gz 2>/dev/null; } | awk -F'[,:]' '
     function percentile(arr, p, n) {
         if (n == 1) return arr[1];
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3.12
 
+import mmap
 import os
 import sys
 import queue
+from collections import deque
 import threading
 import sqlite3
 import datetime
@@ -10,11 +12,12 @@ import logging
 import time
 import argparse
 import configparser
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import warnings
 from cryptography.utils import CryptographyDeprecationWarning
 with warnings.catch_warnings(action="ignore", category=CryptographyDeprecationWarning):
     import paramiko
+    from paramiko.sftp import CMD_STATUS, CMD_WRITE, int64
 
 # Read configuration from config.ini
 config = configparser.ConfigParser()
@@ -34,6 +37,16 @@ LOG_FILE = config.get('sftpUploader', 'LOG_FILE')
 MAX_RETRIES = config.getint('sftpUploader', 'MAX_RETRIES')
 RETRY_DELAY_BASE = config.getint('sftpUploader', 'RETRY_DELAY_BASE')
 MIN_FILE_AGE = config.getint('sftpUploader', 'MIN_FILE_AGE')
+# Transfer tuning, the defaults are sized for high latency links. Paramiko's own defaults are a 2 MB window and 32 KB packets
+TRANSPORT_WINDOW_SIZE = config.getint('sftpUploader', 'TRANSPORT_WINDOW_SIZE', fallback=64 * 1024 * 1024)
+MAX_PACKET_SIZE = config.getint('sftpUploader', 'MAX_PACKET_SIZE', fallback=256 * 1024)
+# OpenSSH's sftp-server drops the session on messages over 256 KB, so a write plus its header has to stay under that
+SFTP_MAX_WRITE_SIZE = 255 * 1024
+WRITE_CHUNK_SIZE = min(config.getint('sftpUploader', 'WRITE_CHUNK_SIZE', fallback=32 * 1024), SFTP_MAX_WRITE_SIZE)
+MAX_OUTSTANDING_REQUESTS = config.getint('sftpUploader', 'MAX_OUTSTANDING_REQUESTS', fallback=64)
+MMAP_THRESHOLD = config.getint('sftpUploader', 'MMAP_THRESHOLD_MB', fallback=16) * 1024 * 1024
+# Comma separated list of [destination:<name>] sections, empty means upload only to SFTP_SERVER above
+DESTINATION_NAMES = [name.strip() for name in config.get('sftpUploader', 'DESTINATIONS', fallback='').split(',') if name.strip()]
 
 # Get logging configuration
 log_level_str = config['logging']['level'].upper()
@@ -53,23 +66,41 @@ def convert_datetime(s):
 sqlite3.register_adapter(datetime.datetime, adapt_datetime)
 sqlite3.register_converter("timestamp", convert_datetime)
 
+def load_destinations():
+    if not DESTINATION_NAMES:
+        return {'default': {'server': SFTP_SERVER, 'port': SFTP_PORT, 'username': SFTP_USERNAME, 'private_key_path': PRIVATE_KEY_PATH}}
+    destinations = {}
+    for name in DESTINATION_NAMES:
+        section = f'destination:{name}'
+        destinations[name] = {
+            'server': config.get(section, 'SFTP_SERVER'),
+            'port': config.getint(section, 'SFTP_PORT', fallback=SFTP_PORT),
+            'username': config.get(section, 'SFTP_USERNAME', fallback=SFTP_USERNAME),
+            'private_key_path': config.get(section, 'PRIVATE_KEY_PATH', fallback=PRIVATE_KEY_PATH),
+        }
+    return destinations
+
+DESTINATIONS = load_destinations()
+
 def setup_database():
     logging.info("Setting up database.")
     logging.debug("SQLite3 version: %s", sqlite3.sqlite_version)
     conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
     c = conn.cursor()
     c.execute('CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, status TEXT, last_modified TIMESTAMP)')
+    c.execute('CREATE TABLE IF NOT EXISTS destinations (filename TEXT, destination TEXT, status TEXT, last_modified TIMESTAMP, PRIMARY KEY (filename, destination))')
     conn.commit()
     conn.close()
 
 def get_db_connection():
     return sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
 
-def setup_sftp_client():
+def setup_sftp_client(destination=None, tuned=True):
+    destination = destination or next(iter(DESTINATIONS.values()))
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.WarningPolicy())
-    private_key = paramiko.RSAKey.from_private_key_file(PRIVATE_KEY_PATH)
-    client.connect(SFTP_SERVER, port=SFTP_PORT, username=SFTP_USERNAME, pkey=private_key, timeout=20)
+    private_key = paramiko.RSAKey.from_private_key_file(destination['private_key_path'])
+    client.connect(destination['server'], port=destination['port'], username=destination['username'], pkey=private_key, timeout=20)
     
     # Log the server's host key (SSL certificate equivalent)
     server_key = client.get_transport().get_remote_server_key()
@@ -77,11 +108,16 @@ def setup_sftp_client():
     key_fingerprint = server_key.get_fingerprint().hex()
     logging.debug(f"SFTP connection established. Server key type: {key_type}, Fingerprint: {key_fingerprint}")
 
-    sftp = client.open_sftp()
+    if tuned:
+        transport = client.get_transport()
+        transport.default_window_size = TRANSPORT_WINDOW_SIZE
+        sftp = paramiko.SFTPClient.from_transport(transport, window_size=TRANSPORT_WINDOW_SIZE, max_packet_size=MAX_PACKET_SIZE)
+    else:
+        sftp = client.open_sftp()
     return sftp, client
 
-# Create a pool of SFTP connections
-sftp_connection_pool = ThreadPoolExecutor(max_workers=(4*(int(NUM_WORKERS))), initializer=setup_sftp_client)
+# Threads for the per-destination uploads, each upload opens its own connection so one unreachable server only fails its own destination
+upload_pool = ThreadPoolExecutor(max_workers=(4*(int(NUM_WORKERS))))
 
 def ensure_sftp_path_exists(sftp, remote_path):
     dirs = []
@@ -100,7 +136,59 @@ def ensure_sftp_path_exists(sftp, remote_path):
         except FileNotFoundError:
             sftp.mkdir(remote_path)
 
-def upload_file(filepath, db_conn, sftp):
+def wait_for_write(sftp, request):
+    response_type, _ = sftp._read_response(request)
+    if response_type != CMD_STATUS:
+        raise IOError(f"unexpected response to write in put: {response_type}")
+
+def pipelined_put(sftp, payload, remote_path):
+    # SFTPFile.write doesn't bound how many writes are in flight or let them be waited on, so writes are sent and
+    # acknowledged through SFTPClient's private _async_request and _read_response instead, on request ids only this
+    # function waits on. The server answers in order, so waiting on the oldest never skips past a response still wanted.
+    outstanding = deque()
+    with memoryview(payload) as view, sftp.open(remote_path, 'wb') as remote_file:
+        for offset in range(0, len(view), WRITE_CHUNK_SIZE):
+            outstanding.append(sftp._async_request(type(None), CMD_WRITE, remote_file.handle, int64(offset),
+                                                   bytes(view[offset:offset + WRITE_CHUNK_SIZE])))
+            if len(outstanding) > MAX_OUTSTANDING_REQUESTS:
+                wait_for_write(sftp, outstanding.popleft())
+        while outstanding:
+            wait_for_write(sftp, outstanding.popleft())
+    remote_size = sftp.stat(remote_path).st_size
+    if remote_size != len(payload):
+        raise IOError(f"size mismatch in put! {remote_size} != {len(payload)}")
+    return len(payload)
+
+def read_payload(local_path):
+    # Large files are memory mapped so every destination streams from the page cache instead of a private copy
+    with open(local_path, 'rb') as local_file:
+        if os.fstat(local_file.fileno()).st_size >= MMAP_THRESHOLD:
+            return mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return local_file.read()
+
+def pending_destinations(cursor, filepath):
+    cursor.execute("SELECT destination FROM destinations WHERE filename=? AND status='uploaded'", (filepath,))
+    uploaded = {row[0] for row in cursor.fetchall()}
+    return [name for name in DESTINATIONS if name not in uploaded]
+
+def upload_to_destination(filepath, payload, name):
+    # Each destination gets its own connection and its own stream over the shared payload
+    client = None
+    try:
+        sftp, client = setup_sftp_client(DESTINATIONS[name])
+        remote_path = filepath
+        ensure_sftp_path_exists(sftp, os.path.dirname(remote_path))
+        pipelined_put(sftp, payload, remote_path)
+        logging.info(f"Uploaded {filepath} to {name}")
+        return True
+    except Exception as e:
+        logging.error(f"Failed to upload {filepath} to {name}: {e}")
+        return False
+    finally:
+        if client:
+            client.close()
+
+def upload_file(filepath, db_conn):
     cursor = db_conn.cursor()
     now = datetime.datetime.now()
     cursor.execute('SELECT status FROM files WHERE filename=?', (filepath,))
@@ -111,25 +199,40 @@ def upload_file(filepath, db_conn, sftp):
 
     cursor.execute('UPDATE files SET status=?, last_modified=? WHERE filename=?', ('uploading', now, filepath))
     db_conn.commit()
+    destinations = pending_destinations(cursor, filepath)
     try:
-        remote_path = filepath
-        ensure_sftp_path_exists(sftp, os.path.dirname(remote_path))
-        sftp.put(os.path.join(SOURCE_FOLDER, filepath), remote_path)
-        cursor.execute('UPDATE files SET status=?, last_modified=? WHERE filename=?', ('uploaded', now, filepath))
-        db_conn.commit()
-        logging.info(f"Uploaded {filepath}")
-        return True
+        # Read the file once, every destination streams from the same buffer
+        payload = read_payload(os.path.join(SOURCE_FOLDER, filepath))
     except Exception as e:
-        logging.error(f"Failed to upload {filepath}: {e}")
+        logging.error(f"Failed to read {filepath}: {e}")
         cursor.execute('UPDATE files SET status=?, last_modified=? WHERE filename=?', ('error', now, filepath))
         db_conn.commit()
         return False
 
+    success = True
+    try:
+        futures = {upload_pool.submit(upload_to_destination, filepath, payload, name): name for name in destinations}
+        for future in as_completed(futures):
+            name = futures[future]
+            status = 'uploaded' if future.result() else 'error'
+            success = success and status == 'uploaded'
+            cursor.execute('INSERT OR REPLACE INTO destinations (filename, destination, status, last_modified) VALUES (?, ?, ?, ?)',
+                           (filepath, name, status, now))
+            db_conn.commit()
+    finally:
+        if isinstance(payload, mmap.mmap):
+            payload.close()
+
+    cursor.execute('UPDATE files SET status=?, last_modified=? WHERE filename=?', ('uploaded' if success else 'error', now, filepath))
+    db_conn.commit()
+    if success:
+        logging.info(f"Uploaded {filepath} to {len(DESTINATIONS)} destination(s)")
+    return success
+
 def retry_upload(filepath, retry_count):
     db_conn = get_db_connection()
-    sftp, client = sftp_connection_pool.submit(setup_sftp_client).result()
     try:
-        success = upload_file(filepath, db_conn, sftp)
+        success = upload_file(filepath, db_conn)
         if not success:
             if retry_count < MAX_RETRIES:
                 logging.info(f"Retrying upload for {filepath}, attempt {retry_count + 1}")
@@ -141,7 +244,6 @@ def retry_upload(filepath, retry_count):
         logging.error(f"Error during upload attempt: {e}")
     finally:
         db_conn.close()
-        client.close()
 
 def worker(file_queue, stop_event):
     while not stop_event.is_set() or not file_queue.empty():
@@ -166,6 +268,7 @@ def manual_requeue(start_time, end_time):
         file_age = (now - last_modified).total_seconds()
         if file_age >= MIN_FILE_AGE:
             cursor.execute("UPDATE files SET status=? WHERE filename=?", ("pending", filepath))
+            cursor.execute("DELETE FROM destinations WHERE filename=?", (filepath,))
             file_queue.put(filepath)
             logging.info(f"Re-queued file {filepath} for re-upload.")
         else:
@@ -187,6 +290,7 @@ def manual_requeue_by_filename(filenames):
             file_age = (now - last_modified).total_seconds()
             if file_age >= MIN_FILE_AGE:
                 cursor.execute("UPDATE files SET status=? WHERE filename=?", ("pending", filepath))
+                cursor.execute("DELETE FROM destinations WHERE filename=?", (filepath,))
                 file_queue.put(filepath)
                 logging.info(f"Re-queued file {filepath} for re-upload.")
             else:
@@ -202,6 +306,7 @@ def cleanup_old_files():
     c = conn.cursor()
     cutoff_date = datetime.datetime.now() - datetime.timedelta(days=DATA_RETENTION_DAYS)
     c.execute('DELETE FROM files WHERE last_modified < ?', (cutoff_date,))
+    c.execute('DELETE FROM destinations WHERE last_modified < ?', (cutoff_date,))
     conn.commit()
     conn.close()
     logging.info("Cleaned up old files based on retention policy.")
@@ -245,6 +350,28 @@ def initial_file_scan():
     db_conn.commit()
     db_conn.close()
 
+def run_benchmark(local_path):
+    # Upload the same file with paramiko's defaults and with the tuned settings, then report throughput for each
+    size_mb = os.path.getsize(local_path) / (1024 * 1024)
+    remote_path = f".benchmark-{os.path.basename(local_path)}"
+    for name, destination in DESTINATIONS.items():
+        for label, tuned in (('paramiko defaults', False), ('tuned', True)):
+            sftp, client = setup_sftp_client(destination, tuned=tuned)
+            try:
+                start = time.perf_counter()
+                if tuned:
+                    payload = read_payload(local_path)
+                    pipelined_put(sftp, payload, remote_path)
+                    if isinstance(payload, mmap.mmap):
+                        payload.close()
+                else:
+                    sftp.put(local_path, remote_path)
+                elapsed = time.perf_counter() - start
+                print(f"{name} ({label}): {size_mb:.1f} MB in {elapsed:.2f}s - {size_mb / elapsed:.2f} MB/s")
+                sftp.remove(remote_path)
+            finally:
+                client.close()
+
 def main():
     logging.info("Batch Upload process started.")
     setup_database()
@@ -290,6 +417,7 @@ if __name__ == "__main__":
     parser.add_argument("--requeue-start", metavar="START", type=str, help="Re-queue files modified starting from this date and time (e.g., '2023-01-01 00:00:00').")
     parser.add_argument("--requeue-end", metavar="END", type=str, help="Re-queue files modified up to this date and time (e.g., '2023-01-01 23:59:59').")
     parser.add_argument("--requeue-filenames", metavar="FILENAMES", type=str, nargs='+', help="Re-queue files by their filenames.")
+    parser.add_argument("--benchmark", metavar="FILE", type=str, help="Upload FILE to every destination with paramiko defaults and with the tuned settings and print MB/s for each.")
     args = parser.parse_args()
 
     if args.requeue_start and args.requeue_end:
@@ -303,5 +431,8 @@ if __name__ == "__main__":
     elif args.requeue_filenames:
         manual_requeue_by_filename(args.requeue_filenames)
         sys.exit(0)
+    elif args.benchmark:
+        run_benchmark(args.benchmark)
+        sys.exit(0)
     else:
         main()
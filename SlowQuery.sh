@@ -1,4 +1,5 @@
 # Find slow queries! Anything that took more than 5 seconds, run from any SSH session to a node where logs are stored
+# QueryM2M.py --performance prints this list from the same single pass as its other reports, with exact fields instead of splitting on [,:]
 Filepath=/var/log/sisense/sisense/ && { cat ${Filepath}query.log; zcat ${Filepath}query*.log-*.gz 2>/dev/null; } | awk -F'[,:]' '
     /FinishQuery/ {
         delete data;